@@ -0,0 +1,322 @@
+"""API HTTP JSON del test finale (server della libreria standard, senza Streamlit).
+
+Usa lo stesso motore della pagina Streamlit (motore.py). Il server non ha
+stato: il test emesso è un ticket firmato che il client rimanda con le
+risposte, e l'unico stato condiviso è l'archivio risultati. Si possono quindi
+avviare più worker dietro un bilanciatore, con lo stesso TEST_FINALE_SEGRETO.
+
+Autenticazione HTTP Basic con gli utenti di utenti.py.
+
+    GET  /api/salute
+    GET  /api/banche                              banche e argomenti disponibili
+    POST /api/test       {"banca", "argomento", "n_domande", "seed", "strati", "una_per_gruppo"}
+    POST /api/consegne   {"ticket", "risposte": [0..3 | "A".."D" | null], "partecipante": {...}}
+                         una consegna per ticket (409 se già consegnato con altri dati
+                         o se la banca è cambiata dopo l'emissione del ticket)
+    GET  /api/risultati/<chiave_consegna>                 propri; staff: del proprio ente
+    GET  /api/risultati/<chiave_consegna>/pdf?tipo=test|badge
+    GET  /api/export?ente=&dal=&al=&indice=xlsx|csv   ZIP per audit (solo RSPP)
+
+Esempio:
+    python api_test.py --host 0.0.0.0 --porta 8502
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import traceback
+import unicodedata
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+import motore
+from export_audit import CARTELLA_EXPORT, FORMATI_INDICE, esporta_audit, nome_file_export
+from archivio_report import TIPI_REPORT, RiproduzioneNonValida, nome_file_report, pdf_report
+from metriche import misura
+from risultati import leggi_risultati
+from utenti import FileUtentiNonValido, autentica, carica_utenti
+
+# ============================================================
+# COSTANTI
+# ============================================================
+RUOLI_STAFF = {"Docente", "RSPP"}
+RUOLI_ADMIN = {"RSPP"}
+MAX_CORPO_BYTE = 1024 * 1024
+MAX_CREDENZIALI_IN_CACHE = 1024
+COLONNE_NASCOSTE = ("riproduzione",)
+
+
+class ErroreAPI(Exception):
+    def __init__(self, stato: int, messaggio: str):
+        super().__init__(messaggio)
+        self.stato = stato
+
+
+# ============================================================
+# AUTENTICAZIONE
+# ============================================================
+# credenziali già verificate: il KDF delle password si paga una volta per
+# processo e non a ogni richiesta (la chiave include la password memorizzata,
+# quindi un cambio di password nel file invalida la voce)
+_credenziali = OrderedDict()
+_lock_credenziali = threading.Lock()
+
+
+def _utente_da_header(header: str) -> dict:
+    if not header or not header.startswith("Basic "):
+        raise ErroreAPI(401, "Autenticazione richiesta.")
+    try:
+        username, _, password = base64.b64decode(header[6:]).decode("utf-8").partition(":")
+    except (ValueError, UnicodeDecodeError):
+        raise ErroreAPI(401, "Credenziali non leggibili.")
+
+    impronta = hashlib.sha256(f"{username}\0{password}".encode("utf-8")).hexdigest()
+    with _lock_credenziali:
+        voce = _credenziali.get(impronta)
+    try:
+        attuale = carica_utenti().get(username)
+    except FileUtentiNonValido as e:
+        raise ErroreAPI(500, str(e))
+    if voce is None or attuale is None or voce.password != attuale.password:
+        try:
+            voce = autentica(username, password)
+        except FileUtentiNonValido as e:
+            raise ErroreAPI(500, str(e))
+        if voce is None:
+            raise ErroreAPI(401, "Credenziali non valide.")
+        with _lock_credenziali:
+            _credenziali[impronta] = voce
+            while len(_credenziali) > MAX_CREDENZIALI_IN_CACHE:
+                _credenziali.popitem(last=False)
+    return {"login_user": voce.username, "user_ente": voce.ente, "user_role": voce.ruolo}
+
+
+# ============================================================
+# OPERAZIONI
+# ============================================================
+
+def _puo_leggere(riga: dict, utente: dict) -> bool:
+    """Il proprio risultato; lo staff quelli del proprio ente; gli amministratori tutti."""
+    if riga.get("login_user") == utente["login_user"] or utente["user_role"] in RUOLI_ADMIN:
+        return True
+    ente = riga.get("user_ente")
+    return utente["user_role"] in RUOLI_STAFF and (ente if isinstance(ente, str) else "") == (utente["user_ente"] or "")
+
+
+def _risultato(chiave: str, utente: dict) -> dict:
+    df = leggi_risultati("chiave_consegna = ?", (chiave,))
+    if df.empty:
+        raise ErroreAPI(404, "Risultato non trovato.")
+    riga = df.iloc[0].to_dict()
+    if not _puo_leggere(riga, utente):
+        # come un risultato inesistente: non si rivela quali chiavi esistono
+        raise ErroreAPI(404, "Risultato non trovato.")
+    return riga
+
+
+def gestisci(metodo: str, percorso: str, query: dict, corpo: dict, utente: dict):
+    """
+    Ritorna (stato, contenuto, content_type, nome_file): contenuto dict (JSON),
+    bytes o file temporaneo aperto (inviato a blocchi e poi rimosso).
+    """
+    parti = [p for p in percorso.split("/") if p]
+    if parti[:1] != ["api"]:
+        raise ErroreAPI(404, "Percorso non trovato.")
+    parti = parti[1:]
+
+    if metodo == "GET" and parti == ["banche"]:
+        return 200, {"banche": motore.elenco_banche()}, None, None
+
+    if metodo == "POST" and parti == ["test"]:
+        if not corpo.get("banca") or not corpo.get("argomento"):
+            raise ErroreAPI(400, "Servono 'banca' e 'argomento'.")
+        with misura("api_emetti_test"):
+            test = motore.emetti_test(
+                str(corpo["banca"]), str(corpo["argomento"]), corpo.get("n_domande", 30), utente,
+                seed=str(corpo.get("seed") or ""), testo_strati=str(corpo.get("strati") or ""),
+                una_per_gruppo=bool(corpo.get("una_per_gruppo")),
+            )
+        return 200, test, None, None
+
+    if metodo == "POST" and parti == ["consegne"]:
+        with misura("api_consegna"):
+            esito = motore.consegna(
+                corpo.get("ticket"), corpo.get("risposte"), corpo.get("partecipante") or {},
+                login_user=utente["login_user"],
+            )
+        esito.pop("riga")
+        return (201 if esito["nuova"] else 200), esito, None, None
+
+    if metodo == "GET" and len(parti) == 2 and parti[0] == "risultati":
+        riga = _risultato(parti[1], utente)
+        # NaN (colonne vuote) non è JSON valido
+        return 200, {k: None if v != v else v for k, v in riga.items() if k not in COLONNE_NASCOSTE}, None, None
+
+    if metodo == "GET" and len(parti) == 3 and parti[0] == "risultati" and parti[2] == "pdf":
+        tipo = (query.get("tipo") or ["test"])[0]
+        if tipo not in TIPI_REPORT:
+            raise ErroreAPI(400, f"tipo deve essere uno tra: {', '.join(TIPI_REPORT)}")
+        riga = _risultato(parti[1], utente)
+        if tipo == "badge" and str(riga.get("superato")).strip().lower() not in ("1", "true"):
+            raise ErroreAPI(404, "Badge disponibile solo per i test superati.")
+        with misura("api_pdf"):
+            dati = pdf_report(riga, tipo)
+        return 200, dati, "application/pdf", nome_file_report(riga, tipo)
+
+    if metodo == "GET" and parti == ["export"]:
+        if utente["user_role"] not in RUOLI_ADMIN:
+            raise ErroreAPI(403, "Export riservato agli amministratori.")
+        filtri = {k: (query.get(k) or [None])[0] for k in ("ente", "dal", "al")}
+        indice = (query.get("indice") or ["xlsx"])[0]
+        if indice not in FORMATI_INDICE:
+            raise ErroreAPI(400, f"indice deve essere uno tra: {', '.join(FORMATI_INDICE)}")
+        os.makedirs(CARTELLA_EXPORT, exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix=".zip", dir=CARTELLA_EXPORT)
+        os.close(fd)
+        try:
+            esporta_audit(path, **filtri, formato_indice=indice)
+        except Exception:
+            os.remove(path)
+            raise
+        return 200, open(path, "rb"), "application/zip", nome_file_export(**filtri)
+
+    raise ErroreAPI(404, "Percorso non trovato.")
+
+
+def content_disposition(nome_file: str) -> str:
+    """
+    Header per il download: filename ASCII (gli header HTTP sono Latin-1) più
+    filename* UTF-8 (RFC 5987) con il nome originale per i client che lo leggono.
+    """
+    ascii_ = unicodedata.normalize("NFKD", nome_file).encode("ascii", "ignore").decode("ascii")
+    ascii_ = "".join(c if c.isprintable() and c not in '"\\' else "_" for c in ascii_) or "download"
+    return f"attachment; filename=\"{ascii_}\"; filename*=UTF-8''{quote(nome_file, safe='')}"
+
+
+def _json_default(v):
+    if hasattr(v, "item"):  # scalari numpy
+        return v.item()
+    return str(v)
+
+
+class GestoreAPI(BaseHTTPRequestHandler):
+    server_version = "TestFinaleAPI/1"
+    protocol_version = "HTTP/1.1"
+
+    def _rispondi(self, stato: int, contenuto, content_type: str = None, nome_file: str = None):
+        if hasattr(contenuto, "read"):
+            return self._rispondi_file(stato, contenuto, content_type, nome_file)
+        if isinstance(contenuto, bytes):
+            dati = contenuto
+        else:
+            dati = json.dumps(contenuto, ensure_ascii=False, default=_json_default).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        disposizione = content_disposition(nome_file) if nome_file else None
+        self._risposta_iniziata = True
+        self.send_response(stato)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(dati)))
+        if disposizione:
+            self.send_header("Content-Disposition", disposizione)
+        if stato == 401:
+            self.send_header("WWW-Authenticate", 'Basic realm="test finale"')
+        self.end_headers()
+        self.wfile.write(dati)
+
+    def _rispondi_file(self, stato: int, f, content_type: str, nome_file: str):
+        try:
+            with f:
+                disposizione = content_disposition(nome_file)
+                self._risposta_iniziata = True
+                self.send_response(stato)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+                self.send_header("Content-Disposition", disposizione)
+                self.end_headers()
+                shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+        finally:
+            os.remove(f.name)
+
+    def _errore(self, stato: int, messaggio: str):
+        if self._risposta_iniziata:
+            # header (e forse parte del corpo) già inviati: una seconda risposta
+            # corromperebbe lo stream, si chiude la connessione
+            self.close_connection = True
+            return
+        self._rispondi(stato, {"errore": messaggio})
+
+    def _esegui(self, metodo: str):
+        url = urlparse(self.path)
+        self._risposta_iniziata = False
+        try:
+            if url.path.rstrip("/") == "/api/salute":
+                return self._rispondi(200, {"stato": "ok"})
+            corpo = {}
+            if metodo == "POST":
+                try:
+                    lunghezza = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    lunghezza = -1
+                if lunghezza < 0 or lunghezza > MAX_CORPO_BYTE:
+                    # il corpo non viene letto: la connessione non si può riusare
+                    self.close_connection = True
+                    if lunghezza < 0:
+                        raise ErroreAPI(400, "Content-Length non valido.")
+                    raise ErroreAPI(413, "Richiesta troppo grande.")
+                try:
+                    corpo = json.loads(self.rfile.read(lunghezza) or b"{}")
+                except ValueError:
+                    raise ErroreAPI(400, "Il corpo della richiesta deve essere JSON.")
+                if not isinstance(corpo, dict):
+                    raise ErroreAPI(400, "Il corpo della richiesta deve essere un oggetto JSON.")
+            utente = _utente_da_header(self.headers.get("Authorization"))
+            self._rispondi(*gestisci(metodo, url.path, parse_qs(url.query), corpo, utente))
+        except ErroreAPI as e:
+            self._errore(e.stato, str(e))
+        except (motore.TicketGiaConsegnato, motore.BancaModificata) as e:
+            self._errore(409, str(e))
+        except (motore.RichiestaNonValida, RiproduzioneNonValida, TypeError, ValueError) as e:
+            self._errore(400, str(e))
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            self._errore(500, "Errore interno del server.")
+
+    def do_GET(self):
+        self._esegui("GET")
+
+    def do_POST(self):
+        self._esegui("POST")
+
+    def log_message(self, formato, *args):
+        sys.stderr.write(f"{self.address_string()} - {formato % args}\n")
+
+
+def crea_server(host: str = "127.0.0.1", porta: int = 8502) -> ThreadingHTTPServer:
+    return ThreadingHTTPServer((host, porta), GestoreAPI)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API HTTP JSON del test finale.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8502)
+    args = parser.parse_args(argv)
+
+    server = crea_server(args.host, args.porta)
+    print(f"API test finale in ascolto su http://{args.host}:{args.porta}/api/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,395 @@
+"""Report e badge PDF generati su richiesta dal record di riproduzione di un risultato.
+
+Alla consegna non si genera nessun PDF: nel risultato viene salvato un record
+compatto (versione e impronta della banca, codici domanda, ordine delle
+opzioni, risposte) da cui il report si ricostruisce identico quando qualcuno
+lo scarica, quando l'outbox deve allegarlo o anni dopo per un audit. I PDF
+generati restano in una cache su disco di dimensione limitata.
+
+Esempio (audit):
+    python archivio_report.py --chiave 3f1c... --tipo test --output report.pdf
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import threading
+import zipfile
+from datetime import date
+
+import numpy as np
+
+from banca_dati import CARTELLA_BANCHE, BancaNonValida, carica_banca, list_quiz_files
+from metriche import misura
+from test_finale import materializza_test
+
+# ============================================================
+# COSTANTI
+# ============================================================
+VERSIONE_RECORD = 1
+CARTELLA_CACHE_PDF = "cache_pdf"
+MAX_BYTE_CACHE_PDF = 256 * 1024 * 1024
+QUOTA_DOPO_POTATURA = 0.9   # la cache potata scende al 90% di max_byte
+TIPI_REPORT = ("test", "badge")
+MAX_CARATTERI_COMPONENTE = 80
+# separatori di percorso, caratteri non ammessi su Windows e caratteri di controllo
+_CARATTERI_NON_AMMESSI = re.compile(r'[\x00-\x1f\x7f<>:"/\\|?*]')
+AVVISO_TESTI_CAMBIATI = (
+    "ATTENZIONE: i testi delle domande sono stati modificati nella banca dopo il test; "
+    "il report mostra i testi attuali, non quelli visti dal partecipante."
+)
+
+
+class RiproduzioneNonValida(ValueError):
+    """Il risultato non ha un record di riproduzione utilizzabile con le banche presenti."""
+
+
+# ============================================================
+# RECORD DI RIPRODUZIONE
+# ============================================================
+
+def impronta_domande(banca, righe) -> str:
+    """SHA-256 (abbreviato) dei testi delle domande usate: rileva banche modificate dopo il test."""
+    h = hashlib.sha256()
+    for pos in righe:
+        pos = int(pos)
+        campi = [banca.df.at[pos, "domanda"], *banca.opzioni[pos], int(banca.corretta_idx[pos])]
+        h.update(json.dumps([str(c) for c in campi], ensure_ascii=False).encode("utf-8"))
+    return h.hexdigest()[:32]
+
+
+def record_riproduzione(banca, righe, permutazioni, risposte) -> str:
+    """
+    JSON compatto: codici domanda, ordine delle opzioni (4 cifre per domanda),
+    risposte come posizioni mostrate ('-' = non risposta), versione e impronta della banca.
+    """
+    codici = banca.df["codice"].to_numpy()[np.asarray(righe, dtype=np.int64)]
+    record = {
+        "v": VERSIONE_RECORD,
+        "versione_banca": banca.versione,
+        "impronta": impronta_domande(banca, righe),
+        "codici": [str(c) for c in codici],
+        "permutazioni": "".join(str(int(j)) for ordine in permutazioni for j in ordine),
+        "risposte": "".join("-" if r is None else str(int(r)) for r in risposte),
+    }
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+
+
+def _path_banca(label: str, cartella_banche: str) -> str:
+    percorsi = dict(list_quiz_files(cartella_banche))
+    if label not in percorsi:
+        raise RiproduzioneNonValida(f"Banca domande '{label}' non presente in '{cartella_banche}'.")
+    return percorsi[label]
+
+
+def ricostruisci_test(riga: dict, cartella_banche: str = CARTELLA_BANCHE):
+    """
+    Dal risultato salvato: (banca, righe, permutazioni, risposte, testi_cambiati).
+    testi_cambiati=True se i testi delle domande sono diversi da quelli del giorno del test.
+    """
+    try:
+        record = json.loads(riga.get("riproduzione") or "")
+    except (TypeError, ValueError):
+        raise RiproduzioneNonValida("Il risultato non ha un record di riproduzione (consegna precedente all'archivio).")
+    if record.get("v") != VERSIONE_RECORD:
+        raise RiproduzioneNonValida(f"Versione del record di riproduzione non supportata: {record.get('v')}")
+
+    try:
+        banca = carica_banca(_path_banca(str(riga.get("banca_domande") or ""), cartella_banche))
+    except BancaNonValida as e:
+        raise RiproduzioneNonValida(str(e)) from e
+
+    mancanti = [c for c in record["codici"] if c not in banca.indice_codici]
+    if mancanti:
+        raise RiproduzioneNonValida(f"Domande non più presenti nella banca: {', '.join(mancanti[:10])}")
+    righe = np.array([banca.indice_codici[c] for c in record["codici"]], dtype=np.int32)
+    permutazioni = np.frombuffer(record["permutazioni"].encode("ascii"), dtype=np.uint8).reshape(-1, 4) - ord("0")
+    risposte = [None if r == "-" else int(r) for r in record["risposte"]]
+    testi_cambiati = impronta_domande(banca, righe) != record["impronta"]
+    return banca, righe, permutazioni, risposte, testi_cambiati
+
+
+def componente_nome_file(testo, predefinito: str) -> str:
+    """
+    Parte di un nome file ricavata da un testo libero (nome, corso): niente
+    separatori di percorso, '..' o caratteri non ammessi, spazi come '_'.
+    Usata per i nomi dei report e delle voci degli ZIP.
+    """
+    testo = _CARATTERI_NON_AMMESSI.sub("_", str(testo or ""))
+    testo = re.sub(r"\s+", "_", testo.strip())
+    testo = re.sub(r"\.{2,}", ".", testo).strip(".")
+    return testo[:MAX_CARATTERI_COMPONENTE] or predefinito
+
+
+def nome_file_report(riga: dict, tipo: str) -> str:
+    nome_sanit = componente_nome_file(riga.get("nome_partecipante"), "partecipante")
+    corso_sanit = componente_nome_file(riga.get("corso") or riga.get("argomento"), "test_finale")
+    data_str = componente_nome_file(str(riga.get("data_test") or "").replace("-", ""), "data")
+    suffisso = "test_finale" if tipo == "test" else "badge_test_finale"
+    return f"{data_str}_{corso_sanit}_{nome_sanit}_{suffisso}.pdf"
+
+
+def _data(valore):
+    try:
+        return date.fromisoformat(str(valore))
+    except ValueError:
+        return valore
+
+
+def _dati_badge(riga: dict) -> dict:
+    return {
+        "nome": riga.get("nome_partecipante") or "",
+        "corso": riga.get("corso") or riga.get("argomento") or "",
+        "data_test": _data(riga.get("data_test")),
+        "percentuale": float(riga.get("percentuale") or 0.0),
+    }
+
+
+def testi_cambiati(riga: dict, cartella_banche: str = CARTELLA_BANCHE) -> bool:
+    """True se il report del risultato si ricostruirebbe con testi diversi da quelli del giorno del test."""
+    return ricostruisci_test(riga, cartella_banche)[4]
+
+
+def genera_pdf(riga: dict, tipo: str = "test", cartella_banche: str = CARTELLA_BANCHE) -> bytes:
+    """
+    Genera report ('test') o badge ('badge') di un risultato salvato. Se i testi
+    delle domande sono cambiati dopo il test il report lo dichiara (AVVISO_TESTI_CAMBIATI).
+    """
+    # reportlab si carica solo alla prima generazione, non all'avvio dell'app
+    from report_pdf import build_badge_pdf, build_test_pdf
+
+    percentuale = float(riga.get("percentuale") or 0.0)
+    if tipo == "badge":
+        with misura("build_badge_pdf"):
+            return build_badge_pdf(**_dati_badge(riga))
+    if tipo != "test":
+        raise ValueError(f"Tipo di report non valido: {tipo}")
+
+    banca, righe, permutazioni, risposte, cambiati = ricostruisci_test(riga, cartella_banche)
+    quiz_df, quiz_options, quiz_correct_idx = materializza_test(banca, righe, permutazioni)
+    superato = riga.get("superato")
+    with misura("build_test_pdf"):
+        return build_test_pdf(
+            nome=riga.get("nome_partecipante") or "",
+            corso=riga.get("corso") or "",
+            argomento=riga.get("argomento") or "",
+            data_test=_data(riga.get("data_test")),
+            punteggio=int(riga.get("punteggio") or 0),
+            percentuale=percentuale,
+            superato=superato if isinstance(superato, bool) else str(superato).strip().lower() in ("1", "true"),
+            quiz_df=quiz_df,
+            quiz_options=quiz_options,
+            quiz_correct_idx=quiz_correct_idx,
+            risposte_utente=risposte,
+            avviso=AVVISO_TESTI_CAMBIATI if cambiati else "",
+        )
+
+
+def genera_badge_superati(righe) -> bytes:
+    """Badge dei risultati superati in un unico PDF, una pagina ciascuno (es. una sessione d'aula)."""
+    from report_pdf import build_badges_pdf
+
+    badge = [_dati_badge(r) for r in righe if str(r.get("superato")).strip().lower() in ("1", "true")]
+    with misura("build_badges_pdf"):
+        return build_badges_pdf(badge)
+
+
+# ============================================================
+# CACHE SU DISCO
+# ============================================================
+
+class CacheDiscoPDF:
+    """
+    PDF generati su disco, al massimo max_byte: scarta i meno usati (mtime aggiornato a ogni lettura).
+    La dimensione totale si aggiorna a ogni scrittura; la cartella si scorre solo alla
+    prima scrittura e quando si supera max_byte, e si pota fino a QUOTA_DOPO_POTATURA
+    per non riscorrerla a ogni scrittura successiva. Con più processi il totale di
+    ognuno è una stima, corretta a ogni potatura.
+    """
+
+    def __init__(self, cartella: str = CARTELLA_CACHE_PDF, max_byte: int = MAX_BYTE_CACHE_PDF):
+        self.cartella = cartella
+        self.max_byte = max_byte
+        self._lock = threading.Lock()
+        self._totale = None   # byte in cartella, None finché non è stata scorsa
+
+    def _path(self, chiave: str) -> str:
+        return os.path.join(self.cartella, f"{hashlib.sha256(chiave.encode('utf-8')).hexdigest()}.pdf")
+
+    def get(self, chiave: str):
+        path = self._path(chiave)
+        try:
+            with open(path, "rb") as f:
+                dati = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return dati
+
+    def put(self, chiave: str, dati: bytes) -> None:
+        os.makedirs(self.cartella, exist_ok=True)
+        path = self._path(chiave)
+        try:
+            precedente = os.path.getsize(path)
+        except OSError:
+            precedente = 0
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(dati)
+        os.replace(tmp, path)
+        with self._lock:
+            if self._totale is not None:
+                self._totale += len(dati) - precedente
+            if self._totale is None or self._totale > self.max_byte:
+                self._pota()
+
+    def pota(self) -> None:
+        """Elimina i file meno recenti se la cartella supera max_byte."""
+        with self._lock:
+            self._pota()
+
+    def _scansiona(self):
+        voci = []
+        with os.scandir(self.cartella) as it:
+            for e in it:
+                if e.is_file() and e.name.endswith(".pdf"):
+                    info = e.stat()
+                    voci.append((info.st_mtime_ns, info.st_size, e.path))
+        return voci
+
+    def _pota(self) -> None:
+        voci = self._scansiona()
+        totale = sum(dimensione for _, dimensione, _ in voci)
+        if totale > self.max_byte:
+            obiettivo = self.max_byte * QUOTA_DOPO_POTATURA
+            for _, dimensione, path in sorted(voci):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                totale -= dimensione
+                if totale <= obiettivo:
+                    break
+        self._totale = totale
+
+
+_cache_predefinita = None
+_lock_cache = threading.Lock()
+
+
+def cache_predefinita() -> CacheDiscoPDF:
+    global _cache_predefinita
+    with _lock_cache:
+        if _cache_predefinita is None:
+            _cache_predefinita = CacheDiscoPDF()
+        return _cache_predefinita
+
+
+def pdf_report(riga: dict, tipo: str = "test", cache: CacheDiscoPDF = None,
+               cartella_banche: str = CARTELLA_BANCHE) -> bytes:
+    """PDF del risultato dalla cache su disco, generandolo alla prima richiesta."""
+    cache = cache or cache_predefinita()
+    identita = riga.get("chiave_consegna") or hashlib.sha256(str(riga.get("riproduzione")).encode("utf-8")).hexdigest()
+    chiave = f"{identita}:{tipo}"
+    dati = cache.get(chiave)
+    if dati is None:
+        dati = genera_pdf(riga, tipo, cartella_banche)
+        cache.put(chiave, dati)
+    return dati
+
+
+def risolvi_allegati(riferimenti, righe_per_chiave=None) -> list:
+    """
+    Risolutore per l'outbox: riferimenti [{"chiave_consegna", "tipo"}, ...] o
+    {"tipo": "zip", "chiavi": [...], "nome"} -> [(filename, bytes_data, mime_type), ...].
+    righe_per_chiave(chiave) -> riga del risultato.
+    """
+    if righe_per_chiave is None:
+        from risultati import leggi_risultati
+
+        def righe_per_chiave(chiave):
+            df = leggi_risultati("chiave_consegna = ?", (chiave,))
+            if df.empty:
+                raise RiproduzioneNonValida(f"Nessun risultato con chiave {chiave}")
+            return df.iloc[0].to_dict()
+
+    allegati = []
+    for rif in riferimenti:
+        if rif["tipo"] == "zip":
+            allegati.append((rif["nome"], zip_report([righe_per_chiave(c) for c in rif["chiavi"]]), "application/zip"))
+            continue
+        riga = righe_per_chiave(rif["chiave_consegna"])
+        allegati.append((nome_file_report(riga, rif["tipo"]), pdf_report(riga, rif["tipo"]), "application/pdf"))
+    return allegati
+
+
+def zip_report(righe) -> bytes:
+    """ZIP con report (e badge dei superati) di più risultati e il riepilogo.csv (allegato dei digest)."""
+    buf = io.BytesIO()
+    riepilogo = io.StringIO()
+    colonne = ["nome_partecipante", "email_partecipante", "corso", "argomento", "data_test",
+               "punteggio", "n_domande", "percentuale", "superato", "file"]
+    writer = csv.DictWriter(riepilogo, fieldnames=colonne, extrasaction="ignore")
+    writer.writeheader()
+    nomi = set()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for riga in righe:
+            superato = str(riga.get("superato")).strip().lower() in ("1", "true")
+            file_report = None
+            for tipo in ("test", "badge") if superato else ("test",):
+                nome = nome_file_report(riga, tipo)
+                base, estensione = os.path.splitext(nome)
+                k = 2
+                while nome in nomi:  # omonimi nello stesso corso
+                    nome = f"{base}_{k}{estensione}"
+                    k += 1
+                nomi.add(nome)
+                try:
+                    zf.writestr(nome, pdf_report(riga, tipo))
+                except RiproduzioneNonValida:
+                    continue
+                file_report = file_report or nome
+            writer.writerow({**riga, "superato": "SI" if superato else "NO", "file": file_report or ""})
+        zf.writestr("riepilogo.csv", riepilogo.getvalue().encode("utf-8-sig"))
+    return buf.getvalue()
+
+
+def main(argv=None):
+    from risultati import leggi_risultati
+
+    parser = argparse.ArgumentParser(description="Rigenera report o badge PDF di un risultato salvato (audit).")
+    chi = parser.add_mutually_exclusive_group(required=True)
+    chi.add_argument("--id", type=int, help="id del risultato nell'archivio")
+    chi.add_argument("--chiave", help="chiave_consegna del risultato")
+    parser.add_argument("--tipo", choices=TIPI_REPORT, default="test")
+    parser.add_argument("--output", help="file PDF (default: nome standard del report)")
+    args = parser.parse_args(argv)
+
+    df = leggi_risultati("id = ?", (args.id,)) if args.id is not None else leggi_risultati("chiave_consegna = ?", (args.chiave,))
+    if df.empty:
+        parser.error("Risultato non trovato.")
+    riga = df.iloc[0].to_dict()
+
+    cambiati = False
+    try:
+        if args.tipo == "test":
+            cambiati = testi_cambiati(riga)
+        dati = genera_pdf(riga, args.tipo)
+    except RiproduzioneNonValida as e:
+        parser.error(str(e))
+    if cambiati:
+        print(AVVISO_TESTI_CAMBIATI, file=sys.stderr)
+
+    output = args.output or nome_file_report(riga, args.tipo)
+    with open(output, "wb") as f:
+        f.write(dati)
+    print(f"{output}: {len(dati)} byte", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
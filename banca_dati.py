@@ -0,0 +1,473 @@
+"""Caricamento e compilazione delle banche domande (cartella banche_dati_quiz).
+
+Ogni CSV viene letto e validato una sola volta; la forma compilata resta in
+memoria nel processo ed è condivisa da tutte le sessioni Streamlit. La cache
+viene invalidata solo quando cambiano mtime o dimensione del file.
+
+Alla compilazione la banca viene validata con controlli vettoriali: le righe
+con errori (es. 'corretta' non valida) restano nel DataFrame ma sono escluse
+dagli indici usati per l'estrazione; il rapporto resta nella banca compilata.
+
+Se accanto al CSV c'è la versione compilata (.arrow, scritta da
+compila_banche.py) e corrisponde al CSV attuale, viene mappata in memoria
+invece di rileggere il testo: i processi che la aprono condividono le pagine.
+"""
+import os
+import glob
+import json
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from metriche import misura
+
+# ============================================================
+# COSTANTI
+# ============================================================
+CARTELLA_BANCHE = "banche_dati_quiz"
+REQUIRED_COLS = {"argomento", "codice", "domanda", "opzione_a", "opzione_b", "opzione_c", "opzione_d", "corretta"}
+COLONNE_OPZIONI = ("opzione_a", "opzione_b", "opzione_c", "opzione_d")
+LABELS = ("A", "B", "C", "D")
+ESTENSIONE_COMPILATA = ".arrow"
+FORMATO_COMPILATO = "3"
+_META_COMPILATA = b"banca_dati"
+
+COLONNE_PROBLEMI = ["riga", "codice", "controllo", "gravita", "dettaglio"]
+
+
+class BancaNonValida(ValueError):
+    """Il CSV della banca domande non è leggibile o non ha le colonne richieste."""
+
+
+@dataclass(frozen=True)
+class BancaCompilata:
+    """Forma compilata e immutabile di una banca domande."""
+    path: str
+    versione: tuple                 # firme (mtime_ns, size) di CSV e .arrow
+    df: pd.DataFrame                # righe della banca, indice 0..n-1
+    argomenti: list                 # argomenti ordinati
+    indice_argomenti: dict          # argomento -> np.ndarray posizioni di riga
+    indice_riferimenti: dict        # riferimento normativo -> np.ndarray posizioni di riga
+    indice_codici: dict             # codice -> posizione di riga (prima occorrenza)
+    opzioni: object                 # per riga: tupla (testo_a, testo_b, testo_c, testo_d)
+    corretta_idx: np.ndarray        # per riga: 0..3, -1 se 'corretta' non valida
+    scartate: np.ndarray            # per riga: True se esclusa dall'estrazione (errori di validazione)
+    problemi: pd.DataFrame          # rapporto di validazione, colonne COLONNE_PROBLEMI
+
+    def __len__(self):
+        return len(self.df)
+
+    def righe_argomento(self, argomento) -> np.ndarray:
+        return self.indice_argomenti.get(argomento, np.empty(0, dtype=np.int64))
+
+    def righe_riferimento(self, riferimento) -> np.ndarray:
+        return self.indice_riferimenti.get(riferimento, np.empty(0, dtype=np.int64))
+
+    def df_argomento(self, argomento) -> pd.DataFrame:
+        return self.df.iloc[self.righe_argomento(argomento)]
+
+
+class OpzioniColonnari:
+    """Testi delle opzioni letti su richiesta dalle colonne Arrow (stessa interfaccia della tupla di tuple)."""
+
+    def __init__(self, tabella):
+        self._colonne = [tabella.column(col) for col in COLONNE_OPZIONI]
+
+    def __len__(self):
+        return len(self._colonne[0])
+
+    def __getitem__(self, pos):
+        pos = int(pos)
+        return tuple(col[pos].as_py() for col in self._colonne)
+
+
+# ============================================================
+# FIRMA FILE
+# ============================================================
+
+def firma_file(path: str) -> tuple:
+    """(mtime_ns, size) del file: cambia quando il file viene riscritto."""
+    info = os.stat(path)
+    return (info.st_mtime_ns, info.st_size)
+
+
+def _firma_o_none(path: str):
+    try:
+        return firma_file(path)
+    except OSError:
+        return None
+
+
+def path_compilato(path: str) -> str:
+    """Percorso della versione compilata (.arrow) di una banca."""
+    return os.path.splitext(path)[0] + ESTENSIONE_COMPILATA
+
+
+# ============================================================
+# VALIDAZIONE
+# ============================================================
+
+CONTROLLI = {  # controllo -> (gravità, descrizione); gli errori escludono la riga dall'estrazione
+    "corretta_non_valida": ("errore", "'corretta' deve essere A, B, C o D"),
+    "domanda_vuota": ("errore", "testo della domanda vuoto"),
+    "opzione_corretta_vuota": ("errore", "l'opzione indicata come corretta è vuota"),
+    "opzioni_duplicate": ("errore", "due opzioni hanno lo stesso testo"),
+    "codice_mancante": ("errore", "codice domanda vuoto"),
+    "codice_duplicato": ("errore", "codice già usato da una riga precedente della banca"),
+    "opzione_vuota": ("avviso", "una o più opzioni vuote"),
+}
+
+
+def _codici_normalizzati(df: pd.DataFrame) -> pd.Series:
+    return df["codice"].astype("string").str.strip().fillna("")
+
+
+def controlla_banca(df: pd.DataFrame, corretta_idx: np.ndarray) -> dict:
+    """Controlli vettoriali su una banca già normalizzata: controllo -> maschera bool delle righe."""
+    n = len(df)
+    if n:
+        testi = np.column_stack([df[col].str.strip().str.lower().to_numpy(dtype=object) for col in COLONNE_OPZIONI])
+    else:
+        testi = np.empty((0, 4), dtype=object)
+    vuote = testi == ""
+    valida = corretta_idx >= 0
+    corretta_vuota = np.zeros(n, dtype=bool)
+    corretta_vuota[valida] = vuote[valida, corretta_idx[valida]]
+
+    duplicate = np.zeros(n, dtype=bool)
+    for a in range(4):
+        for b in range(a + 1, 4):
+            duplicate |= (testi[:, a] == testi[:, b]) & ~vuote[:, a]
+
+    domanda = df["domanda"].astype("string").str.strip().fillna("")
+    codici = _codici_normalizzati(df)
+    return {
+        "corretta_non_valida": ~valida,
+        "domanda_vuota": (domanda == "").to_numpy(dtype=bool),
+        "opzione_corretta_vuota": corretta_vuota,
+        "opzioni_duplicate": duplicate,
+        "codice_mancante": (codici == "").to_numpy(dtype=bool),
+        "codice_duplicato": (codici.duplicated() & (codici != "")).to_numpy(dtype=bool),
+        "opzione_vuota": vuote.any(axis=1) & ~corretta_vuota,
+    }
+
+
+def rapporto_validazione(df: pd.DataFrame, maschere: dict):
+    """
+    (scartate, problemi) dalle maschere di controlla_banca: righe con almeno un
+    errore e DataFrame con una riga per problema (riga = numero di riga nel CSV).
+    """
+    n = len(df)
+    codici = _codici_normalizzati(df).to_numpy(dtype=object)
+    scartate = np.zeros(n, dtype=bool)
+    parti = []
+    for controllo, maschera in maschere.items():
+        gravita, descrizione = CONTROLLI[controllo]
+        pos = np.flatnonzero(maschera)
+        if gravita == "errore":
+            scartate[pos] = True
+        if not len(pos):
+            continue
+        dettaglio = descrizione
+        if controllo == "corretta_non_valida":
+            dettaglio = descrizione + ", trovato '" + df["corretta"].to_numpy(dtype=object)[pos].astype(str) + "'"
+        parti.append(pd.DataFrame({
+            "riga": pos + 2,  # intestazione + base 1
+            "codice": codici[pos],
+            "controllo": controllo,
+            "gravita": gravita,
+            "dettaglio": dettaglio,
+        }))
+    if not parti:
+        return scartate, pd.DataFrame(columns=COLONNE_PROBLEMI)
+    problemi = pd.concat(parti, ignore_index=True).sort_values(["riga", "controllo"], kind="stable")
+    return scartate, problemi.reset_index(drop=True)
+
+
+def codici_condivisi(banche) -> pd.DataFrame:
+    """Codici presenti in più banche: banche = [(label, BancaCompilata), ...] -> DataFrame codice, banche."""
+    parti = [pd.DataFrame({"codice": b.df["codice"].astype(str).to_numpy(), "banca": label}) for label, b in banche]
+    if not parti:
+        return pd.DataFrame(columns=["codice", "banche"])
+    tutti = pd.concat(parti, ignore_index=True).drop_duplicates()
+    condivisi = tutti[tutti["codice"].duplicated(keep=False)]
+    return (
+        condivisi.groupby("codice", sort=True)["banca"]
+        .agg(lambda s: ", ".join(sorted(s)))
+        .rename("banche")
+        .reset_index()
+    )
+
+
+# ============================================================
+# COMPILAZIONE
+# ============================================================
+
+def compila_banca(df: pd.DataFrame, path: str = "", versione: tuple = ()) -> BancaCompilata:
+    """Valida un DataFrame nel formato banca e ne costruisce la forma compilata."""
+    if not REQUIRED_COLS.issubset(set(df.columns)):
+        raise BancaNonValida(f"Il CSV deve contenere almeno queste colonne: {', '.join(sorted(REQUIRED_COLS))}")
+
+    df = df.reset_index(drop=True)
+    df["corretta"] = df["corretta"].astype("string").str.strip().str.upper().fillna("")
+    for col in COLONNE_OPZIONI:
+        df[col] = df[col].fillna("").astype(str)
+    if "riferimento" not in df.columns:
+        df["riferimento"] = ""
+    df["riferimento"] = df["riferimento"].fillna("").astype(str)
+
+    mappa = {lab: i for i, lab in enumerate(LABELS)}
+    corretta_idx = df["corretta"].map(mappa).fillna(-1).astype(np.int8).to_numpy()
+
+    opzioni = tuple(zip(*(df[col].tolist() for col in COLONNE_OPZIONI)))
+    maschere = controlla_banca(df, corretta_idx)
+    scartate, problemi = rapporto_validazione(df, maschere)
+
+    # le righe scartate non entrano negli indici usati per l'estrazione; groupby().indices
+    # dà posizioni nella serie filtrata, riportate a righe di df tramite il suo indice
+    argomenti_validi = df["argomento"][~scartate].dropna()
+    indice_argomenti = {
+        arg: argomenti_validi.index.to_numpy(dtype=np.int64)[pos]
+        for arg, pos in argomenti_validi.groupby(argomenti_validi, sort=True).indices.items()
+    }
+    argomenti = sorted(indice_argomenti)
+
+    riferimenti = df["riferimento"][~scartate].str.strip()
+    riferimenti = riferimenti[riferimenti != ""]  # come sopra: posizioni riportate tramite riferimenti.index
+    indice_riferimenti = {
+        rif: riferimenti.index.to_numpy(dtype=np.int64)[pos]
+        for rif, pos in riferimenti.groupby(riferimenti, sort=True).indices.items()
+    }
+
+    return BancaCompilata(
+        path=path,
+        versione=versione,
+        df=df,
+        argomenti=argomenti,
+        indice_argomenti=indice_argomenti,
+        indice_riferimenti=indice_riferimenti,
+        indice_codici=_indice_codici(df),
+        opzioni=opzioni,
+        corretta_idx=corretta_idx,
+        scartate=scartate,
+        problemi=problemi,
+    )
+
+
+def _indice_codici(df: pd.DataFrame) -> dict:
+    codici = df["codice"].astype(str)
+    primi = ~codici.duplicated().to_numpy()
+    return dict(zip(codici[primi].tolist(), np.flatnonzero(primi).tolist()))
+
+
+# ============================================================
+# FORMATO COMPILATO (Arrow IPC, mappato in memoria)
+# ============================================================
+
+def _indice_in_colonna(indice: dict, n: int):
+    """dict chiave -> posizioni  =>  (colonna int64 lunga n, [[chiave, inizio, fine], ...])."""
+    colonna = np.full(n, -1, dtype=np.int64)
+    intervalli = []
+    inizio = 0
+    for chiave, pos in indice.items():
+        colonna[inizio:inizio + len(pos)] = pos
+        intervalli.append([chiave.item() if isinstance(chiave, np.generic) else chiave, inizio, inizio + len(pos)])
+        inizio += len(pos)
+    return colonna, intervalli
+
+
+def salva_banca_compilata(banca: BancaCompilata, path_out: str, versione_sorgente=None) -> None:
+    """
+    Scrive la banca compilata in formato Arrow IPC non compresso (un solo blocco),
+    con indici e chiavi precalcolati, così la lettura è una mappatura senza parsing.
+    Scrittura atomica: i processi che hanno già mappato il file precedente non ne risentono.
+    """
+    df = banca.df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            # colonne miste (numeri e testo) non sono rappresentabili in Arrow
+            df[col] = df[col].map(lambda v: v if pd.isna(v) else str(v))
+    n = len(df)
+    ordine_arg, intervalli_arg = _indice_in_colonna(banca.indice_argomenti, n)
+    ordine_rif, intervalli_rif = _indice_in_colonna(banca.indice_riferimenti, n)
+
+    tabella = pa.Table.from_pandas(df, preserve_index=False)
+    tabella = tabella.append_column("_corretta_idx", pa.array(banca.corretta_idx, type=pa.int8()))
+    tabella = tabella.append_column("_ordine_argomenti", pa.array(ordine_arg))
+    tabella = tabella.append_column("_ordine_riferimenti", pa.array(ordine_rif))
+    meta = {
+        "formato": FORMATO_COMPILATO,
+        "sorgente": list(versione_sorgente) if versione_sorgente else None,
+        "argomenti": intervalli_arg,
+        "riferimenti": intervalli_rif,
+        # posizioni per controllo: il rapporto si ricostruisce alla lettura
+        "controlli": {
+            controllo: (banca.problemi.loc[banca.problemi["controllo"] == controllo, "riga"] - 2).tolist()
+            for controllo in CONTROLLI
+        },
+    }
+    tabella = tabella.replace_schema_metadata({
+        **(tabella.schema.metadata or {}),
+        _META_COMPILATA: json.dumps(meta, ensure_ascii=False).encode("utf-8"),
+    })
+
+    tmp = f"{path_out}.{os.getpid()}.tmp"
+    try:
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, tabella.schema) as writer:
+            writer.write_table(tabella.combine_chunks(), max_chunksize=max(n, 1))
+        os.replace(tmp, path_out)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _colonna_numpy(tabella, nome: str) -> np.ndarray:
+    colonna = tabella.column(nome)
+    if colonna.num_chunks == 1:
+        return colonna.chunk(0).to_numpy(zero_copy_only=True)
+    return colonna.to_numpy()
+
+
+def compilata_aggiornata(path_arrow: str, firma_csv=None) -> bool:
+    """True se il .arrow è leggibile e compilato dal CSV con questa firma (None = CSV assente)."""
+    try:
+        with pa.memory_map(path_arrow, "r") as src:
+            schema = pa.ipc.open_file(src).schema
+        meta = json.loads((schema.metadata or {})[_META_COMPILATA])
+    except Exception:
+        return False
+    return meta.get("formato") == FORMATO_COMPILATO and (firma_csv is None or meta.get("sorgente") == list(firma_csv))
+
+
+def leggi_banca_compilata(path_arrow: str, versione: tuple = (), path: str = "") -> BancaCompilata:
+    """Mappa in memoria un file .arrow scritto da salva_banca_compilata."""
+    try:
+        tabella = pa.ipc.open_file(pa.memory_map(path_arrow, "r")).read_all()
+        meta = json.loads(tabella.schema.metadata[_META_COMPILATA])
+    except Exception as e:
+        raise BancaNonValida(f"Errore nella lettura della banca compilata '{path_arrow}': {e}") from e
+    if meta.get("formato") != FORMATO_COMPILATO:
+        raise BancaNonValida(f"Formato della banca compilata '{path_arrow}' non supportato: ricompilare con compila_banche.py")
+
+    ordine_arg = _colonna_numpy(tabella, "_ordine_argomenti")
+    ordine_rif = _colonna_numpy(tabella, "_ordine_riferimenti")
+    indice_argomenti = {arg: ordine_arg[i:j] for arg, i, j in meta["argomenti"]}
+    indice_riferimenti = {rif: ordine_rif[i:j] for rif, i, j in meta["riferimenti"]}
+    corretta_idx = _colonna_numpy(tabella, "_corretta_idx")
+    dati = tabella.drop_columns(["_corretta_idx", "_ordine_argomenti", "_ordine_riferimenti"])
+    df = dati.to_pandas()
+    maschere = {}
+    for controllo, pos in meta["controlli"].items():
+        maschere[controllo] = np.zeros(len(df), dtype=bool)
+        maschere[controllo][np.asarray(pos, dtype=np.int64)] = True
+    scartate, problemi = rapporto_validazione(df, maschere)
+
+    return BancaCompilata(
+        path=path or path_arrow,
+        versione=versione,
+        df=df,
+        argomenti=sorted(indice_argomenti),
+        indice_argomenti=indice_argomenti,
+        indice_riferimenti=indice_riferimenti,
+        indice_codici=_indice_codici(df),
+        opzioni=OpzioniColonnari(dati),
+        corretta_idx=corretta_idx,
+        scartate=scartate,
+        problemi=problemi,
+    )
+
+
+# ============================================================
+# CACHE DI PROCESSO
+# ============================================================
+_lock = threading.Lock()
+_cache_banche = {}   # path -> BancaCompilata
+_cache_cartelle = {}  # cartella -> (firma, lista file)
+
+
+def _sorgenti(path: str) -> tuple:
+    """(path CSV, path .arrow) della banca, qualunque dei due sia stato indicato."""
+    base = os.path.splitext(path)[0]
+    return base + ".csv", base + ESTENSIONE_COMPILATA
+
+
+def carica_banca(path: str) -> BancaCompilata:
+    """
+    Ritorna la banca compilata. Usa il file .arrow se presente e compilato dal CSV
+    attuale, altrimenti rilegge il CSV; entrambi solo se mtime/size sono cambiati.
+    """
+    path = os.path.abspath(path)
+    path_csv, path_arrow = _sorgenti(path)
+    versione = (_firma_o_none(path_csv), _firma_o_none(path_arrow))
+    if versione == (None, None):
+        raise BancaNonValida(f"Errore nella lettura del CSV '{path}': file non trovato")
+    # una banca è identificata dal suo CSV (o dal .arrow se distribuita solo compilata)
+    path = path_csv if versione[0] is not None else path_arrow
+
+    banca = _cache_banche.get(path)
+    if banca is not None and banca.versione == versione:
+        return banca
+
+    with _lock:
+        banca = _cache_banche.get(path)
+        if banca is not None and banca.versione == versione:
+            return banca
+        firma_csv, firma_arrow = versione
+        if firma_arrow is not None and compilata_aggiornata(path_arrow, firma_csv):
+            with misura("lettura_banca_compilata"):
+                banca = leggi_banca_compilata(path_arrow, versione, path=path)
+        elif firma_csv is None:
+            raise BancaNonValida(f"Errore nella lettura della banca compilata '{path_arrow}': ricompilare con compila_banche.py")
+        else:
+            with misura("lettura_banca_csv"):
+                try:
+                    df = pd.read_csv(path_csv)
+                except Exception as e:
+                    raise BancaNonValida(f"Errore nella lettura del CSV '{path_csv}': {e}") from e
+                banca = compila_banca(df, path=path, versione=versione)
+        _cache_banche[path] = banca
+        return banca
+
+
+def list_quiz_files(base_folder: str = CARTELLA_BANCHE):
+    """Ritorna lista di (label, path) per tutte le banche nella cartella indicata.
+
+    Una banca è un CSV, un .arrow compilato o entrambi (il path è il CSV se
+    esiste: carica_banca userà comunque il .arrow se aggiornato).
+    Il risultato è ricalcolato solo quando cambia l'mtime della cartella
+    (aggiunta, rimozione o rinomina di un file).
+    """
+    try:
+        firma = os.stat(base_folder).st_mtime_ns
+    except OSError:
+        return []
+
+    cached = _cache_cartelle.get(base_folder)
+    if cached is not None and cached[0] == firma:
+        return list(cached[1])
+
+    per_label = {}
+    for estensione in (ESTENSIONE_COMPILATA, ".csv"):
+        for f in glob.glob(os.path.join(base_folder, f"*{estensione}")):
+            label = os.path.splitext(os.path.basename(f))[0]  # nome file senza estensione
+            per_label[label] = f
+    quiz_files = sorted(per_label.items())
+
+    with _lock:
+        _cache_cartelle[base_folder] = (firma, tuple(quiz_files))
+        # scarta le banche di file non più presenti
+        presenti = {os.path.abspath(f) for _, f in quiz_files}
+        cartella_abs = os.path.abspath(base_folder)
+        for p in list(_cache_banche):
+            if os.path.dirname(p) == cartella_abs and p not in presenti:
+                del _cache_banche[p]
+    return quiz_files
+
+
+def svuota_cache():
+    with _lock:
+        _cache_banche.clear()
+        _cache_cartelle.clear()
@@ -0,0 +1,418 @@
+"""Benchmark riproducibile dell'app: esegue main.py senza browser (Streamlit AppTest).
+
+Per ogni dimensione genera una banca sintetica nel formato di banche_dati_quiz,
+simula login, "Prepara test finale", risposta a tutte le domande e correzione,
+e misura i tempi di ogni passo, le fasi registrate da metriche.py, la memoria
+per sessione e il throughput delle consegne; a parte, tempo e dimensione dei
+PDF (report per test di 10-50 domande e badge). Il report è un JSON.
+
+Esempio:
+    python benchmark.py --dimensioni 1000 10000 100000 --output bench_report.json
+    python benchmark.py --baseline bench_report.json --tolleranza 0.25   # exit 1 se regressioni
+    python benchmark.py --dimensioni 1000 --budget-avvio                 # exit 1 se l'avvio supera il budget
+    python benchmark.py --solo-pdf --output bench_pdf.json               # solo report e badge PDF
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+CARTELLA_APP = os.path.dirname(os.path.abspath(__file__))
+UTENTE = ("bench", "bench-pwd", "Discente", "Benchmark")
+
+# metriche confrontate con --baseline (minore è meglio)
+METRICHE_CONFRONTATE = ("login_s", "prepara_s", "risposta_rerun_s", "correzione_s", "memoria_sessione_kb", "ricerca_ms")
+METRICHE_AVVIO_CONFRONTATE = ("import_streamlit_s", "primo_rerun_s", "pagina_login_ms")
+METRICHE_PDF_CONFRONTATE = ("report_10_ms", "report_30_ms", "report_50_ms", "badge_ms")
+
+# budget dell'avvio a freddo (processo nuovo, pagina di login): --budget-avvio
+BUDGET_AVVIO = {"primo_rerun_s": 1.0, "pagina_login_ms": 150.0}
+# moduli che la pagina di login non deve importare (caricati dopo il login o alla correzione)
+MODULI_DIFFERITI = (
+    "pandas", "pyarrow", "reportlab", "smtplib", "email.mime",
+    "banca_dati", "risultati", "outbox_email", "report_pdf", "archivio_report",
+)
+
+
+def genera_banca(n: int, path: str, n_argomenti: int = 10, seed: int = 0) -> None:
+    """Scrive una banca sintetica di n domande nel formato di banche_dati_quiz."""
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    idx = np.arange(n)
+    parole = np.array("sicurezza lavoro rischio datore preposto dirigente dispositivo protezione "
+                      "emergenza formazione valutazione documento sorveglianza sanitaria".split())
+
+    def frasi(k):
+        scelte = parole[rng.integers(0, len(parole), size=(n, k))]
+        return [" ".join(r) for r in scelte]
+
+    df = pd.DataFrame({
+        "argomento": [f"Modulo {i % n_argomenti + 1:02d}" for i in idx],
+        "codice": [f"SYN_{i:06d}" for i in idx],
+        "domanda": [f"{t}?" for t in frasi(12)],
+        "opzione_a": frasi(6),
+        "opzione_b": frasi(6),
+        "opzione_c": frasi(6),
+        "opzione_d": frasi(6),
+        "corretta": np.array(list("ABCD"))[rng.integers(0, 4, size=n)],
+        "riferimento": [f"Art. {i % 300 + 1} D.Lgs. 81/08" for i in idx],
+    })
+    df.to_csv(path, index=False)
+
+
+def _prepara_cartella(n: int) -> str:
+    import pandas as pd
+
+    cartella = tempfile.mkdtemp(prefix=f"bench_{n}_")
+    os.makedirs(os.path.join(cartella, "banche_dati_quiz"))
+    genera_banca(n, os.path.join(cartella, "banche_dati_quiz", f"SYN_{n}.csv"))
+    pd.DataFrame([dict(zip(("username", "password", "ruolo", "ente"), UTENTE))]).to_csv(
+        os.path.join(cartella, "utenti_quiz.csv"), index=False
+    )
+    return cartella
+
+
+def _cronometra(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+def esegui_sessione(n_domande: int, seed: str, rispondi_tutte: bool = True) -> dict:
+    """Una sessione studente completa su AppTest; ritorna i tempi dei passi."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(os.path.join(CARTELLA_APP, "main.py"), default_timeout=300)
+    tempi = {"primo_rerun_s": _cronometra(at.run)}
+
+    at.sidebar.text_input(key="login_user").input(UTENTE[0])
+    at.sidebar.text_input(key="login_pwd").input(UTENTE[1])
+    next(b for b in at.sidebar.button if b.label == "Login").click()
+    tempi["login_s"] = _cronometra(at.run)
+
+    next(n for n in at.sidebar.number_input if n.label.startswith("Numero domande")).set_value(n_domande)
+    next(t for t in at.sidebar.text_input if t.label.startswith("Seed casuale")).input(seed)
+    tempi["impostazioni_s"] = _cronometra(at.run)
+
+    next(b for b in at.button if "Prepara" in b.label).click()
+    tempi["prepara_s"] = _cronometra(at.run)
+    tempi["n_domande"] = len(at.radio)
+
+    if rispondi_tutte:
+        rng = random.Random(seed)
+        for r in at.radio:
+            r.set_value(rng.randrange(len(r.options)))
+    # con il form le risposte non causano rerun: si misura un rerun qualsiasi a pagina piena
+    tempi["risposta_rerun_s"] = _cronometra(at.run)
+
+    next(b for b in at.button if "Correggi" in b.label).click()
+    tempi["correzione_s"] = _cronometra(at.run)
+    if at.exception:
+        raise RuntimeError(f"Eccezione nell'app: {at.exception[0].message}")
+    tempi["esito"] = [m.value for m in at.metric]
+
+    stato = at.session_state
+    tempi["stato_sessione_bytes"] = int(stato["quiz_righe"].nbytes + stato["quiz_perm"].nbytes)
+    return tempi
+
+
+def misura_memoria_sessione(n_domande: int) -> float:
+    """KB allocati (tracemalloc) da una sessione aggiuntiva a banca già in cache."""
+    tracemalloc.start()
+    prima = tracemalloc.take_snapshot()
+    esegui_sessione(n_domande, seed="memoria")
+    dopo = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = sum(s.size_diff for s in dopo.compare_to(prima, "filename"))
+    return round(diff / 1024, 1)
+
+
+def misura_throughput_consegne(cartella: str, n: int, n_domande: int) -> dict:
+    """Consegne/secondo: correzione vettoriale in blocco e salvataggio nell'archivio risultati."""
+    import pandas as pd
+
+    from banca_dati import carica_banca
+    from correzione import correggi_consegne
+    from risultati import connessione, salva_risultati
+
+    banca = carica_banca(os.path.join(cartella, "banche_dati_quiz", f"SYN_{n}.csv"))
+    argomento = banca.argomenti[0]
+    rng = random.Random(1)
+    consegne = pd.DataFrame({
+        "nome": [f"P{i}" for i in range(1000)],
+        "seed": [f"s{i}" for i in range(1000)],
+        "risposte": ["".join(rng.choice("ABCD") for _ in range(n_domande)) for _ in range(1000)],
+    })
+    t0 = time.perf_counter()
+    df = correggi_consegne(banca, argomento, n_domande, consegne)
+    t_correzione = time.perf_counter() - t0
+
+    conn = connessione(os.path.join(cartella, "risultati_test_finale.sqlite3"))
+    righe = df.to_dict(orient="records")
+    t0 = time.perf_counter()
+    for r in righe[:200]:
+        salva_risultati([r], conn=conn)
+    t_singole = time.perf_counter() - t0
+    return {
+        "correzione_blocco_consegne_s": round(len(consegne) / t_correzione, 1),
+        "salvataggio_singolo_righe_s": round(200 / t_singole, 1),
+    }
+
+
+def misura_ricerca(ripetizioni: int = 5) -> dict:
+    """Costruzione dell'indice full-text della banca e tempo mediano di alcune query (cartella corrente)."""
+    import ricerca_domande
+
+    t0 = time.perf_counter()
+    ricerca_domande.indici_cartella("banche_dati_quiz")
+    t_indice = time.perf_counter() - t0
+    tempi = []
+    for query in ("sicurezza lavoro", "dispositivo protezione emergenza", "sorveglianza sanit", "art 18"):
+        for _ in range(ripetizioni):
+            t0 = time.perf_counter()
+            ricerca_domande.cerca(query, "banche_dati_quiz")
+            tempi.append(time.perf_counter() - t0)
+    return {"indice_ricerca_s": round(t_indice, 3), "ricerca_ms": round(float(np.median(tempi)) * 1000, 2)}
+
+
+def misura_pdf(domande=(10, 30, 50), ripetizioni: int = 20) -> dict:
+    """
+    Micro-benchmark dei PDF su una banca sintetica: tempo mediano e dimensione
+    del report per test di 10-50 domande (anche a cache di impaginazione vuote)
+    e del badge, da solo e in un unico PDF per 30 partecipanti.
+    """
+    from datetime import date
+
+    import report_pdf
+    from banca_dati import carica_banca
+    from test_finale import estrai_variante, materializza_test
+
+    def mediana_ms(fn):
+        tempi = []
+        for _ in range(ripetizioni):
+            t0 = time.perf_counter()
+            fn()
+            tempi.append(time.perf_counter() - t0)
+        return round(float(np.median(tempi)) * 1000, 2)
+
+    cartella = tempfile.mkdtemp(prefix="bench_pdf_")
+    try:
+        genera_banca(max(domande) * 4, os.path.join(cartella, "SYN.csv"))
+        banca = carica_banca(os.path.join(cartella, "SYN.csv"))
+        rng = random.Random(0)
+        risultato = {}
+        for n in domande:
+            righe, permutazioni = estrai_variante(np.arange(len(banca)), n, f"bench-pdf-{n}")
+            quiz_df, quiz_options, quiz_correct_idx = materializza_test(banca, righe, permutazioni)
+            argomenti = dict(
+                nome="Mario Rossi", corso="Formazione generale 4h", argomento="", data_test=date(2025, 1, 1),
+                punteggio=n // 2, percentuale=50.0, superato=False, quiz_df=quiz_df, quiz_options=quiz_options,
+                quiz_correct_idx=quiz_correct_idx, risposte_utente=[rng.choice((0, 1, 2, 3, None)) for _ in range(n)],
+            )
+            if hasattr(report_pdf, "righe_a_capo"):
+                for funzione in (report_pdf.righe_a_capo, report_pdf.larghezza_testo):
+                    funzione.cache_clear()
+            t0 = time.perf_counter()
+            report_pdf.build_test_pdf(**argomenti)
+            risultato[f"report_{n}_freddo_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            risultato[f"report_{n}_ms"] = mediana_ms(lambda: report_pdf.build_test_pdf(**argomenti))
+            risultato[f"report_{n}_kb"] = round(len(report_pdf.build_test_pdf(**argomenti)) / 1024, 1)
+
+        badge = {"nome": "Mario Rossi", "corso": "Formazione generale 4h", "data_test": date(2025, 1, 1),
+                 "percentuale": 90.0}
+        risultato["badge_ms"] = mediana_ms(lambda: report_pdf.build_badge_pdf(**badge))
+        risultato["badge_kb"] = round(len(report_pdf.build_badge_pdf(**badge)) / 1024, 1)
+        if hasattr(report_pdf, "build_badges_pdf"):
+            lotto = [{**badge, "nome": f"Partecipante {i}"} for i in range(30)]
+            risultato["badge_30_in_un_pdf_ms"] = mediana_ms(lambda: report_pdf.build_badges_pdf(lotto))
+            risultato["badge_30_in_un_pdf_kb"] = round(len(report_pdf.build_badges_pdf(lotto)) / 1024, 1)
+        return risultato
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+def benchmark_dimensione(n: int, n_domande: int, ripetizioni: int) -> dict:
+    import metriche
+
+    cartella = _prepara_cartella(n)
+    cwd = os.getcwd()
+    os.chdir(cartella)
+    try:
+        import streamlit as st
+        from banca_dati import svuota_cache
+        from ricerca_domande import svuota_cache as svuota_indici_ricerca
+        # risorse legate alla cartella di lavoro precedente (outbox, cache consegne)
+        st.cache_resource.clear()
+        st.cache_data.clear()
+        svuota_cache()
+        svuota_indici_ricerca()
+        metriche.azzera()
+
+        sessioni = [esegui_sessione(n_domande, seed=f"bench-{i}") for i in range(ripetizioni)]
+        risultato = {
+            "dimensione_banca": n,
+            "n_domande": sessioni[0]["n_domande"],
+            "ripetizioni": ripetizioni,
+        }
+        for chiave in ("primo_rerun_s", "login_s", "impostazioni_s", "prepara_s", "risposta_rerun_s", "correzione_s"):
+            valori = [s[chiave] for s in sessioni]
+            risultato[chiave] = round(float(np.median(valori)), 4)
+        risultato["stato_sessione_bytes"] = sessioni[0]["stato_sessione_bytes"]
+        risultato["memoria_sessione_kb"] = misura_memoria_sessione(n_domande)
+        risultato.update(misura_throughput_consegne(cartella, n, n_domande))
+        risultato.update(misura_ricerca())
+        risultato["fasi"] = metriche.riepilogo()
+        return risultato
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(cartella, ignore_errors=True)
+
+
+def _misura_avvio_qui() -> dict:
+    """
+    Eseguita nel processo figlio: import di Streamlit e primo rerun della pagina di login.
+    Questo file importa pandas solo dentro le funzioni, così sys.modules riflette i soli import dell'app.
+    """
+    import metriche
+
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    import_s = time.perf_counter() - t0
+
+    at = AppTest.from_file(os.path.join(CARTELLA_APP, "main.py"), default_timeout=300)
+    primo_rerun_s = _cronometra(at.run)
+    if at.exception:
+        raise RuntimeError(f"Eccezione nell'app: {at.exception[0].message}")
+    fasi = {r["fase"]: r for r in metriche.riepilogo()}
+    return {
+        "import_streamlit_s": round(import_s, 4),
+        "primo_rerun_s": round(primo_rerun_s, 4),
+        "pagina_login_ms": fasi.get("rerun_pagina_login", {}).get("max_ms", 0.0),
+        "moduli_caricati": [m for m in MODULI_DIFFERITI if m in sys.modules],
+    }
+
+
+def misura_avvio() -> dict:
+    """Avvio a freddo in un processo nuovo (i moduli già importati qui falserebbero la misura)."""
+    cartella = _prepara_cartella(10)
+    try:
+        esito = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--avvio-figlio"],
+            cwd=cartella, capture_output=True, text=True, check=True,
+        )
+    finally:
+        shutil.rmtree(cartella, ignore_errors=True)
+    return json.loads(esito.stdout.strip().splitlines()[-1])
+
+
+def violazioni_budget_avvio(avvio: dict) -> list:
+    violazioni = [
+        f"avvio: {m} {avvio[m]} > budget {limite}"
+        for m, limite in BUDGET_AVVIO.items() if avvio.get(m, 0) > limite
+    ]
+    if avvio.get("moduli_caricati"):
+        violazioni.append(f"avvio: moduli importati prima del login: {', '.join(avvio['moduli_caricati'])}")
+    return violazioni
+
+
+def confronta(report: dict, baseline: dict, tolleranza: float) -> list:
+    """Regressioni oltre la tolleranza relativa rispetto al report di riferimento."""
+    regressioni = []
+    avvio, avvio_base = report.get("avvio", {}), baseline.get("avvio", {})
+    for m in METRICHE_AVVIO_CONFRONTATE:
+        if avvio_base.get(m, 0) > 0 and m in avvio and avvio[m] > avvio_base[m] * (1 + tolleranza):
+            regressioni.append(f"avvio: {m} {avvio_base[m]} -> {avvio[m]}")
+    pdf, pdf_base = report.get("pdf", {}), baseline.get("pdf", {})
+    for m in METRICHE_PDF_CONFRONTATE:
+        if pdf_base.get(m, 0) > 0 and m in pdf and pdf[m] > pdf_base[m] * (1 + tolleranza):
+            regressioni.append(f"pdf: {m} {pdf_base[m]} -> {pdf[m]}")
+    base = {r["dimensione_banca"]: r for r in baseline.get("risultati", [])}
+    for r in report.get("risultati", []):
+        b = base.get(r["dimensione_banca"])
+        if not b:
+            continue
+        for m in METRICHE_CONFRONTATE:
+            if m in b and b[m] > 0 and r[m] > b[m] * (1 + tolleranza):
+                regressioni.append(f"banca {r['dimensione_banca']}: {m} {b[m]} -> {r[m]}")
+    return regressioni
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark headless di main.py con banche sintetiche.")
+    parser.add_argument("--dimensioni", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--n-domande", type=int, default=30)
+    parser.add_argument("--ripetizioni", type=int, default=3)
+    parser.add_argument("--output", default="bench_report.json")
+    parser.add_argument("--baseline", help="report JSON precedente da confrontare")
+    parser.add_argument("--tolleranza", type=float, default=0.25, help="regressione relativa ammessa (0.25 = +25%%)")
+    parser.add_argument("--budget-avvio", action="store_true",
+                        help="exit 1 se l'avvio a freddo supera BUDGET_AVVIO o importa moduli differiti")
+    parser.add_argument("--solo-pdf", action="store_true", help="solo il micro-benchmark di report e badge PDF")
+    parser.add_argument("--avvio-figlio", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, CARTELLA_APP)
+    if args.avvio_figlio:
+        print(json.dumps(_misura_avvio_qui()))
+        return 0
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "pdf": misura_pdf(),
+    }
+    if not args.solo_pdf:
+        report["avvio"] = misura_avvio()
+        report["risultati"] = [benchmark_dimensione(n, args.n_domande, args.ripetizioni) for n in args.dimensioni]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    pdf = report["pdf"]
+    print(
+        "pdf: " + ", ".join(f"report {n} domande {pdf[f'report_{n}_ms']:.1f} ms / {pdf[f'report_{n}_kb']} KB"
+                            for n in (10, 30, 50))
+        + f", badge {pdf['badge_ms']:.1f} ms / {pdf['badge_kb']} KB",
+        file=sys.stderr,
+    )
+    avvio = report.get("avvio", {})
+    if avvio:
+        print(
+            f"avvio: import streamlit {avvio['import_streamlit_s']*1000:.0f} ms, primo rerun "
+            f"{avvio['primo_rerun_s']*1000:.0f} ms, pagina di login {avvio['pagina_login_ms']:.1f} ms",
+            file=sys.stderr,
+        )
+    for r in report.get("risultati", []):
+        print(
+            f"banca {r['dimensione_banca']:>7}: prepara {r['prepara_s']*1000:.0f} ms, "
+            f"rerun {r['risposta_rerun_s']*1000:.0f} ms, correzione {r['correzione_s']*1000:.0f} ms, "
+            f"sessione {r['memoria_sessione_kb']} KB, ricerca {r['ricerca_ms']:.1f} ms",
+            file=sys.stderr,
+        )
+
+    problemi = []
+    if args.budget_avvio and avvio:
+        problemi += violazioni_budget_avvio(avvio)
+    if baseline:
+        problemi += [f"REGRESSIONE {riga}" for riga in confronta(report, baseline, args.tolleranza)]
+    for riga in problemi:
+        print(riga, file=sys.stderr)
+    return 1 if problemi else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
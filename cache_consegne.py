@@ -0,0 +1,79 @@
+"""Cache delle consegne già corrette, condivisa tra le sessioni del processo.
+
+Una consegna è identificata da un hash di utente, seed, codici domanda,
+ordine delle opzioni, risposte e dati del partecipante: ripremere "Correggi"
+o i rerun dei download riusano esito e PDF già generati.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import date
+
+MAX_CONSEGNE = 256
+
+
+def chiave_consegna(login_user, seed, codici, permutazioni, risposte, partecipante: dict) -> str:
+    """Hash SHA-256 stabile della consegna."""
+    payload = {
+        "utente": login_user or "",
+        "seed": seed or "",
+        "codici": [str(c) for c in codici],
+        "permutazioni": [[int(x) for x in ordine] for ordine in permutazioni],
+        "risposte": [None if r is None else int(r) for r in risposte],
+        "partecipante": {
+            k: v.isoformat() if isinstance(v, date) else str(v or "")
+            for k, v in sorted(partecipante.items())
+        },
+    }
+    testo = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(testo.encode("utf-8")).hexdigest()
+
+
+class CacheLRU:
+    """Dizionario thread-safe con al massimo max_voci elementi (scarta i meno recenti)."""
+
+    def __init__(self, max_voci: int = MAX_CONSEGNE):
+        self.max_voci = max_voci
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_calcolo = {}  # chiave -> Lock, per non calcolare due volte la stessa voce
+
+    def get(self, chiave):
+        with self._lock:
+            valore = self._voci.get(chiave)
+            if valore is not None:
+                self._voci.move_to_end(chiave)
+            return valore
+
+    def put(self, chiave, valore):
+        with self._lock:
+            self._voci[chiave] = valore
+            self._voci.move_to_end(chiave)
+            while len(self._voci) > self.max_voci:
+                self._voci.popitem(last=False)
+
+    def ottieni_o_crea(self, chiave, crea):
+        """
+        Ritorna (valore, nuovo). crea() viene eseguita al più una volta per chiave
+        anche con richieste concorrenti; nuovo=True solo per chi l'ha eseguita.
+        """
+        valore = self.get(chiave)
+        if valore is not None:
+            return valore, False
+        with self._lock:
+            lock_chiave = self._in_calcolo.setdefault(chiave, threading.Lock())
+        with lock_chiave:
+            valore = self.get(chiave)
+            if valore is not None:
+                return valore, False
+            try:
+                valore = crea()
+                self.put(chiave, valore)
+            finally:
+                with self._lock:
+                    self._in_calcolo.pop(chiave, None)
+        return valore, True
+
+    def __len__(self):
+        return len(self._voci)
@@ -0,0 +1,101 @@
+"""Compilazione delle banche domande CSV nel formato binario colonnare (.arrow).
+
+Il CSV viene letto e validato una sola volta qui; l'app e gli strumenti a riga
+di comando mappano poi in memoria il file .arrow scritto accanto al CSV, senza
+parsing, e i processi che lo aprono ne condividono le pagine. Se il CSV viene
+modificato dopo la compilazione, il .arrow è ignorato finché non si ricompila.
+Al termine vengono segnalati i codici domanda presenti in più banche.
+
+Esempio:
+    python compila_banche.py                      # tutte le banche di banche_dati_quiz
+    python compila_banche.py banche_dati_quiz/FORM_Preposti.csv --forza
+    python compila_banche.py --rapporto problemi_banche.csv   # rapporto di validazione completo
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import pandas as pd
+
+from banca_dati import (
+    CARTELLA_BANCHE, COLONNE_PROBLEMI, BancaNonValida, carica_banca, codici_condivisi, compila_banca,
+    compilata_aggiornata, firma_file, path_compilato, salva_banca_compilata,
+)
+
+
+def aggiornata(path_csv: str) -> bool:
+    """True se il .arrow esiste ed è stato compilato dal CSV nella versione attuale."""
+    path_arrow = path_compilato(path_csv)
+    return os.path.exists(path_arrow) and compilata_aggiornata(path_arrow, firma_file(path_csv))
+
+
+def compila_file(path_csv: str) -> dict:
+    """Valida il CSV e scrive il .arrow accanto; ritorna un riepilogo."""
+    versione = firma_file(path_csv)
+    t0 = time.perf_counter()
+    try:
+        df = pd.read_csv(path_csv)
+    except Exception as e:
+        raise BancaNonValida(f"Errore nella lettura del CSV '{path_csv}': {e}") from e
+    banca = compila_banca(df, path=path_csv, versione=versione)
+    path_arrow = path_compilato(path_csv)
+    salva_banca_compilata(banca, path_arrow, versione_sorgente=versione)
+    return {
+        "file": path_arrow,
+        "domande": len(banca),
+        "argomenti": len(banca.argomenti),
+        "scartate": int(banca.scartate.sum()),
+        "avvisi": int((banca.problemi["gravita"] == "avviso").sum()),
+        "secondi": time.perf_counter() - t0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compila le banche domande CSV nel formato .arrow mappabile in memoria.")
+    parser.add_argument("csv", nargs="*", help=f"CSV da compilare (default: tutti quelli in {CARTELLA_BANCHE}/)")
+    parser.add_argument("--forza", action="store_true", help="ricompila anche le banche già aggiornate")
+    parser.add_argument("--rapporto", help="CSV in cui scrivere i problemi di validazione di tutte le banche")
+    args = parser.parse_args(argv)
+
+    percorsi = args.csv or sorted(glob.glob(os.path.join(CARTELLA_BANCHE, "*.csv")))
+    if not percorsi:
+        parser.error(f"Nessun CSV trovato in '{CARTELLA_BANCHE}'.")
+
+    errori = 0
+    for path_csv in percorsi:
+        if not args.forza and aggiornata(path_csv):
+            print(f"{path_csv}: già aggiornata", file=sys.stderr)
+            continue
+        try:
+            r = compila_file(path_csv)
+        except (BancaNonValida, OSError) as e:
+            print(f"{path_csv}: ERRORE {e}", file=sys.stderr)
+            errori += 1
+            continue
+        print(
+            f"{path_csv} -> {r['file']}: {r['domande']} domande, {r['argomenti']} argomenti, "
+            f"{r['scartate']} righe scartate, {r['avvisi']} avvisi ({r['secondi']:.2f}s)",
+            file=sys.stderr,
+        )
+
+    banche = []
+    for path_csv in percorsi:
+        try:
+            banche.append((os.path.splitext(os.path.basename(path_csv))[0], carica_banca(path_csv)))
+        except BancaNonValida:
+            pass
+    condivisi = codici_condivisi(banche)
+    for codice, elenco in zip(condivisi["codice"], condivisi["banche"]):
+        print(f"codice {codice} presente in più banche: {elenco}", file=sys.stderr)
+
+    if args.rapporto:
+        parti = [b.problemi.assign(banca=label) for label, b in banche]
+        rapporto = pd.concat(parti, ignore_index=True) if parti else pd.DataFrame(columns=["banca", *COLONNE_PROBLEMI])
+        rapporto[["banca", *COLONNE_PROBLEMI]].to_csv(args.rapporto, index=False)
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
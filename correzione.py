@@ -0,0 +1,242 @@
+"""Correzione vettoriale di molte consegne (fogli cartacei scansionati o importati).
+
+Ogni consegna indica il partecipante, il test svolto (seed della variante
+oppure elenco dei codici domanda) e le lettere risposte. Le risposte sono
+confrontate con la chiave compilata come matrice NumPy (consegne x domande).
+
+Esempio:
+    python correzione.py --banca banche_dati_quiz/FORM_Preposti.csv --argomento Preposti \
+        --n-domande 30 --consegne fogli.csv --corso "Preposti 8h" --ente "Essentials"
+
+Formato di fogli.csv: colonne nome, risposte e una tra seed / codici.
+- con seed: le lettere si riferiscono all'ordine mescolato stampato sul foglio
+  (come in genera_test.py);
+- con codici (separati da ';'): le lettere sono quelle originali della banca.
+Le risposte sono una stringa di lettere ("ABDC-A", '-' o spazio = non risposta)
+oppure lettere separate da ';' ("A;B;;C").
+"""
+import argparse
+import os
+import sys
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+from archivio_report import record_riproduzione
+from banca_dati import BancaNonValida, carica_banca
+from cache_consegne import chiave_consegna
+from risultati import salva_risultati
+from test_finale import SOGLIA_SUPERAMENTO, dettaglio_risposte, estrai_variante
+
+NON_RISPOSTA = -1
+FUORI_TEST = -2     # riempimento delle righe più corte della matrice
+
+
+def calcola_esito(punteggio, totale):
+    """Percentuale (1 decimale) ed esito rispetto a SOGLIA_SUPERAMENTO; accetta scalari o array."""
+    punteggio = np.asarray(punteggio, dtype=np.float64)
+    totale = np.asarray(totale, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percentuale = np.where(totale > 0, np.round(punteggio / totale * 100, 1), 0.0)
+    superato = percentuale >= SOGLIA_SUPERAMENTO
+    if percentuale.ndim == 0:
+        return float(percentuale), bool(superato)
+    return percentuale, superato
+
+
+def risposte_in_indici(risposte) -> np.ndarray:
+    """'AB-D' / 'A;B;;D' / ['A', None, ...] -> array int8 di indici 0..3 (-1 = non risposta)."""
+    if risposte is None or (isinstance(risposte, float) and np.isnan(risposte)):
+        return np.empty(0, dtype=np.int8)
+    if isinstance(risposte, str):
+        lettere = risposte.split(";") if ";" in risposte else list(risposte)
+    else:
+        lettere = list(risposte)
+    codici = np.array([ord(x.strip().upper()) if x and x.strip() else 0 for x in lettere], dtype=np.int16)
+    idx = codici - ord("A")
+    idx[(idx < 0) | (idx > 3)] = NON_RISPOSTA
+    return idx.astype(np.int8)
+
+
+def _chiave_da_seed(banca, righe_argomento, n_domande, seed_str, cache):
+    """(codici, chiave nelle posizioni mescolate, corrette originali, permutazioni, righe) della variante."""
+    chiave = cache.get(seed_str)
+    if chiave is None:
+        righe, permutazioni = estrai_variante(righe_argomento, n_domande, seed_str)
+        originali = banca.corretta_idx[righe]
+        mostrate = np.where(
+            originali >= 0, (permutazioni == originali[:, None]).argmax(axis=1), NON_RISPOSTA
+        ).astype(np.int8)
+        codici = banca.df["codice"].to_numpy()[righe].tolist()
+        chiave = cache[seed_str] = (codici, mostrate, originali, permutazioni, righe)
+    return chiave
+
+
+def _chiave_da_codici(banca, codici):
+    """Come _chiave_da_seed, con le lettere nell'ordine della banca; righe None se un codice non esiste."""
+    codici = [c.strip() for c in str(codici).split(";") if c.strip()]
+    pos = np.array([banca.indice_codici.get(c, -1) for c in codici], dtype=np.int64)
+    corrette = np.where(pos >= 0, banca.corretta_idx[np.maximum(pos, 0)], NON_RISPOSTA).astype(np.int8)
+    return codici, corrette, corrette, None, pos if (pos >= 0).all() else None
+
+
+def correggi_matrice(risposte: np.ndarray, chiavi: np.ndarray):
+    """
+    risposte, chiavi: matrici int8 (consegne x domande); chiavi con FUORI_TEST oltre la lunghezza del test.
+    Ritorna (punteggio, totale, esiti) dove esiti è la matrice booleana delle risposte corrette.
+    """
+    esiti = (risposte == chiavi) & (chiavi >= 0)
+    punteggio = esiti.sum(axis=1)
+    totale = (chiavi != FUORI_TEST).sum(axis=1)
+    return punteggio, totale, esiti
+
+
+def correggi_consegne(banca, argomento: str, n_domande: int, consegne: pd.DataFrame, comuni: dict = None) -> pd.DataFrame:
+    """
+    Corregge tutte le consegne e ritorna un DataFrame con i campi di riga_csv.
+    ValueError se una consegna non ha né seed né codici: senza seed l'estrazione
+    è casuale e la chiave non corrisponderebbe al foglio.
+
+    Ogni foglio ha una chiave_consegna ricavata da test svolto, risposte e
+    partecipante: importare di nuovo lo stesso CSV non duplica i risultati.
+    """
+    comuni = comuni or {}
+    righe_argomento = banca.righe_argomento(argomento)
+    cache_seed = {}
+
+    n = len(consegne)
+    seeds = consegne["seed"].fillna("").astype(str).tolist() if "seed" in consegne else [""] * n
+    codici_col = consegne["codici"].fillna("").astype(str).str.strip().tolist() if "codici" in consegne else [""] * n
+    senza_test = [i + 2 for i, (seed_str, codici) in enumerate(zip(seeds, codici_col)) if not seed_str.strip() and not codici]
+    if senza_test:
+        elenco = ", ".join(map(str, senza_test[:10])) + (" ..." if len(senza_test) > 10 else "")
+        raise ValueError(f"Consegne senza 'seed' né 'codici' (righe del CSV: {elenco}): test svolto non riproducibile.")
+
+    nome_col = "nome" if "nome" in consegne else "nome_partecipante"
+    data_test = comuni.get("data_test", date.today())
+    data_str = data_test.strftime("%Y-%m-%d") if isinstance(data_test, date) else str(data_test)
+    nomi = consegne[nome_col].fillna("").astype(str).tolist()
+    email = consegne["email"].fillna("").astype(str).tolist() if "email" in consegne else [""] * n
+    enti = consegne["ente"].astype(str).tolist() if "ente" in consegne else [comuni.get("user_ente", "")] * n
+
+    chiavi_righe = []
+    risposte_righe = []
+    dettagli = []
+    chiavi_consegna = []
+    riproduzioni = []
+    righe_foglio = zip(seeds, codici_col, consegne["risposte"].tolist(), nomi, email, enti)
+    for seed_str, codici, risposte, nome, email_p, ente in righe_foglio:
+        if codici:
+            codici_test, chiave, originali, permutazioni, righe = _chiave_da_codici(banca, codici)
+        else:
+            codici_test, chiave, originali, permutazioni, righe = _chiave_da_seed(
+                banca, righe_argomento, n_domande, seed_str, cache_seed
+            )
+        indici = risposte_in_indici(risposte)
+        chiavi_righe.append(chiave)
+        risposte_righe.append(indici)
+        scelte = np.full(len(chiave), NON_RISPOSTA, dtype=np.int8)
+        scelte[:min(len(indici), len(chiave))] = indici[:len(chiave)]
+        dettagli.append(dettaglio_risposte(codici_test, originali, permutazioni, scelte))
+
+        # con i codici le lettere sono nell'ordine della banca: permutazione identità
+        if permutazioni is None:
+            permutazioni = np.tile(np.arange(4, dtype=np.int8), (len(codici_test), 1))
+        risposte_mostrate = [None if r < 0 else int(r) for r in scelte]
+        chiavi_consegna.append(chiave_consegna(
+            "", "" if codici else seed_str, codici_test, permutazioni, risposte_mostrate,
+            {
+                "origine": "cartaceo", "nome": nome, "email": email_p, "ente": ente,
+                "corso": comuni.get("corso", ""), "data_test": data_str, "argomento": argomento,
+                "banca": comuni.get("banca_domande", ""), "sessione_aula": comuni.get("sessione_aula", ""),
+            },
+        ))
+        riproduzioni.append(
+            record_riproduzione(banca, righe, permutazioni, risposte_mostrate) if righe is not None else None
+        )
+
+    larghezza = max((len(k) for k in chiavi_righe), default=0)
+    chiavi = np.full((n, larghezza), FUORI_TEST, dtype=np.int8)
+    risposte_m = np.full((n, larghezza), NON_RISPOSTA, dtype=np.int8)
+    for r, (k, a) in enumerate(zip(chiavi_righe, risposte_righe)):
+        chiavi[r, :len(k)] = k
+        a = a[:len(k)]
+        risposte_m[r, :len(a)] = a
+
+    punteggio, totale, _ = correggi_matrice(risposte_m, chiavi)
+    percentuale, superato = calcola_esito(punteggio, totale)
+
+    out = pd.DataFrame({
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "login_user": comuni.get("login_user", ""),
+        "user_ente": enti,
+        "user_role": comuni.get("user_role", ""),
+        "nome_partecipante": nomi,
+        "email_partecipante": email,
+        "corso": comuni.get("corso", ""),
+        "argomento": argomento,
+        "banca_domande": comuni.get("banca_domande", ""),
+        "data_test": data_str,
+        "n_domande": totale,
+        "punteggio": punteggio,
+        "percentuale": percentuale,
+        "superato": superato,
+        "seed": np.where(np.array(codici_col, dtype=object) != "", "", np.array(seeds, dtype=object)),
+        "chiave_consegna": chiavi_consegna,
+        "risposte_domande": dettagli,
+        "riproduzione": riproduzioni,
+        "sessione_aula": comuni.get("sessione_aula", ""),
+    })
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Correzione in blocco di fogli risposte (CSV) e salvataggio nell'archivio risultati.")
+    parser.add_argument("--banca", required=True, help="CSV della banca domande")
+    parser.add_argument("--argomento", required=True)
+    parser.add_argument("--n-domande", type=int, default=30, help="numero domande delle varianti (consegne con seed)")
+    parser.add_argument("--consegne", required=True, help="CSV con colonne nome, risposte e seed o codici")
+    parser.add_argument("--corso", default="")
+    parser.add_argument("--ente", default="")
+    parser.add_argument("--data-test", default=date.today().isoformat(), help="AAAA-MM-GG")
+    parser.add_argument("--utente", default="import_cartaceo", help="valore di login_user nei risultati")
+    parser.add_argument("--solo-stampa", action="store_true", help="non salvare, stampa i risultati in CSV")
+    args = parser.parse_args(argv)
+
+    try:
+        banca = carica_banca(args.banca)
+    except BancaNonValida as e:
+        parser.error(str(e))
+
+    consegne = pd.read_csv(args.consegne, dtype=str, keep_default_na=False)
+    if "risposte" not in consegne or not ({"seed", "codici"} & set(consegne.columns)):
+        parser.error("Il CSV delle consegne deve avere le colonne 'risposte' e 'seed' o 'codici'.")
+
+    comuni = {
+        "login_user": args.utente,
+        "user_ente": args.ente,
+        "user_role": "",
+        "corso": args.corso,
+        "banca_domande": os.path.splitext(os.path.basename(args.banca))[0],
+        "data_test": date.fromisoformat(args.data_test),
+    }
+    try:
+        risultati_df = correggi_consegne(banca, args.argomento, args.n_domande, consegne, comuni)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.solo_stampa:
+        risultati_df.to_csv(sys.stdout, index=False)
+    else:
+        n = salva_risultati(risultati_df.to_dict(orient="records"))
+        print(
+            f"{n} consegne corrette e salvate ({int(risultati_df['superato'].sum())} superate), "
+            f"{len(risultati_df) - n} già presenti nell'archivio.",
+            file=sys.stderr,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""Email di riepilogo (digest): una per ente, corso e data invece di una per consegna.
+
+In modalità digest la consegna non spedisce un messaggio al destinatario
+fisso: viene annotata nella tabella digest_in_attesa (nello stesso database
+dell'outbox) e, allo scadere della finestra del suo gruppo (es. 15 minuti
+dalla prima consegna) o alla chiusura della sessione d'aula, il worker
+dell'outbox accoda un solo messaggio con la tabella riepilogativa nel corpo
+e uno ZIP dei report come allegato differito (generato all'invio).
+"""
+import time
+
+from metriche import misura
+from outbox_email import Outbox, componi_messaggio
+
+# ============================================================
+# COSTANTI
+# ============================================================
+FINESTRA_DIGEST_S = 15 * 60
+INTERVALLO_CONTROLLO_S = 30.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS digest_in_attesa (
+    chiave_consegna TEXT PRIMARY KEY,
+    user_ente TEXT NOT NULL,
+    corso TEXT NOT NULL,
+    data_test TEXT NOT NULL,
+    sessione_aula TEXT,
+    mittente TEXT NOT NULL,
+    destinatari TEXT NOT NULL,
+    scadenza REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_digest_scadenza ON digest_in_attesa (scadenza);
+"""
+
+_inizializzate = set()
+
+
+def _conn(outbox: Outbox):
+    conn = outbox._conn()
+    if outbox.path not in _inizializzate:
+        conn.executescript(_SCHEMA)
+        _inizializzate.add(outbox.path)
+    return conn
+
+
+# ============================================================
+# ACCODAMENTO
+# ============================================================
+
+def accoda_per_digest(outbox: Outbox, riga: dict, mittente: str, destinatari, finestra_s: float = FINESTRA_DIGEST_S) -> bool:
+    """
+    Annota una consegna già salvata nell'archivio risultati. Il gruppo
+    (ente, corso, data_test, destinatari) parte alla scadenza della sua consegna più vecchia.
+    """
+    cur = _conn(outbox).execute(
+        "INSERT OR IGNORE INTO digest_in_attesa (chiave_consegna, user_ente, corso, data_test, sessione_aula, "
+        "mittente, destinatari, scadenza) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            riga["chiave_consegna"], str(riga.get("user_ente") or ""),
+            str(riga.get("corso") or riga.get("argomento") or ""), str(riga.get("data_test") or ""),
+            str(riga.get("sessione_aula") or ""), mittente, ", ".join(destinatari), time.time() + finestra_s,
+        ),
+    )
+    return cur.rowcount == 1
+
+
+def chiudi_finestra_sessione(outbox: Outbox, codice_sessione: str) -> int:
+    """Chiusura della sessione d'aula: i gruppi con sue consegne partono al prossimo controllo."""
+    cur = _conn(outbox).execute(
+        "UPDATE digest_in_attesa SET scadenza = 0 WHERE sessione_aula = ?", (codice_sessione,)
+    )
+    return cur.rowcount
+
+
+def in_attesa(outbox: Outbox) -> int:
+    return _conn(outbox).execute("SELECT COUNT(*) FROM digest_in_attesa").fetchone()[0]
+
+
+# ============================================================
+# COMPOSIZIONE E INVIO
+# ============================================================
+
+def _leggi_righe(chiavi) -> list:
+    from risultati import leggi_risultati
+
+    segnaposto = ", ".join("?" for _ in chiavi)
+    df = leggi_risultati(f"chiave_consegna IN ({segnaposto})", tuple(chiavi))
+    return df.to_dict(orient="records")
+
+
+def _superato(v) -> bool:
+    return str(v).strip().lower() in ("1", "true")
+
+
+def componi_digest(ente: str, corso: str, data_test: str, righe: list):
+    """(oggetto, corpo) del riepilogo: una riga per partecipante, in ordine di consegna."""
+    superati = sum(_superato(r.get("superato")) for r in righe)
+    oggetto = f"Riepilogo test finali - {corso or '-'} - {data_test} - {ente or '-'}: {len(righe)} consegne, {superati} superati"
+
+    intestazione = ("Partecipante", "Punteggio", "%", "Esito")
+    tabella = [
+        (
+            str(r.get("nome_partecipante") or "-"),
+            f"{int(float(r.get('punteggio') or 0))}/{int(float(r.get('n_domande') or 0))}",
+            f"{float(r.get('percentuale') or 0):.1f}",
+            "SUPERATO" if _superato(r.get("superato")) else "NON SUPERATO",
+        )
+        for r in righe
+    ]
+    larghezze = [max(len(riga[i]) for riga in [intestazione, *tabella]) for i in range(len(intestazione))]
+
+    def formatta(riga):
+        return "  ".join(v.ljust(w) for v, w in zip(riga, larghezze)).rstrip()
+
+    linee = [
+        "Riepilogo dei test finali di formazione sicurezza.",
+        "",
+        f"Ente: {ente or '-'}",
+        f"Corso / Modulo: {corso or '-'}",
+        f"Data test finale: {data_test}",
+        f"Consegne: {len(righe)} — Superati: {superati} — Non superati: {len(righe) - superati}",
+        "",
+        formatta(intestazione),
+        formatta(["-" * w for w in larghezze]),
+        *(formatta(riga) for riga in tabella),
+        "",
+        "In allegato lo ZIP con i report PDF (e i badge dei superati) e il riepilogo in CSV.",
+    ]
+    return oggetto, "\n".join(linee)
+
+
+def invia_digest_pronti(outbox: Outbox, ora: float = None, leggi_righe=_leggi_righe) -> int:
+    """
+    Accoda un messaggio per ogni gruppo scaduto e lo toglie dall'attesa nella
+    stessa transazione (anche con più processi ogni consegna finisce in un solo digest).
+    """
+    conn = _conn(outbox)
+    ora = time.time() if ora is None else ora
+    if conn.execute("SELECT 1 FROM digest_in_attesa WHERE scadenza <= ? LIMIT 1", (ora,)).fetchone() is None:
+        return 0
+
+    accodati = 0
+    with misura("digest_email"):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            gruppi = conn.execute(
+                "SELECT user_ente, corso, data_test, mittente, destinatari FROM digest_in_attesa "
+                "GROUP BY user_ente, corso, data_test, mittente, destinatari HAVING MIN(scadenza) <= ?",
+                (ora,),
+            ).fetchall()
+            for ente, corso, data_test, mittente, destinatari in gruppi:
+                filtro = ("user_ente = ? AND corso = ? AND data_test = ? AND mittente = ? AND destinatari = ?")
+                params = (ente, corso, data_test, mittente, destinatari)
+                chiavi = [c for (c,) in conn.execute(
+                    f"SELECT chiave_consegna FROM digest_in_attesa WHERE {filtro}", params
+                )]
+                righe = leggi_righe(chiavi)
+                if righe:
+                    oggetto, corpo = componi_digest(ente, corso, data_test, righe)
+                    destinatari_l = destinatari.split(", ")
+                    nome_zip = "_".join(p.replace(" ", "_") for p in (data_test.replace("-", ""), corso, ente) if p)
+                    outbox.accoda(
+                        mittente, destinatari_l, oggetto,
+                        componi_messaggio(mittente, destinatari_l, oggetto, corpo, []),
+                        [{"tipo": "zip", "chiavi": [r["chiave_consegna"] for r in righe], "nome": f"report_{nome_zip}.zip"}],
+                    )
+                    accodati += 1
+                conn.execute(f"DELETE FROM digest_in_attesa WHERE {filtro}", params)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    return accodati
+
+
+def controllo_periodico(outbox: Outbox, intervallo_s: float = INTERVALLO_CONTROLLO_S):
+    """Funzione per OutboxWorker(periodico=...): invia i digest pronti al più ogni intervallo_s."""
+    ultimo = [0.0]
+
+    def controlla():
+        if time.monotonic() - ultimo[0] >= intervallo_s:
+            ultimo[0] = time.monotonic()
+            invia_digest_pronti(outbox)
+
+    return controlla
@@ -0,0 +1,278 @@
+"""Domande quasi duplicate (anche riformulate) nelle banche, con MinHash/LSH in tempo quasi lineare.
+
+Il testo di ogni domanda (con quello della sua risposta corretta, vedi
+testi_confronto) viene normalizzato come per la ricerca
+(ricerca_domande.termini: accenti, stopword, singolare/plurale) e ridotto
+all'insieme dei suoi shingle (termini e coppie di termini). Di ogni insieme si
+calcola la firma MinHash (NUM_PERMUTAZIONI minimi di funzioni hash
+universali, in blocco con numpy); con LSH le firme vengono divise in BANDE e
+due domande diventano candidate solo se coincidono in almeno una banda, così
+non si confrontano tutte le coppie. Le candidate con similarità di Jaccard
+stimata >= SOGLIA_SIMILARITA finiscono nello stesso gruppo (union-find).
+
+L'estrazione può prendere al più una domanda per gruppo (motore.estrai,
+una_per_gruppo=True), così un test non contiene due volte la stessa domanda.
+
+Esempio:
+    python duplicati.py                              # tutte le banche di banche_dati_quiz
+    python duplicati.py Example.csv --output gruppi_duplicati.csv
+"""
+import argparse
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+from banca_dati import CARTELLA_BANCHE, COLONNE_OPZIONI, BancaNonValida, carica_banca, list_quiz_files
+from metriche import misura
+from ricerca_domande import termini
+
+# ============================================================
+# COSTANTI
+# ============================================================
+NUM_PERMUTAZIONI = 64
+BANDE = 16                      # 16 bande da 4 righe: candidate da similarità ~0.5 in su
+SOGLIA_SIMILARITA = 0.5
+SHINGLE_PER_BLOCCO = 100_000    # memoria del calcolo delle firme: NUM_PERMUTAZIONI x blocco uint64
+_MASSIMO_HASH = (1 << 32) - 1
+_SEME_HASH = 20240601           # fisso: stesse firme (e stessi gruppi) in ogni processo
+
+COLONNE_GRUPPI = ["gruppo", "banca", "codice", "argomento", "domanda"]
+
+
+# ============================================================
+# SHINGLE E FIRME MINHASH
+# ============================================================
+
+def shingle(testi):
+    """
+    Shingle di tutti i testi, calcolati in blocco: i termini normalizzati e le
+    coppie di termini consecutivi (l'ordine delle parole conta, ma una parola
+    cambiata tocca solo pochi shingle). Ritorna (valori uint64, documento di
+    ciascuno shingle), ordinati per documento; i testi senza termini non ne hanno.
+    """
+    vocabolario = {}
+    ids, lunghezze = [], []
+    for testo in testi:
+        trovati = [vocabolario.setdefault(t, len(vocabolario) + 1) for t in termini(testo)]
+        ids.extend(trovati)
+        lunghezze.append(len(trovati))
+    ids = np.asarray(ids, dtype=np.uint64)
+    documento = np.repeat(np.arange(len(lunghezze)), lunghezze)
+
+    # coppie: id1 nei 32 bit alti, id2 nei bassi (i termini singoli restano sotto 2^32)
+    stessa = documento[1:] == documento[:-1]
+    coppie = (ids[:-1][stessa] << np.uint64(32)) | ids[1:][stessa]
+    valori = np.concatenate((ids, coppie))
+    documento = np.concatenate((documento, documento[:-1][stessa]))
+    ordine = np.argsort(documento, kind="stable")
+    return valori[ordine], documento[ordine]
+
+
+def _coefficienti():
+    """Funzioni hash multiply-shift h(x) = (a*x + b) mod 2^64 >> 32, con a dispari."""
+    rng = np.random.default_rng(_SEME_HASH)
+    a = rng.integers(0, 1 << 63, size=(NUM_PERMUTAZIONI, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=(NUM_PERMUTAZIONI, 1), dtype=np.uint64)
+    return a, b
+
+
+def firme_minhash(testi) -> tuple:
+    """
+    (firme uint32 n x NUM_PERMUTAZIONI, maschera dei testi con almeno uno shingle).
+    Le firme dei testi senza shingle non vanno usate.
+    """
+    valori, documento = shingle(testi)
+    n = len(testi)
+    firme = np.full((n, NUM_PERMUTAZIONI), _MASSIMO_HASH, dtype=np.uint32)
+    if len(valori):
+        a, b = _coefficienti()
+        # a blocchi di shingle interi per documento: memoria limitata anche su banche grandi
+        confini = np.flatnonzero(np.diff(documento)) + 1
+        inizi_doc = np.concatenate(([0], confini))
+        tagli = [0]
+        for i in inizi_doc:
+            if i - tagli[-1] >= SHINGLE_PER_BLOCCO:
+                tagli.append(int(i))
+        tagli.append(len(valori))
+        for da, a_ in zip(tagli[:-1], tagli[1:]):
+            # overflow voluto: l'aritmetica uint64 è modulo 2^64
+            hash_blocco = ((a * valori[da:a_] + b) >> np.uint64(32)).astype(np.uint32)
+            inizi_blocco = inizi_doc[(inizi_doc >= da) & (inizi_doc < a_)]
+            minimi = np.minimum.reduceat(hash_blocco, inizi_blocco - da, axis=1)
+            firme[documento[inizi_blocco]] = minimi.T
+    validi = np.zeros(n, dtype=bool)
+    validi[documento] = True
+    return firme, validi
+
+
+# ============================================================
+# LSH E GRUPPI
+# ============================================================
+
+def _radice(padri: list, i: int) -> int:
+    while padri[i] != i:
+        padri[i] = padri[padri[i]]
+        i = padri[i]
+    return i
+
+
+def rileva_gruppi(testi, soglia: float = SOGLIA_SIMILARITA) -> np.ndarray:
+    """
+    Per ogni testo l'id del suo gruppo di quasi duplicati (0, 1, ...) oppure -1
+    se non somiglia a nessun altro. Costo O(n) per firme e bande più i candidati.
+    """
+    testi = list(testi)
+    n = len(testi)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    firme, validi = firme_minhash(testi)
+    indici_validi = np.flatnonzero(validi)
+    righe_banda = NUM_PERMUTAZIONI // BANDE
+    padri = list(range(n))
+
+    for banda in range(BANDE):
+        colonne = firme[indici_validi, banda * righe_banda:(banda + 1) * righe_banda].astype(np.uint64)
+        chiave = np.zeros(len(indici_validi), dtype=np.uint64)
+        for j in range(righe_banda):
+            chiave = chiave * np.uint64(1_000_003) ^ colonne[:, j]
+        ordine = np.argsort(chiave, kind="stable")
+        chiave_ordinata = chiave[ordine]
+        # primo elemento del secchio di ciascuno: ogni candidato si confronta con quello (stella)
+        nuovo_secchio = np.concatenate(([True], chiave_ordinata[1:] != chiave_ordinata[:-1]))
+        testa = ordine[np.maximum.accumulate(np.where(nuovo_secchio, np.arange(len(ordine)), 0))]
+        candidati = ~nuovo_secchio
+        if not candidati.any():
+            continue
+        membri = indici_validi[ordine[candidati]]
+        teste = indici_validi[testa[candidati]]
+        similarita = (firme[membri] == firme[teste]).mean(axis=1)
+        for i, j in zip(membri[similarita >= soglia].tolist(), teste[similarita >= soglia].tolist()):
+            ri, rj = _radice(padri, i), _radice(padri, j)
+            if ri != rj:
+                padri[max(ri, rj)] = min(ri, rj)
+
+    radici = np.array([_radice(padri, i) for i in range(n)])
+    _, gruppo, dimensioni = np.unique(radici, return_inverse=True, return_counts=True)
+    # solo i gruppi con almeno due domande, numerati in ordine di prima comparsa
+    gruppo = np.where(dimensioni[gruppo] > 1, gruppo, -1)
+    rinumera = {g: k for k, g in enumerate(dict.fromkeys(g for g in gruppo.tolist() if g >= 0))}
+    return np.array([rinumera.get(g, -1) for g in gruppo.tolist()], dtype=np.int64)
+
+
+# ============================================================
+# CACHE PER BANCA E TRA BANCHE
+# ============================================================
+
+def testi_confronto(banca) -> list:
+    """
+    Domanda seguita dal testo della risposta corretta: domande brevi con lo
+    stesso testo ('Il preposto deve:') ma risposte diverse non sono duplicati.
+    """
+    domande = banca.df["domanda"].tolist()
+    opzioni = np.column_stack([banca.df[c].astype(str).to_numpy(dtype=object) for c in COLONNE_OPZIONI])
+    corrette = np.where(banca.corretta_idx >= 0, opzioni[np.arange(len(banca)), np.maximum(banca.corretta_idx, 0)], "")
+    return [f"{d if isinstance(d, str) else ''} {c}" for d, c in zip(domande, corrette)]
+
+_lock = threading.Lock()
+_cache_banche = {}    # path -> (versione, gruppi per riga)
+_cache_cartelle = {}  # (path, versione) delle banche -> DataFrame dei gruppi
+
+
+def gruppi_banca(banca) -> np.ndarray:
+    """Gruppo di quasi duplicati di ogni riga della banca (-1 = nessuno), ricalcolato se la banca cambia."""
+    voce = _cache_banche.get(banca.path)
+    if voce is not None and voce[0] == banca.versione:
+        return voce[1]
+    with _lock:
+        voce = _cache_banche.get(banca.path)
+        if voce is None or voce[0] != banca.versione:
+            with misura("duplicati_banca"):
+                voce = (banca.versione, rileva_gruppi(testi_confronto(banca)))
+            _cache_banche[banca.path] = voce
+        return voce[1]
+
+
+def gruppi_tra_banche(banche) -> pd.DataFrame:
+    """
+    Gruppi di quasi duplicati tra più banche: banche = [(label, BancaCompilata), ...]
+    -> DataFrame COLONNE_GRUPPI con le sole domande che hanno almeno un duplicato.
+    """
+    firma = tuple((b.path, b.versione) for _, b in banche)
+    risultato = _cache_cartelle.get(firma)
+    if risultato is not None:
+        return risultato
+
+    parti = [
+        pd.DataFrame({
+            "banca": label,
+            "codice": b.df["codice"].astype(str).to_numpy(),
+            "argomento": b.df["argomento"].astype(str).to_numpy(),
+            "domanda": b.df["domanda"].to_numpy(dtype=object),
+            "_testo": testi_confronto(b),
+        })
+        for label, b in banche
+    ]
+    if not parti:
+        return pd.DataFrame(columns=COLONNE_GRUPPI)
+    tutte = pd.concat(parti, ignore_index=True)
+    with misura("duplicati_banche"):
+        tutte.insert(0, "gruppo", rileva_gruppi(tutte.pop("_testo").tolist()))
+    risultato = tutte[tutte["gruppo"] >= 0].sort_values(["gruppo", "banca", "codice"], kind="stable")
+    risultato = risultato.reset_index(drop=True)
+    with _lock:
+        _cache_cartelle.clear()  # una sola voce: la cartella nella sua versione attuale
+        _cache_cartelle[firma] = risultato
+    return risultato
+
+
+def gruppi_cartella(cartella: str = CARTELLA_BANCHE) -> pd.DataFrame:
+    banche = []
+    for label, path in list_quiz_files(cartella):
+        try:
+            banche.append((label, carica_banca(path)))
+        except BancaNonValida:
+            continue
+    return gruppi_tra_banche(banche)
+
+
+def svuota_cache():
+    with _lock:
+        _cache_banche.clear()
+        _cache_cartelle.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gruppi di domande quasi duplicate nelle banche (MinHash/LSH).")
+    parser.add_argument("csv", nargs="*", help=f"altre banche da confrontare con quelle di {CARTELLA_BANCHE}/")
+    parser.add_argument("--cartella", default=CARTELLA_BANCHE)
+    parser.add_argument("--output", help="CSV in cui scrivere i gruppi")
+    args = parser.parse_args(argv)
+
+    banche = []
+    altre = [(os.path.splitext(os.path.basename(p))[0], p) for p in args.csv]
+    for label, path in list_quiz_files(args.cartella) + altre:
+        try:
+            banca = carica_banca(path)
+        except BancaNonValida as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            continue
+        if all(banca.path != b.path for _, b in banche):
+            banche.append((label, banca))
+
+    gruppi = gruppi_tra_banche(banche)
+    if args.output:
+        gruppi.to_csv(args.output, index=False)
+    else:
+        with pd.option_context("display.max_colwidth", 70, "display.width", 200, "display.max_rows", 200):
+            print(gruppi[["gruppo", "banca", "codice", "domanda"]].to_string(index=False))
+    n_domande = sum(len(b) for _, b in banche)
+    print(f"{gruppi['gruppo'].nunique()} gruppi, {len(gruppi)} domande su {n_domande} in {len(banche)} banche",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
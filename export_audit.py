@@ -0,0 +1,319 @@
+"""Export per le verifiche ispettive: risultati filtrati e report PDF in un unico ZIP.
+
+I risultati (per ente e/o intervallo di date del test) si leggono a blocchi
+dall'archivio e i report si producono uno alla volta dal record di
+riproduzione (o si prendono dalla cache PDF se già presenti), scrivendoli
+subito nello ZIP su disco: la memoria usata non dipende dal numero di
+risultati. Nello ZIP c'è anche l'indice (indice.xlsx o indice.csv) con una
+riga per risultato e i nomi dei file dei report.
+
+Esempio:
+    python export_audit.py --ente "Studio 4Step" --dal 2025-01-01 --al 2025-12-31 --output audit.zip
+"""
+import argparse
+import csv
+import os
+import re
+import sys
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape
+
+from archivio_report import (
+    AVVISO_TESTI_CAMBIATI, RiproduzioneNonValida, cache_predefinita, componente_nome_file, genera_pdf, nome_file_report,
+    testi_cambiati,
+)
+from metriche import misura
+from risultati import conta_risultati, itera_risultati
+
+# ============================================================
+# COSTANTI
+# ============================================================
+CARTELLA_EXPORT = "export_audit"
+FORMATI_INDICE = ("xlsx", "csv")
+BLOCCO_RIGHE = 500
+RISULTATI_PER_PARTE = 2000  # export dalla pagina: ZIP scaricati interi in memoria, quindi di dimensione limitata
+
+COLONNE_INDICE = (
+    "id", "timestamp", "user_ente", "login_user", "nome_partecipante", "email_partecipante",
+    "corso", "argomento", "banca_domande", "data_test", "n_domande", "domande_estratte", "punteggio",
+    "percentuale", "superato", "seed", "sessione_aula", "chiave_consegna",
+    "file_report", "file_badge", "note",
+)
+# colonne lette dall'archivio: l'indice più il record da cui si rigenerano i report
+_COLONNE_LETTE = [*COLONNE_INDICE[1:-3], "riproduzione"]
+
+_CONTROLLO_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def filtro_audit(ente: str = None, dal: str = None, al: str = None):
+    """(where, params) per itera_risultati: date ISO 'AAAA-MM-GG', estremi inclusi."""
+    condizioni, params = [], []
+    if ente:
+        condizioni.append("user_ente = ?")
+        params.append(ente)
+    if dal:
+        condizioni.append("data_test >= ?")
+        params.append(str(dal))
+    if al:
+        condizioni.append("data_test <= ?")
+        params.append(str(al))
+    return " AND ".join(condizioni), tuple(params)
+
+
+# ============================================================
+# INDICE XLSX IN STREAMING
+# ============================================================
+
+def _colonna_excel(i: int) -> str:
+    lettere = ""
+    i += 1
+    while i:
+        i, resto = divmod(i - 1, 26)
+        lettere = chr(ord("A") + resto) + lettere
+    return lettere
+
+
+class ScrittoreXLSX:
+    """
+    Foglio XLSX scritto riga per riga direttamente nel file (celle inlineStr,
+    nessuna tabella delle stringhe condivise da tenere in memoria).
+    """
+
+    def __init__(self, path: str, foglio: str = "Risultati"):
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        self._foglio = foglio
+        self._righe = 0
+        self._xml = self._zip.open("xl/worksheets/sheet1.xml", "w")
+        self._scrivi(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+        )
+
+    def _scrivi(self, testo: str) -> None:
+        self._xml.write(testo.encode("utf-8"))
+
+    def _cella(self, rif: str, valore) -> str:
+        if valore is None or valore == "":
+            return ""
+        if isinstance(valore, (int, float)) and not isinstance(valore, bool) and valore == valore:
+            return f'<c r="{rif}"><v>{valore}</v></c>'
+        testo = escape(_CONTROLLO_XML.sub("", str(valore)))
+        return f'<c r="{rif}" t="inlineStr"><is><t xml:space="preserve">{testo}</t></is></c>'
+
+    def riga(self, valori) -> None:
+        self._righe += 1
+        celle = "".join(self._cella(f"{_colonna_excel(i)}{self._righe}", v) for i, v in enumerate(valori))
+        self._scrivi(f'<row r="{self._righe}">{celle}</row>')
+
+    def chiudi(self) -> None:
+        self._scrivi("</sheetData></worksheet>")
+        self._xml.close()
+        self._zip.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            "</Types>",
+        )
+        self._zip.writestr(
+            "_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+            'officeDocument" Target="xl/workbook.xml"/></Relationships>',
+        )
+        self._zip.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(self._foglio)}" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        )
+        self._zip.writestr(
+            "xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+            'worksheet" Target="worksheets/sheet1.xml"/></Relationships>',
+        )
+        self._zip.close()
+
+
+class ScrittoreCSV:
+    def __init__(self, path: str):
+        self._file = open(path, "w", newline="", encoding="utf-8-sig")
+        self._writer = csv.writer(self._file)
+
+    def riga(self, valori) -> None:
+        self._writer.writerow(["" if v is None else v for v in valori])
+
+    def chiudi(self) -> None:
+        self._file.close()
+
+
+# ============================================================
+# EXPORT
+# ============================================================
+
+def _pdf(riga: dict, tipo: str):
+    """
+    (PDF, nota): dalla cache se c'è, altrimenti generato senza salvarlo (l'export
+    non deve svuotare la cache); nota = avviso se il report generato usa testi cambiati dopo il test.
+    """
+    dati = cache_predefinita().get(f"{riga.get('chiave_consegna')}:{tipo}") if riga.get("chiave_consegna") else None
+    if dati is not None:
+        return dati, ""
+    nota = AVVISO_TESTI_CAMBIATI if tipo == "test" and testi_cambiati(riga) else ""
+    return genera_pdf(riga, tipo), nota
+
+
+def _nome_unico(nome: str, nomi: set) -> str:
+    base, estensione = os.path.splitext(nome)
+    k = 2
+    while nome in nomi:  # omonimi nello stesso corso e data
+        nome = f"{base}_{k}{estensione}"
+        k += 1
+    nomi.add(nome)
+    return nome
+
+
+class _ParteZip:
+    """Uno ZIP dell'export (report/, badge/ e indice) scritto in file temporanei e spostato in output alla chiusura."""
+
+    def __init__(self, output: str, formato_indice: str):
+        self.output = output
+        self.formato_indice = formato_indice
+        cartella = os.path.dirname(os.path.abspath(output))
+        os.makedirs(cartella, exist_ok=True)
+        fd, self._tmp_zip = tempfile.mkstemp(suffix=".zip.tmp", dir=cartella)
+        os.close(fd)
+        fd, self._tmp_indice = tempfile.mkstemp(suffix=f".{formato_indice}.tmp", dir=cartella)
+        os.close(fd)
+        self.indice = ScrittoreXLSX(self._tmp_indice) if formato_indice == "xlsx" else ScrittoreCSV(self._tmp_indice)
+        self.indice.riga(COLONNE_INDICE)
+        self.zip = zipfile.ZipFile(self._tmp_zip, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.nomi = set()
+        self.risultati = 0
+
+    def chiudi(self) -> None:
+        self.indice.chiudi()
+        self.zip.write(self._tmp_indice, f"indice.{self.formato_indice}")
+        self.zip.close()
+        os.replace(self._tmp_zip, self.output)
+        self.scarta()
+
+    def scarta(self) -> None:
+        for path in (self._tmp_zip, self._tmp_indice):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def path_parte(output: str, parte: int, parti: int) -> str:
+    """output per un export in una sola parte, altrimenti '<nome>_parte<k>di<n>.zip'."""
+    if parti <= 1:
+        return output
+    base, estensione = os.path.splitext(output)
+    return f"{base}_parte{parte:0{len(str(parti))}d}di{parti}{estensione}"
+
+
+def esporta_audit(output: str, ente: str = None, dal: str = None, al: str = None,
+                  formato_indice: str = "xlsx", badge: bool = True, avanzamento=None,
+                  blocco: int = BLOCCO_RIGHE, risultati_per_parte: int = None) -> dict:
+    """
+    Scrive in output lo ZIP dell'export (report/ e badge/ con i PDF, più
+    l'indice). avanzamento(fatti, totale) viene chiamata dopo ogni risultato.
+    Con risultati_per_parte l'export è diviso in più ZIP completi (ognuno con
+    il suo indice), nominati da path_parte: ogni file resta di dimensione limitata.
+    Ritorna i conteggi: risultati, report, badge, errori e file (ZIP scritti).
+    """
+    if formato_indice not in FORMATI_INDICE:
+        raise ValueError(f"formato_indice deve essere uno tra: {', '.join(FORMATI_INDICE)}")
+    where, params = filtro_audit(ente, dal, al)
+    totale = conta_risultati(where, params)
+    per_parte = risultati_per_parte or max(totale, 1)
+    parti = max(1, -(-totale // per_parte))
+    conteggi = {"risultati": 0, "report": 0, "badge": 0, "errori": 0, "file": []}
+
+    parte = _ParteZip(path_parte(output, 1, parti), formato_indice)
+    try:
+        with misura("export_audit"):
+            for riga in itera_risultati(where, params, colonne=_COLONNE_LETTE, blocco=blocco):
+                if parte.risultati == per_parte:
+                    parte.chiudi()
+                    conteggi["file"].append(parte.output)
+                    parte = _ParteZip(path_parte(output, len(conteggi["file"]) + 1, parti), formato_indice)
+                superato = str(riga.get("superato")).strip().lower() in ("1", "true")
+                file_report = file_badge = note = ""
+                try:
+                    # i PDF sono già compressi: nello ZIP si salvano senza ricomprimerli
+                    dati, note = _pdf(riga, "test")
+                    nome = _nome_unico(f"report/{nome_file_report(riga, 'test')}", parte.nomi)
+                    parte.zip.writestr(nome, dati, compress_type=zipfile.ZIP_STORED)
+                    file_report = nome
+                    conteggi["report"] += 1
+                except RiproduzioneNonValida as e:
+                    note = str(e)
+                    conteggi["errori"] += 1
+                if badge and superato:
+                    nome = _nome_unico(f"badge/{nome_file_report(riga, 'badge')}", parte.nomi)
+                    parte.zip.writestr(nome, _pdf(riga, "badge")[0], compress_type=zipfile.ZIP_STORED)
+                    file_badge = nome
+                    conteggi["badge"] += 1
+
+                valori = {**riga, "superato": "SI" if superato else "NO",
+                          "file_report": file_report, "file_badge": file_badge, "note": note}
+                parte.indice.riga([valori.get(c) for c in COLONNE_INDICE])
+                parte.risultati += 1
+                conteggi["risultati"] += 1
+                if avanzamento is not None:
+                    avanzamento(conteggi["risultati"], totale)
+            parte.chiudi()
+            conteggi["file"].append(parte.output)
+    finally:
+        parte.scarta()
+    return conteggi
+
+
+def nome_file_export(ente: str = None, dal: str = None, al: str = None) -> str:
+    # ente e date arrivano anche dall'API: stessa sanificazione dei nomi dei report
+    parti = ["audit", componente_nome_file(ente, "tutti")]
+    if dal or al:
+        parti.append(componente_nome_file(f"{str(dal or '').replace('-', '')}-{str(al or '').replace('-', '')}", "date"))
+    return "_".join(parti) + ".zip"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export dei risultati e dei report PDF per le verifiche (ZIP).")
+    parser.add_argument("--ente", help="solo i risultati di questo ente")
+    parser.add_argument("--dal", help="data del test iniziale, AAAA-MM-GG (inclusa)")
+    parser.add_argument("--al", help="data del test finale, AAAA-MM-GG (inclusa)")
+    parser.add_argument("--indice", choices=FORMATI_INDICE, default="xlsx", help="formato dell'indice nello ZIP")
+    parser.add_argument("--senza-badge", action="store_true", help="non includere i badge dei superati")
+    parser.add_argument("--output", help="file ZIP (default: nome standard nella cartella export_audit)")
+    parser.add_argument("--risultati-per-parte", type=int, help="dividi l'export in più ZIP con al massimo N risultati")
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.join(CARTELLA_EXPORT, nome_file_export(args.ente, args.dal, args.al))
+
+    def stampa(fatti, totale):
+        if fatti % 100 == 0 or fatti == totale:
+            print(f"\r{fatti}/{totale}", end="", file=sys.stderr)
+
+    conteggi = esporta_audit(output, args.ente, args.dal, args.al, args.indice, not args.senza_badge, stampa,
+                             risultati_per_parte=args.risultati_per_parte)
+    print(
+        f"\n{', '.join(conteggi['file'])}: {conteggi['risultati']} risultati, {conteggi['report']} report, "
+        f"{conteggi['badge']} badge, {conteggi['errori']} senza record di riproduzione",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
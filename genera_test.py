@@ -0,0 +1,197 @@
+"""Generatore da riga di comando di test finali cartacei (una variante per partecipante).
+
+Esempio:
+    python genera_test.py --banca banche_dati_quiz/FORM_Preposti.csv --argomento Preposti \
+        --n-domande 30 --partecipanti iscritti.csv --output sessione.zip
+
+Ogni variante è ottenuta con la stessa derivazione SHA-256 del seed usata
+dall'app: inserendo il seed riportato in chiavi_risposte.csv nel campo
+"Seed casuale" si ottiene lo stesso test. I PDF sono generati in parallelo
+su un pool di processi.
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import pandas as pd
+
+from archivio_report import componente_nome_file
+from banca_dati import BancaNonValida, carica_banca
+from report_pdf import build_exam_pdf
+from test_finale import estrai_test
+
+LETTERE = "ABCD"
+COLONNE_CHIAVI = ["partecipante", "seed", "file", "n", "codice", "risposta_corretta", "corretta_banca"]
+
+# stato dei processi del pool (impostato da _init_worker)
+_df_topic = None
+_parametri = None
+
+
+def _init_worker(banca_path: str, argomento: str, parametri: dict):
+    global _df_topic, _parametri
+    _df_topic = carica_banca(banca_path).df_argomento(argomento)
+    _parametri = parametri
+
+
+def genera_variante(df_topic: pd.DataFrame, nome: str, seed_str: str, parametri: dict):
+    """Ritorna (pdf_bytes, righe_chiave) per un partecipante."""
+    quiz_df, quiz_options, quiz_correct_idx = estrai_test(df_topic, parametri["n_domande"], seed_str)
+    pdf = build_exam_pdf(
+        nome=nome,
+        corso=parametri["corso"],
+        argomento=parametri["argomento"],
+        data_test=parametri["data_test"],
+        codice_variante=seed_str,
+        quiz_df=quiz_df,
+        quiz_options=quiz_options,
+    )
+    chiave = []
+    righe = zip(quiz_df["codice"].tolist(), quiz_df["corretta"].tolist(), quiz_correct_idx)
+    for i, (codice, corretta, idx) in enumerate(righe):
+        chiave.append({
+            "partecipante": nome,
+            "seed": seed_str,
+            "n": i + 1,
+            "codice": codice,
+            "risposta_corretta": LETTERE[idx] if idx is not None else "",
+            "corretta_banca": corretta,
+        })
+    return pdf, chiave
+
+
+def _task(job):
+    n, nome, seed_str = job
+    pdf, chiave = genera_variante(_df_topic, nome, seed_str, _parametri)
+    nome_file = f"{n:04d}_{componente_nome_file(nome, 'partecipante')}_test_finale.pdf"
+    for r in chiave:
+        r["file"] = nome_file
+    return nome_file, pdf, chiave
+
+
+def leggi_partecipanti(path: str):
+    """Lista di (nome, seed) da CSV (colonne 'nome' e opzionale 'seed') o da file di testo (un nome per riga)."""
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path, dtype=str, keep_default_na=False)
+        col_nome = "nome" if "nome" in df.columns else df.columns[0]
+        seeds = df["seed"] if "seed" in df.columns else [""] * len(df)
+        return [(n.strip(), s.strip()) for n, s in zip(df[col_nome], seeds) if n.strip()]
+    with open(path, encoding="utf-8") as f:
+        return [(riga.strip(), "") for riga in f if riga.strip()]
+
+
+def prepara_jobs(partecipanti, seeds, varianti: int, seed_base: str):
+    """Assegna a ogni partecipante (o variante anonima) il proprio seed."""
+    jobs = []
+    if partecipanti:
+        for n, (nome, seed_str) in enumerate(partecipanti, start=1):
+            jobs.append((n, nome, seed_str or f"{seed_base}-{n:04d}"))
+    elif seeds:
+        for n, seed_str in enumerate(seeds, start=1):
+            jobs.append((n, "", seed_str))
+    else:
+        for n in range(1, varianti + 1):
+            jobs.append((n, "", f"{seed_base}-{n:04d}"))
+    return jobs
+
+
+class _Destinazione:
+    """Scrittura dei PDF in un archivio ZIP o in una cartella."""
+
+    def __init__(self, output: str):
+        self.zip = None
+        self.cartella = None
+        if output.lower().endswith(".zip"):
+            # i PDF sono già compressi internamente: ZIP_STORED evita di ricomprimerli
+            self.zip = zipfile.ZipFile(output, "w", compression=zipfile.ZIP_STORED)
+        else:
+            os.makedirs(output, exist_ok=True)
+            self.cartella = output
+
+    def scrivi(self, nome_file: str, data: bytes):
+        if self.zip is not None:
+            self.zip.writestr(nome_file, data)
+        else:
+            with open(os.path.join(self.cartella, nome_file), "wb") as f:
+                f.write(data)
+
+    def chiudi(self):
+        if self.zip is not None:
+            self.zip.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera test finali cartacei, una variante per partecipante.")
+    parser.add_argument("--banca", required=True, help="CSV della banca domande")
+    parser.add_argument("--argomento", required=True, help="argomento / modulo da cui estrarre le domande")
+    parser.add_argument("--n-domande", type=int, default=30)
+    gruppo = parser.add_mutually_exclusive_group(required=True)
+    gruppo.add_argument("--partecipanti", help="CSV (colonne nome[, seed]) o file di testo con un nome per riga")
+    gruppo.add_argument("--seed", action="append", help="seed di una variante (ripetibile)")
+    gruppo.add_argument("--varianti", type=int, help="numero di varianti anonime da generare")
+    parser.add_argument("--seed-base", default="", help="prefisso dei seed generati (default: data-argomento)")
+    parser.add_argument("--corso", default="")
+    parser.add_argument("--data-test", default=date.today().isoformat(), help="AAAA-MM-GG")
+    parser.add_argument("--output", required=True, help="file .zip o cartella di destinazione")
+    parser.add_argument("--processi", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+
+    try:
+        banca = carica_banca(args.banca)
+    except BancaNonValida as e:
+        parser.error(str(e))
+    if args.argomento not in banca.indice_argomenti:
+        parser.error(f"Argomento '{args.argomento}' non presente. Disponibili: {', '.join(map(str, banca.argomenti))}")
+
+    data_test = date.fromisoformat(args.data_test)
+    seed_base = args.seed_base or f"{data_test.isoformat()}-{args.argomento}"
+    partecipanti = leggi_partecipanti(args.partecipanti) if args.partecipanti else None
+    jobs = prepara_jobs(partecipanti, args.seed, args.varianti or 0, seed_base)
+
+    parametri = {
+        "n_domande": args.n_domande,
+        "corso": args.corso,
+        "argomento": args.argomento,
+        "data_test": data_test,
+    }
+
+    t0 = time.perf_counter()
+    dest = _Destinazione(args.output)
+    chiavi = []
+    try:
+        if args.processi <= 1:
+            _init_worker(banca.path, args.argomento, parametri)
+            for nome_file, pdf, chiave in map(_task, jobs):
+                dest.scrivi(nome_file, pdf)
+                chiavi.extend(chiave)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=args.processi,
+                initializer=_init_worker,
+                initargs=(banca.path, args.argomento, parametri),
+            ) as pool:
+                chunksize = max(1, len(jobs) // (args.processi * 4))
+                for nome_file, pdf, chiave in pool.map(_task, jobs, chunksize=chunksize):
+                    dest.scrivi(nome_file, pdf)
+                    chiavi.extend(chiave)
+
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=COLONNE_CHIAVI)
+        writer.writeheader()
+        writer.writerows(chiavi)
+        dest.scrivi("chiavi_risposte.csv", buf.getvalue().encode("utf-8"))
+    finally:
+        dest.chiudi()
+
+    print(f"{len(jobs)} varianti generate in {time.perf_counter() - t0:.2f}s -> {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
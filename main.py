@@ -1,45 +1,31 @@
 import streamlit as st
-import pandas as pd
-from datetime import date, datetime
-import random
+from datetime import date
 import os
-import glob
-import hashlib
-import io
-import smtplib
-import ssl
-from email.mime.base import MIMEBase
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email import encoders
-
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4, landscape
+import runpy
+import time
+
+# Solo moduli leggeri prima del login: pandas, banche, PDF (reportlab) ed
+# email (smtplib, MIME) si importano dopo il login o alla prima correzione.
+from metriche import MAX_CAMPIONI, ProfiloSessione, misura, registra, riepilogo
+from utenti import FileUtentiNonValido, ancora_valido, autentica, carica_utenti, impronta_password
+
+# Profilazione cProfile opt-in (attivabile dal pannello metriche, solo per questa sessione):
+# lo script viene rieseguito per intero dentro il profilo, nello stesso thread del rerun.
+profilo_sessione = st.session_state.get("profilo_sessione")
+if profilo_sessione is not None and not profilo_sessione.attivo:
+    with profilo_sessione.rerun():
+        runpy.run_path(__file__, run_name="__main__")
+    st.stop()
 
 st.set_page_config(page_title="Test finale Formazione Sicurezza", page_icon="📝", layout="wide")
 
-# ============================================================
-# COSTANTI
-# ============================================================
-SOGLIA_SUPERAMENTO = 80.0
-RISULTATI_CSV = "risultati_test_finale.csv"
+t_rerun = time.perf_counter()
 
 # ============================================================
-# CSS
+# COSTANTI
 # ============================================================
-st.markdown("""
-<style>
-:root { --brand:#0f766e; --muted:#6b7280; --soft:#e5e7eb; --danger:#b91c1c; --danger-bg:#fee2e2; }
-.block-container { padding-top: 1rem; }
-h1,h2,h3 { letter-spacing: .2px; }
-div[role="radiogroup"] > label {
-  padding: 6px 10px; border: 1px solid var(--soft); border-radius: 8px; margin-right: 6px; margin-bottom: 6px;
-}
-[data-testid="stMetricValue"] { color: var(--brand); }
-.badge-nc { background:#b91c1c; color:#fff; padding:4px 8px; border-radius:999px; font-size:12px; font-weight:700; }
-.ref { color:#666; font-size:12px; font-size:12px; }
-</style>
-""", unsafe_allow_html=True)
+RUOLI_STAFF = {"Docente", "RSPP"}
+RUOLI_ADMIN = {"RSPP"}
 
 st.title("📝 Test finale formazione sicurezza sul lavoro")
 
@@ -47,244 +33,89 @@ st.title("📝 Test finale formazione sicurezza sul lavoro")
 # FUNZIONI UTILI
 # ============================================================
 
-@st.cache_data
-def list_quiz_files(base_folder: str = "banche_dati_quiz"):
-    """Ritorna lista di (label, path_assoluto) per tutti i CSV nella cartella indicata."""
-    pattern = os.path.join(base_folder, "*.csv")
-    files = glob.glob(pattern)
-    quiz_files = []
-    for f in sorted(files):
-        name = os.path.basename(f)
-        label = os.path.splitext(name)[0]  # nome file senza .csv
-        quiz_files.append((label, f))
-    return quiz_files
-
-
-@st.cache_data
-def load_users():
-    try:
-        df_users = pd.read_csv("utenti_test_finale.csv")
-    except FileNotFoundError:
-        # fallback per compatibilità se il file si chiama ancora utenti_quiz.csv
-        try:
-            df_users = pd.read_csv("utenti_quiz.csv")
-        except FileNotFoundError:
-            st.error("File 'utenti_test_finale.csv' (o 'utenti_quiz.csv') non trovato. Crealo nella stessa cartella dell'app.")
-            return pd.DataFrame()
-
-    required_cols = {"username", "password"}
-    if not required_cols.issubset(set(df_users.columns)):
-        st.error("Il file utenti deve contenere almeno le colonne: username, password.")
-        return pd.DataFrame()
-
-    return df_users
-
-
-def get_icon(esito: str) -> str:
-    esito = esito.upper()
-    if esito == "CORRETTA":
-        return "✅"
-    if esito == "ERRATA":
-        return "❌"
-    return "⚠️"
-
-
-def build_test_pdf(
-    nome: str,
-    corso: str,
-    argomento: str,
-    data_test: date,
-    punteggio: int,
-    percentuale: float,
-    superato: bool,
-    quiz_df: pd.DataFrame,
-    quiz_options,
-    risposte_utente
-) -> bytes:
-    """Genera un PDF con riepilogo completo del test finale (domande, risposte date, correttezza)."""
-    buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=A4)
-    width, height = A4
-
-    y = height - 50
-
-    titolo = "Report Test finale formazione sicurezza"
-    c.setFont("Helvetica-Bold", 16)
-    c.setFillColorRGB(0, 0, 0)
-    c.drawString(50, y, titolo)
-    y -= 25
-
-    c.setFont("Helvetica", 10)
-    data_str = data_test.strftime("%d/%m/%Y") if isinstance(data_test, date) else str(data_test)
-    corso_o_argomento = corso or argomento or "-"
-    esito_txt = "SUPERATO" if superato else "NON SUPERATO"
-
-    c.drawString(50, y, f"Nome: {nome or '-'}")
-    y -= 15
-    c.drawString(50, y, f"Corso / Modulo: {corso_o_argomento}")
-    y -= 15
-    c.drawString(50, y, f"Data test finale: {data_str}")
-    y -= 15
-    c.drawString(50, y, f"Punteggio: {punteggio} / {len(quiz_df)} ({percentuale}%)")
-    y -= 15
-    c.drawString(50, y, f"Esito: {esito_txt} (soglia {SOGLIA_SUPERAMENTO}%)")
-    y -= 30
-
-    c.setFont("Helvetica-Bold", 12)
-    c.drawString(50, y, "Dettaglio domande test finale:")
-    y -= 20
-    c.setFont("Helvetica", 9)
-
-    for i, row in quiz_df.iterrows():
-        domanda = str(row["domanda"])
-        options = quiz_options[i]
-        scelta = risposte_utente[i]
-
-        # individua testo risposta corretta
-        corretta_label = str(row["corretta"]).strip().upper()
-        testo_corretta = ""
-        for lab, txt in options:
-            if lab == corretta_label:
-                testo_corretta = txt
-                break
-
-        # esito
-        if scelta is None:
-            esito = "NON RISPOSTA"
-        elif scelta == testo_corretta:
-            esito = "CORRETTA"
-        else:
-            esito = "ERRATA"
-
-        icon = get_icon(esito)
-
-        # nuova pagina se serve
-        if y < 100:
-            c.showPage()
-            c.setFont("Helvetica", 9)
-            y = height - 50
-
-        # Domanda (nero)
-        c.setFillColorRGB(0, 0, 0)
-        c.drawString(50, y, f"{i+1}. {domanda}")
-        y -= 12
-
-        # Esito (colorato)
-        if esito == "CORRETTA":
-            c.setFillColorRGB(0.0, 0.5, 0.0)  # verde
-        elif esito == "ERRATA":
-            c.setFillColorRGB(0.75, 0.0, 0.0)  # rosso
-        else:
-            c.setFillColorRGB(0.8, 0.5, 0.0)   # arancio
-
-        c.drawString(50, y, f"{icon} Esito: {esito}")
-        y -= 12
-        c.drawString(50, y, f"   Risposta data: {scelta if scelta else 'NON RISPOSTA'}")
-        y -= 12
-
-        # Risposta corretta (nero)
-        c.setFillColorRGB(0, 0, 0)
-        c.drawString(50, y, f"   Risposta corretta: {testo_corretta}")
-        y -= 16  # piccolo spazio extra tra domande
-
-    c.showPage()
-    c.save()
-    pdf_bytes = buf.getvalue()
-    buf.close()
-    return pdf_bytes
-
-
-def build_badge_pdf(nome: str, corso: str, data_test: date, percentuale: float) -> bytes:
-    """Badge semplice di superamento test finale (A4 orizzontale)."""
-    buf = io.BytesIO()
-    c = canvas.Canvas(buf, pagesize=landscape(A4))
-    width, height = landscape(A4)
-
-    c.setFillColorRGB(0.94, 0.97, 0.99)
-    c.rect(0, 0, width, height, fill=1, stroke=0)
+@st.cache_data(show_spinner=False, max_entries=4)
+def codici_in_piu_banche(firme):
+    """firme: ((label, path, versione), ...): il risultato resta valido finché nessuna banca cambia."""
+    return codici_condivisi([(label, carica_banca(path)) for label, path, _ in firme])
 
-    c.setFillColorRGB(0, 0, 0)
-    c.setFont("Helvetica-Bold", 22)
-    c.drawCentredString(width / 2, height - 70, "Badge superamento test finale")
 
-    c.setFont("Helvetica", 14)
-    c.drawCentredString(width / 2, height - 110, f"Nome: {nome or '-'}")
-    c.drawCentredString(width / 2, height - 140, f"Corso: {corso or '-'}")
+@st.cache_resource
+def get_outbox():
+    from outbox_email import Outbox
+    return Outbox()
 
-    data_str = data_test.strftime("%d/%m/%Y") if isinstance(data_test, date) else str(data_test)
-    c.drawCentredString(width / 2, height - 170, f"Data test finale: {data_str}")
-    c.drawCentredString(width / 2, height - 200, f"Punteggio: {percentuale}%")
 
-    c.setFont("Helvetica-Oblique", 10)
-    c.drawRightString(width - 40, 40, "Rilasciato automaticamente dal sistema di test finale sicurezza")
+def avvia_outbox_worker(email_conf):
+    from outbox_email import TrasportoSMTP, avvia_worker
 
-    c.showPage()
-    c.save()
-    pdf_bytes = buf.getvalue()
-    buf.close()
-    return pdf_bytes
+    # use_ssl = false con starttls = false: SMTP in chiaro (es. server locale di prova)
+    trasporto = TrasportoSMTP(
+        host=email_conf.get("smtp_host", "smtp.gmail.com"),
+        port=int(email_conf.get("smtp_port", 465)),
+        username=email_conf["sender"],
+        password=email_conf.get("password", ""),
+        use_ssl=bool(email_conf.get("use_ssl", True)),
+        starttls=bool(email_conf.get("starttls", True)),
+    )
+    periodico = None
+    if modalita_digest(email_conf):
+        from digest_email import controllo_periodico
+        periodico = controllo_periodico
+    return avvia_worker(trasporto, risolutore_allegati=risolvi_allegati, periodico=periodico)
 
 
-def salva_risultato_csv(riga: dict, path: str = RISULTATI_CSV):
-    df_row = pd.DataFrame([riga])
-    if os.path.exists(path):
-        try:
-            df_old = pd.read_csv(path)
-            df_new = pd.concat([df_old, df_row], ignore_index=True)
-        except Exception:
-            df_new = df_row
-    else:
-        df_new = df_row
-    df_new.to_csv(path, index=False)
+def modalita_digest(email_conf) -> bool:
+    """Con email.digest = true il destinatario fisso riceve un riepilogo per ente/corso/data."""
+    return bool(email_conf.get("digest", False))
 
 
-def send_email_with_attachments(subject: str, body: str, attachments, extra_to=None):
+def send_email_with_attachments(subject: str, body: str, attachments, extra_to=None, allegati_differiti=None,
+                                riga_digest=None):
     """
+    Accoda l'email nell'outbox su disco: l'invio avviene in background.
     attachments: lista di tuple (filename, bytes_data, mime_type)
     extra_to: lista di destinatari aggiuntivi
+    allegati_differiti: riferimenti ai report generati dal worker all'invio
+    riga_digest: risultato già salvato; in modalità digest il destinatario fisso
+    lo riceve nel riepilogo del gruppo e il messaggio va solo a extra_to
     """
     try:
         email_conf = st.secrets["email"]
         sender = email_conf["sender"]
         receiver = email_conf["receiver"]
-        password = email_conf["password"]
     except Exception:
         st.error("Configurazione email non trovata in st.secrets['email'].")
         return
 
-    to_addrs = [receiver]
+    digest = riga_digest is not None and modalita_digest(email_conf)
+    to_addrs = [] if digest else [receiver]
     if extra_to:
         to_addrs.extend([addr for addr in extra_to if addr])
 
-    msg = MIMEMultipart()
-    msg["From"] = sender
-    msg["To"] = ", ".join(to_addrs)
-    msg["Subject"] = subject
-
-    msg.attach(MIMEText(body, "plain"))
-
-    for filename, data_bytes, mime_type in attachments:
-        maintype, subtype = mime_type.split("/", 1)
-        part = MIMEBase(maintype, subtype)
-        part.set_payload(data_bytes)
-        encoders.encode_base64(part)
-        part.add_header("Content-Disposition", f'attachment; filename="{filename}"')
-        msg.attach(part)
-
     try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465, context=context) as server:
-            server.login(sender, password)
-            server.sendmail(sender, to_addrs, msg.as_string())
-        st.success("📧 Email inviata con successo.")
+        from outbox_email import accoda_email
+
+        avvia_outbox_worker(email_conf)
+        if digest:
+            from digest_email import accoda_per_digest
+
+            with misura("accoda_digest"):
+                accoda_per_digest(
+                    get_outbox(), riga_digest, sender, [receiver],
+                    finestra_s=60 * float(email_conf.get("digest_minuti", 15)),
+                )
+        if to_addrs:
+            with misura("accoda_email"):
+                accoda_email(get_outbox(), sender, to_addrs, subject, body, attachments, allegati_differiti)
+            st.success("📧 Email messa in coda per l'invio.")
+        else:
+            st.success("📧 Risultato incluso nel prossimo riepilogo email.")
     except Exception as e:
-        st.error(f"Errore nell'invio email: {e}")
+        st.error(f"Errore nell'accodamento email: {e}")
 
 # ============================================================
 # LOGIN
 # ============================================================
-df_users = load_users()
-
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 if "logged_user" not in st.session_state:
@@ -293,6 +124,23 @@ if "user_role" not in st.session_state:
     st.session_state.user_role = None
 if "user_ente" not in st.session_state:
     st.session_state.user_ente = None
+if "password_verificata" not in st.session_state:
+    st.session_state.password_verificata = None
+
+
+def chiudi_sessione():
+    st.session_state.logged_in = False
+    st.session_state.logged_user = None
+    st.session_state.user_role = None
+    st.session_state.user_ente = None
+    st.session_state.password_verificata = None
+
+
+# il KDF si calcola solo al login: a ogni rerun basta confrontare l'impronta della
+# password memorizzata con quella del file (ricaricato se modificato)
+if st.session_state.logged_in and not ancora_valido(st.session_state.logged_user, st.session_state.password_verificata or ""):
+    chiudi_sessione()
+    st.warning("Sessione chiusa: utente rimosso o password modificata nel file utenti.")
 
 with st.sidebar:
     st.header("Accesso riservato 🔐")
@@ -301,23 +149,68 @@ with st.sidebar:
     login_btn = st.button("Login")
 
     if login_btn:
-        if df_users is None or df_users.empty:
-            st.error("Nessun utente caricato. Verifica il file utenti.")
+        try:
+            with misura("login"):
+                utente = autentica(login_user, login_pwd)
+        except (OSError, FileUtentiNonValido) as e:
+            chiudi_sessione()
+            st.error(str(e))
         else:
-            row = df_users[df_users["username"] == login_user]
-            if not row.empty and str(row.iloc[0]["password"]) == login_pwd:
+            if utente is not None:
                 st.session_state.logged_in = True
-                st.session_state.logged_user = login_user
-                st.session_state.user_role = row.iloc[0].get("ruolo", "")
-                st.session_state.user_ente = row.iloc[0].get("ente", "")
+                st.session_state.logged_user = utente.username
+                st.session_state.user_role = utente.ruolo
+                st.session_state.user_ente = utente.ente
+                st.session_state.password_verificata = impronta_password(utente.password)
                 st.success(f"Accesso effettuato come: {login_user}")
             else:
-                st.session_state.logged_in = False
-                st.session_state.logged_user = None
-                st.session_state.user_role = None
-                st.session_state.user_ente = None
+                chiudi_sessione()
                 st.error("Credenziali non valide.")
 
+if not st.session_state.logged_in:
+    st.warning("Accesso riservato. Effettua il login dalla sidebar per utilizzare il test finale.")
+    registra("rerun_pagina_login", time.perf_counter() - t_rerun)
+    st.stop()
+
+# ============================================================
+# MODULI DELL'APP (caricati solo dopo il login)
+# ============================================================
+import pandas as pd
+
+from banca_dati import BancaNonValida, carica_banca, codici_condivisi, list_quiz_files
+from risultati import (
+    DIMENSIONI_ANALISI, codici_gia_estratti, errore_migrazione, leggi_aggregati_esiti, leggi_statistiche_domande, salva_risultato,
+)
+from test_finale import MAX_DOMANDE, MIN_DOMANDE, SOGLIA_SUPERAMENTO, posizione_corretta
+import motore
+from cache_consegne import CacheLRU
+from sessioni_aula import (
+    K_VARIANTI, MAX_VARIANTI, apri_sessione, assegna_variante, avanzamento, chiudi_sessione_aula, correggi_fogli,
+    leggi_sessione, sessioni_aperte,
+)
+from risultati import leggi_risultati, salva_risultati
+from archivio_report import genera_badge_superati, nome_file_report, pdf_report, risolvi_allegati
+from duplicati import gruppi_cartella
+from sequenziale import ALFA, BETA, MINIMO_DOMANDE, ParametriSPRT, arresto
+
+# ============================================================
+# CSS
+# ============================================================
+st.markdown("""
+<style>
+:root { --brand:#0f766e; --muted:#6b7280; --soft:#e5e7eb; --danger:#b91c1c; --danger-bg:#fee2e2; }
+.block-container { padding-top: 1rem; }
+h1,h2,h3 { letter-spacing: .2px; }
+div[role="radiogroup"] > label {
+  padding: 6px 10px; border: 1px solid var(--soft); border-radius: 8px; margin-right: 6px; margin-bottom: 6px;
+}
+[data-testid="stMetricValue"] { color: var(--brand); }
+.badge-nc { background:#b91c1c; color:#fff; padding:4px 8px; border-radius:999px; font-size:12px; font-weight:700; }
+.ref { color:#666; font-size:12px; font-size:12px; }
+</style>
+""", unsafe_allow_html=True)
+
+with st.sidebar:
     if st.session_state.logged_in:
         info = f"✅ Utente: **{st.session_state.logged_user}**"
         if st.session_state.user_role:
@@ -326,15 +219,323 @@ with st.sidebar:
             info += f" — Ente: **{st.session_state.user_ente}**"
         st.caption(info)
 
+        if st.session_state.user_role in RUOLI_ADMIN:
+            indice_utenti = carica_utenti()
+            if indice_utenti.in_chiaro:
+                st.caption(
+                    f"⚠️ {indice_utenti.in_chiaro} utenti con password in chiaro: "
+                    f"`python utenti.py --converti {os.path.basename(indice_utenti.path)}`"
+                )
+
+        if st.session_state.user_role in RUOLI_STAFF:
+            with st.expander("📧 Stato invio email"):
+                outbox = get_outbox()
+                conteggi = outbox.conteggi()
+                st.caption(
+                    f"In coda: {conteggi.get('in_coda', 0) + conteggi.get('in_invio', 0)} — "
+                    f"Inviate: {conteggi.get('inviata', 0)} — Fallite: {conteggi.get('fallita', 0)}"
+                )
+                from digest_email import in_attesa
+
+                n_digest = in_attesa(outbox)
+                if n_digest:
+                    st.caption(f"Consegne in attesa del riepilogo (digest): {n_digest}")
+                st.dataframe(outbox.elenco(limite=20), use_container_width=True, hide_index=True)
+                if conteggi.get("fallita", 0) and st.button("Riprova invii falliti"):
+                    outbox.riprova_falliti()
+                    try:
+                        avvia_outbox_worker(st.secrets["email"]).sveglia()
+                    except Exception:
+                        pass
+
+        if st.session_state.user_role in RUOLI_ADMIN:
+            with st.expander("⏱️ Metriche prestazioni"):
+                st.dataframe(pd.DataFrame(riepilogo()), use_container_width=True, hide_index=True)
+                st.caption(
+                    "Export periodico per processo: metriche_app.<pid>.prom (Prometheus) e metriche_app.<pid>.json. "
+                    f"p50/p95/max sulle ultime {MAX_CAMPIONI} misure, conteggio e totale dall'avvio."
+                )
+                profilo_attivo = st.toggle(
+                    "Profila questa sessione (cProfile)",
+                    value=st.session_state.get("profilo_sessione") is not None,
+                )
+                if profilo_attivo and st.session_state.get("profilo_sessione") is None:
+                    # il profilo parte dal prossimo rerun
+                    st.session_state.profilo_sessione = ProfiloSessione(
+                        f"{st.session_state.logged_user}_{int(time.time())}"
+                    )
+                elif not profilo_attivo and st.session_state.get("profilo_sessione") is not None:
+                    # il rerun in corso è ancora profilato e viene salvato alla fine
+                    profilo = st.session_state.profilo_sessione
+                    st.session_state.profilo_sessione = None
+                    st.caption(f"Ultimo profilo salvato in `{profilo.percorso(profilo.n_rerun + 1)}`")
+                if st.session_state.get("profilo_sessione") is not None:
+                    st.caption(f"Profili .pstats nella cartella `{st.session_state.profilo_sessione.cartella}`")
+
         if st.button("Logout"):
-            st.session_state.logged_in = False
-            st.session_state.logged_user = None
-            st.session_state.user_role = None
-            st.session_state.user_ente = None
-            st.experimental_rerun()
+            chiudi_sessione()
+            st.rerun()
 
-if not st.session_state.logged_in:
-    st.warning("Accesso riservato. Effettua il login dalla sidebar per utilizzare il test finale.")
+# ============================================================
+# ANALISI RISULTATI (staff): letta dagli aggregati, non dallo storico
+# ============================================================
+if st.session_state.user_role in RUOLI_STAFF and st.sidebar.toggle("📊 Analisi risultati"):
+    st.header("Analisi risultati test finale")
+    etichette_dimensioni = {
+        "argomento": "Argomento",
+        "banca_domande": "Banca domande",
+        "user_ente": "Ente",
+        "data_test": "Data test",
+    }
+    with misura("analisi_risultati"):
+        tabs = st.tabs([etichette_dimensioni[d] for d in DIMENSIONI_ANALISI] + ["Domande"])
+        for tab, dimensione in zip(tabs, DIMENSIONI_ANALISI):
+            with tab:
+                df_esiti = leggi_aggregati_esiti(dimensione)
+                if df_esiti.empty:
+                    st.info("Nessun risultato registrato.")
+                    continue
+                st.dataframe(df_esiti, use_container_width=True, hide_index=True)
+                st.bar_chart(df_esiti.set_index(dimensione)["tasso_superamento"])
+
+        with tabs[-1]:
+            df_domande = leggi_statistiche_domande()
+            if df_domande.empty:
+                st.info("Nessuna statistica per domanda disponibile.")
+            else:
+                banche_stat = sorted(df_domande["banca_domande"].unique())
+                banca_stat = st.selectbox("Banca domande", options=banche_stat)
+                df_domande = df_domande[df_domande["banca_domande"] == banca_stat]
+                min_presentazioni = st.number_input("Presentazioni minime", min_value=1, value=5, step=1)
+                df_domande = df_domande[df_domande["presentazioni"] >= min_presentazioni]
+                st.caption(
+                    "Indice di difficoltà = quota di risposte corrette (basso = domanda difficile). "
+                    "Distrattore principale = opzione errata più scelta (lettere della banca originale)."
+                )
+                st.dataframe(
+                    df_domande[[
+                        "codice", "presentazioni", "indice_difficolta", "quota_non_risposte", "corretta",
+                        "distrattore_principale", "scelte_a", "scelte_b", "scelte_c", "scelte_d",
+                    ]],
+                    use_container_width=True,
+                    hide_index=True,
+                )
+    st.stop()
+
+# ============================================================
+# RICERCA NELLE BANCHE (staff): indice invertito, ricostruito solo se una banca cambia
+# ============================================================
+if st.session_state.user_role in RUOLI_STAFF and st.sidebar.toggle("🔍 Cerca nelle banche"):
+    from ricerca_domande import LIMITE_RISULTATI, cerca
+
+    st.header("Ricerca nelle banche domande")
+    etichette_banche = [label for label, _ in list_quiz_files("banche_dati_quiz")]
+    col1, col2 = st.columns([3, 2])
+    with col1:
+        testo_ricerca = st.text_input(
+            "Cerca in domande, opzioni e riferimenti",
+            placeholder="es. dispositivi protezione, art. 37, preposto",
+        )
+    with col2:
+        banche_ricerca = st.multiselect("Banche", options=etichette_banche, placeholder="Tutte")
+    if testo_ricerca.strip():
+        t0 = time.perf_counter()
+        trovate = cerca(testo_ricerca, "banche_dati_quiz", banche=banche_ricerca or None)
+        st.caption(f"{len(trovate)} domande trovate in {(time.perf_counter() - t0) * 1000:.0f} ms "
+                   f"(al massimo {LIMITE_RISULTATI}, in ordine di pertinenza; 'scartata' = esclusa dall'estrazione)")
+        st.dataframe(trovate, use_container_width=True, hide_index=True)
+    st.stop()
+
+# ============================================================
+# EXPORT PER AUDIT (admin): ZIP scritto su disco a blocchi, un PDF alla volta
+# ============================================================
+if st.session_state.user_role in RUOLI_ADMIN and st.sidebar.toggle("🗂️ Export per audit"):
+    from export_audit import CARTELLA_EXPORT, FORMATI_INDICE, RISULTATI_PER_PARTE, esporta_audit, nome_file_export
+
+    st.header("Export per audit")
+    st.caption("Risultati filtrati con i report PDF (e i badge dei superati) e l'indice, in un unico ZIP.")
+    enti = [e for e in leggi_aggregati_esiti("user_ente")["user_ente"].tolist() if e]
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        ente_export = st.selectbox("Ente", options=["(tutti)"] + enti)
+    with col2:
+        dal_export = st.date_input("Test dal", value=None, format="DD/MM/YYYY")
+    with col3:
+        al_export = st.date_input("Test al", value=None, format="DD/MM/YYYY")
+    formato_export = st.radio("Indice", options=FORMATI_INDICE, horizontal=True, format_func=str.upper)
+    badge_export = st.checkbox("Includi i badge dei superati", value=True)
+
+    filtri_export = (
+        None if ente_export == "(tutti)" else ente_export,
+        dal_export.isoformat() if dal_export else None,
+        al_export.isoformat() if al_export else None,
+    )
+    if st.button("Prepara export"):
+        path_export = os.path.join(CARTELLA_EXPORT, nome_file_export(*filtri_export))
+        barra = st.progress(0.0, text="Preparazione export…")
+
+        def aggiorna_barra(fatti, totale):
+            if fatti % 25 == 0 or fatti == totale:
+                barra.progress(fatti / totale, text=f"{fatti}/{totale} risultati")
+
+        # il download della pagina legge il file intero in memoria: export in parti
+        # di al massimo RISULTATI_PER_PARTE risultati (per un solo ZIP: export_audit.py o /api/export)
+        conteggi = esporta_audit(path_export, *filtri_export, formato_indice=formato_export,
+                                 badge=badge_export, avanzamento=aggiorna_barra,
+                                 risultati_per_parte=RISULTATI_PER_PARTE)
+        barra.empty()
+        st.session_state.export_audit = conteggi
+
+    if st.session_state.get("export_audit"):
+        conteggi = st.session_state.export_audit
+        st.success(
+            f"{conteggi['risultati']} risultati — {conteggi['report']} report, {conteggi['badge']} badge"
+            + (f" — {conteggi['errori']} senza record di riproduzione (vedi colonna note)" if conteggi["errori"] else "")
+        )
+        if len(conteggi["file"]) > 1:
+            st.caption(f"Export diviso in {len(conteggi['file'])} ZIP da al massimo {RISULTATI_PER_PARTE} risultati, "
+                       "ognuno con il suo indice.")
+
+        def leggi_export(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        for path_export in conteggi["file"]:
+            if not os.path.exists(path_export):
+                continue
+            st.download_button(
+                f"⬇️ Scarica {os.path.basename(path_export)} ({os.path.getsize(path_export) / 1e6:.1f} MB)",
+                data=lambda path=path_export: leggi_export(path),
+                file_name=os.path.basename(path_export),
+                mime="application/zip",
+                on_click="ignore",
+                key=f"scarica_{path_export}",
+            )
+    st.stop()
+
+# ============================================================
+# SESSIONI D'AULA (staff): pool di varianti estratto una volta all'apertura
+# ============================================================
+if st.session_state.user_role in RUOLI_STAFF and st.sidebar.toggle("🎓 Sessioni d'aula"):
+    st.header("Sessioni d'aula")
+    quiz_files = list_quiz_files("banche_dati_quiz")
+    if not quiz_files:
+        st.error("Nessuna banca domande trovata nella cartella 'banche_dati_quiz'.")
+        st.stop()
+
+    with st.expander("➕ Apri una nuova sessione", expanded=True):
+        label_aula = st.selectbox("Banca domande", options=[label for label, _ in quiz_files], key="aula_banca")
+        try:
+            banca_aula = carica_banca(dict(quiz_files)[label_aula])
+        except BancaNonValida as e:
+            st.error(str(e))
+            st.stop()
+        with st.form("form_apri_sessione"):
+            argomento_aula = st.selectbox("Argomento / modulo", options=banca_aula.argomenti)
+            col1, col2 = st.columns(2)
+            n_domande_aula = col1.number_input(
+                "Numero domande", min_value=MIN_DOMANDE, max_value=MAX_DOMANDE, value=30, step=1
+            )
+            k_aula = col2.number_input(
+                "Varianti del test", min_value=1, max_value=MAX_VARIANTI, value=K_VARIANTI, step=1,
+                help="Estratte una volta all'apertura e assegnate a rotazione ai partecipanti.",
+            )
+            corso_aula = st.text_input("Corso / Modulo (es. Formazione generale 4h)")
+            data_aula = st.date_input("Data test finale", value=date.today())
+            apri = st.form_submit_button("Apri sessione")
+        if apri:
+            with misura("apri_sessione_aula"):
+                nuova_sessione = apri_sessione(
+                    banca_aula, label_aula, argomento_aula, int(n_domande_aula), int(k_aula),
+                    docente=st.session_state.logged_user, ente=st.session_state.user_ente or "",
+                    corso=corso_aula, data_test=data_aula.isoformat(),
+                )
+            st.success(f"Sessione aperta: codice **{nuova_sessione.codice}** ({nuova_sessione.k_varianti} varianti)")
+
+    aperte = sessioni_aperte(None if st.session_state.user_role in RUOLI_ADMIN else st.session_state.logged_user)
+    if aperte.empty:
+        st.info("Nessuna sessione aperta.")
+        st.stop()
+    codice_sel = st.selectbox(
+        "Sessione",
+        options=aperte["codice"].tolist(),
+        format_func=lambda c: " — ".join(
+            str(v) for v in aperte.loc[aperte["codice"] == c, ["codice", "argomento", "corso", "aperta_il"]].iloc[0] if v
+        ),
+    )
+    sessione_sel = leggi_sessione(codice_sel)
+
+    @st.fragment(run_every=5)
+    def mostra_avanzamento(codice):
+        stato_aula = avanzamento(codice)
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Partecipanti entrati", stato_aula["entrati"])
+        col2.metric("Consegne", stato_aula["consegne"])
+        col3.metric("Superati", stato_aula["superati"])
+        col4.metric("Punteggio medio %", "-" if stato_aula["percentuale_media"] is None else stato_aula["percentuale_media"])
+
+    st.subheader(f"Codice sessione: {codice_sel}")
+    st.caption(
+        f"{sessione_sel.banca_domande} — {sessione_sel.argomento} — {sessione_sel.n_domande} domande, "
+        f"{sessione_sel.k_varianti} varianti (seed {codice_sel}-1 … {codice_sel}-{sessione_sel.k_varianti})"
+    )
+    mostra_avanzamento(codice_sel)
+
+    df_aula = leggi_risultati("sessione_aula = ?", (codice_sel,))
+    if not df_aula.empty:
+        st.dataframe(
+            df_aula[["timestamp", "nome_partecipante", "email_partecipante", "punteggio", "n_domande", "percentuale", "superato", "seed"]],
+            use_container_width=True,
+            hide_index=True,
+        )
+        st.download_button(
+            "⬇️ Scarica risultati della sessione (CSV)",
+            data=df_aula.drop(columns=["risposte_domande", "riproduzione"], errors="ignore").to_csv(index=False).encode("utf-8"),
+            file_name=f"sessione_{codice_sel}.csv",
+            mime="text/csv",
+        )
+        if df_aula["superato"].astype(str).str.strip().str.lower().isin(["1", "true"]).any():
+            st.download_button(
+                "⬇️ Scarica badge dei superati (un PDF)",
+                data=lambda: genera_badge_superati(df_aula.to_dict(orient="records")),
+                file_name=f"badge_sessione_{codice_sel}.pdf",
+                mime="application/pdf",
+                on_click="ignore",
+            )
+
+    with st.expander("📄 Correzione in blocco di fogli cartacei"):
+        st.caption("CSV con colonne nome, risposte e variante (1..K) o seed; email facoltativa.")
+        fogli = st.file_uploader("Fogli risposte", type="csv", key=f"fogli_{codice_sel}")
+        if fogli is not None and st.button("Correggi e salva"):
+            try:
+                banca_fogli = carica_banca(sessione_sel.path_banca)
+                with misura("correzione_fogli_aula"):
+                    df_fogli = correggi_fogli(
+                        sessione_sel, banca_fogli, pd.read_csv(fogli, dtype=str, keep_default_na=False),
+                        {"login_user": st.session_state.logged_user, "user_ente": st.session_state.user_ente or ""},
+                    )
+                    n_salvate = salva_risultati(df_fogli.to_dict(orient="records"))
+                st.success(
+                    f"{n_salvate} consegne corrette e salvate ({int(df_fogli['superato'].sum())} superate), "
+                    f"{len(df_fogli) - n_salvate} già presenti nell'archivio."
+                )
+            except (BancaNonValida, ValueError, KeyError) as e:
+                st.error(f"Correzione non riuscita: {e}")
+
+    if st.button("🔒 Chiudi sessione (nessun nuovo ingresso)"):
+        chiudi_sessione_aula(codice_sel)
+        try:
+            email_conf = st.secrets["email"]
+        except Exception:
+            email_conf = {}
+        if modalita_digest(email_conf):
+            # il riepilogo della sessione parte subito, senza attendere la finestra
+            from digest_email import chiudi_finestra_sessione, invia_digest_pronti
+
+            chiudi_finestra_sessione(get_outbox(), codice_sel)
+            invia_digest_pronti(get_outbox())
+            avvia_outbox_worker(email_conf).sveglia()
+        st.rerun()
     st.stop()
 
 # ============================================================
@@ -348,177 +549,366 @@ with st.sidebar:
         st.error("Nessuna banca domande trovata nella cartella 'banche_dati_quiz'.")
         st.stop()
 
-    labels = [label for label, _ in quiz_files]
-    selected_label = st.selectbox("Seleziona banca domande", options=labels)
-    selected_path = dict(quiz_files)[selected_label]
+    # Sessione d'aula: banca, argomento e numero domande li ha scelti il docente
+    codice_aula = st.text_input("Codice sessione d'aula (se fornito dal docente)", key="codice_aula")
+    codice_aula = codice_aula.strip().upper()
+    sessione_aula = None
+    if codice_aula:
+        # chi ha già ricevuto la variante può consegnare anche se nel frattempo la sessione è stata chiusa
+        sessione_aula = leggi_sessione(codice_aula, anche_chiusa=st.session_state.get("quiz_aula") == codice_aula)
+        if sessione_aula is None:
+            st.error("Codice sessione non valido o sessione chiusa.")
+
+    if sessione_aula is not None:
+        selected_label = sessione_aula.banca_domande
+        selected_path = sessione_aula.path_banca
+        st.caption(f"Sessione d'aula **{sessione_aula.codice}**: {selected_label} — {sessione_aula.argomento}")
+    else:
+        labels = [label for label, _ in quiz_files]
+        selected_label = st.selectbox("Seleziona banca domande", options=labels)
+        selected_path = dict(quiz_files)[selected_label]
 
-    st.caption(f"File selezionato: `{selected_path}`")
-    st.caption("Formato richiesto: argomento, codice, domanda, opzione_a, opzione_b, opzione_c, opzione_d, corretta, riferimento")
+        st.caption(f"File selezionato: `{selected_path}`")
+        st.caption("Formato richiesto: argomento, codice, domanda, opzione_a, opzione_b, opzione_c, opzione_d, corretta, riferimento")
 
     st.divider()
     st.header("Dati partecipante")
     nome = st.text_input("Nome e cognome")
     email_partecipante = st.text_input("Email partecipante (facoltativa)")
-    corso = st.text_input("Corso / Modulo (es. Formazione generale 4h)", value="")
-    data_test = st.date_input("Data test finale", value=date.today())
+    if sessione_aula is not None:
+        corso = sessione_aula.corso
+        data_test = date.fromisoformat(sessione_aula.data_test) if sessione_aula.data_test else date.today()
+    else:
+        corso = st.text_input("Corso / Modulo (es. Formazione generale 4h)", value="")
+        data_test = st.date_input("Data test finale", value=date.today())
 
     st.divider()
-    n_domande = st.number_input("Numero domande da estrarre", min_value=10, max_value=50, value=30, step=1)
-    seed = st.text_input("Seed casuale (facoltativo, per avere sempre lo stesso test finale)", value="")
-
-# Lettura banca domande
+    if sessione_aula is not None:
+        n_domande = sessione_aula.n_domande
+        seed = ""
+        testo_strati = ""
+        escludi_precedenti = False
+        una_per_gruppo = False
+        adattivo = None
+    else:
+        n_domande = st.number_input(
+            "Numero domande da estrarre", min_value=MIN_DOMANDE, max_value=MAX_DOMANDE, value=30, step=1
+        )
+        seed = st.text_input("Seed casuale (facoltativo, per avere sempre lo stesso test finale)", value="")
+
+        with st.expander("Estrazione stratificata / ritentativi"):
+            testo_strati = st.text_area(
+                "Strati (uno per riga, 'argomento o riferimento: numero')",
+                value="",
+                placeholder="Art. 18-20: 10\nDVR: 5",
+                help="Un filtro è il nome di un argomento oppure un testo cercato nei riferimenti; "
+                     "'Art. 18-20' comprende Art. 18, 19 e 20. Se compilato sostituisce il numero domande.",
+            )
+            escludi_precedenti = st.checkbox(
+                "Escludi le domande già proposte al partecipante",
+                help="Usa lo storico dei risultati (per email, altrimenti per nome); "
+                     "le domande già viste tornano solo se non ce ne sono altre.",
+            )
+            una_per_gruppo = st.checkbox(
+                "Al massimo una domanda per gruppo di quasi duplicati",
+                help="Le domande riformulate o copiate (stesso testo e stessa risposta corretta) "
+                     "non compaiono due volte nello stesso test.",
+            )
+
+        with st.expander("Test adattivo (arresto anticipato)"):
+            adattivo = None
+            if st.checkbox(
+                "Domande una alla volta, esito appena è statisticamente certo",
+                help="Dopo ogni risposta un test sequenziale (SPRT) decide se il partecipante è sopra o "
+                     f"sotto la soglia del {SOGLIA_SUPERAMENTO}%; il numero domande diventa il massimo.",
+            ):
+                minimo = st.number_input("Domande minime prima dell'esito", min_value=1, max_value=MAX_DOMANDE,
+                                         value=MINIMO_DOMANDE, step=1)
+                alfa = st.number_input("Errore ammesso: superare da non preparato", min_value=0.01,
+                                       max_value=0.25, value=ALFA, step=0.01)
+                beta = st.number_input("Errore ammesso: non superare da preparato", min_value=0.01,
+                                       max_value=0.25, value=BETA, step=0.01)
+                adattivo = ParametriSPRT(alfa=alfa, beta=beta, minimo=int(minimo))
+
+# Lettura banca domande (compilata e condivisa tra le sessioni, riletta solo se il file cambia)
 try:
-    df = pd.read_csv(selected_path)
-except Exception as e:
-    st.error(f"Errore nella lettura del CSV '{selected_path}': {e}")
+    with misura("carica_banca"):
+        banca = carica_banca(selected_path)
+except BancaNonValida as e:
+    st.error(str(e))
     st.stop()
 
-required_cols = {"argomento", "codice", "domanda", "opzione_a", "opzione_b", "opzione_c", "opzione_d", "corretta"}
-if not required_cols.issubset(set(df.columns)):
-    st.error(f"Il CSV deve contenere almeno queste colonne: {', '.join(required_cols)}")
-    st.stop()
-
-argomenti = sorted(df["argomento"].dropna().unique().tolist())
-argomento_scelto = st.selectbox("Seleziona l'argomento / modulo di formazione", options=argomenti)
-df_topic = df[df["argomento"] == argomento_scelto].copy()
-
-if df_topic.empty:
+# Rapporto di validazione: calcolato alla compilazione, una volta per versione della banca
+if st.session_state.user_role in RUOLI_STAFF:
+    problemi = banca.problemi
+    n_avvisi = int((problemi["gravita"] == "avviso").sum())
+    with st.sidebar.expander(f"🔎 Validazione banca: {int(banca.scartate.sum())} righe scartate, {n_avvisi} avvisi"):
+        st.caption("Le righe con errori sono escluse dall'estrazione finché il CSV non viene corretto.")
+        st.dataframe(problemi, use_container_width=True, hide_index=True)
+        firme = []
+        for label, path in quiz_files:
+            try:
+                firme.append((label, path, carica_banca(path).versione))
+            except BancaNonValida:
+                pass
+        condivisi = codici_in_piu_banche(tuple(firme))
+        condivisi = condivisi[condivisi["codice"].isin(banca.indice_codici.keys())]
+        if not condivisi.empty:
+            st.caption("Codici presenti anche in altre banche")
+            st.dataframe(condivisi, use_container_width=True, hide_index=True)
+        with misura("duplicati_cartella"):
+            gruppi = gruppi_cartella("banche_dati_quiz")
+        gruppi = gruppi[gruppi["gruppo"].isin(gruppi.loc[gruppi["banca"] == selected_label, "gruppo"])]
+        if not gruppi.empty:
+            st.caption(f"Domande quasi duplicate: {gruppi['gruppo'].nunique()} gruppi")
+            st.dataframe(gruppi, use_container_width=True, hide_index=True)
+
+argomenti = banca.argomenti
+if sessione_aula is not None:
+    argomento_scelto = sessione_aula.argomento
+else:
+    argomento_scelto = st.selectbox("Seleziona l'argomento / modulo di formazione", options=argomenti)
+righe_topic = banca.righe_argomento(argomento_scelto)
+
+if len(righe_topic) == 0:
     st.warning("Nessuna domanda per l'argomento selezionato.")
     st.stop()
 
-st.write(f"**Argomento selezionato:** {argomento_scelto} — Domande disponibili: {len(df_topic)}")
-
-# Stato test
-if "quiz_df" not in st.session_state:
-    st.session_state.quiz_df = None
-    st.session_state.quiz_options = None
-    st.session_state.quiz_correct_idx = None
+st.write(f"**Argomento selezionato:** {argomento_scelto} — Domande disponibili: {len(righe_topic)}")
+
+# Stato test: per sessione solo posizioni di riga nella banca e permutazione
+# delle opzioni; i testi si risolvono dalla banca condivisa.
+if "quiz_righe" not in st.session_state:
+    st.session_state.quiz_righe = None
+    st.session_state.quiz_perm = None
+    st.session_state.quiz_banca = None
+    st.session_state.quiz_versione = None
+    st.session_state.quiz_aula = None     # codice della sessione d'aula da cui viene il test
+    st.session_state.quiz_seed = ""
+    st.session_state.quiz_sprt = None     # ParametriSPRT del test adattivo, None per il test classico
+    st.session_state.quiz_esiti_seq = []  # test adattivo: correttezza delle risposte confermate
+    st.session_state.quiz_risposte_seq = []
+    st.session_state.quiz_chiave_seq = None  # test adattivo: chiave della consegna fatta alla decisione
+if "varianti_aula" not in st.session_state:
+    st.session_state.varianti_aula = {}  # codice sessione -> variante assegnata a questo partecipante
+
+# entrando in una sessione d'aula (o uscendone) il test in corso non vale più
+if st.session_state.quiz_righe is not None and st.session_state.quiz_aula != (sessione_aula.codice if sessione_aula else None):
+    st.session_state.quiz_righe = None
 
 def prepara_test():
-    seed_str = seed.strip()
-    seed_int = None
-    if seed_str:
-        seed_int = int(hashlib.sha256(seed_str.encode("utf-8")).hexdigest(), 16) % (2**32)
-
-    n = min(n_domande, len(df_topic))
-    if seed_int is not None:
-        quiz_df = df_topic.sample(n=n, random_state=seed_int).reset_index(drop=True)
-        random.seed(seed_int)
-    else:
-        quiz_df = df_topic.sample(n=n, random_state=None).reset_index(drop=True)
-
-    quiz_options = []
-    quiz_correct_idx = []
-
-    for _, row in quiz_df.iterrows():
-        options = [
-            ("A", row["opzione_a"]),
-            ("B", row["opzione_b"]),
-            ("C", row["opzione_c"]),
-            ("D", row["opzione_d"]),
-        ]
-        random.shuffle(options)
-        corretta_label = str(row["corretta"]).strip().upper()
-        correct_idx = next(
-            (i for i, (lab, _) in enumerate(options) if lab == corretta_label),
-            None
+    codici_visti = ()
+    if escludi_precedenti:
+        codici_visti = codici_gia_estratti(selected_label, nome=nome, email=email_partecipante)
+    try:
+        righe, permutazioni = motore.estrai(
+            banca, argomento_scelto, n_domande, seed, testo_strati, codici_visti, una_per_gruppo=una_per_gruppo,
         )
-        quiz_options.append(options)
-        quiz_correct_idx.append(correct_idx)
+    except motore.RichiestaNonValida as e:
+        st.warning(str(e))
+        return
 
-    st.session_state.quiz_df = quiz_df
-    st.session_state.quiz_options = quiz_options
-    st.session_state.quiz_correct_idx = quiz_correct_idx
+    st.session_state.quiz_righe = righe
+    st.session_state.quiz_perm = permutazioni
+    st.session_state.quiz_banca = banca.path
+    st.session_state.quiz_versione = banca.versione
+    st.session_state.quiz_aula = None
+    st.session_state.quiz_seed = seed
+    st.session_state.quiz_sprt = adattivo
+    st.session_state.quiz_esiti_seq = []
+    st.session_state.quiz_risposte_seq = []
+    st.session_state.quiz_chiave_seq = None
+
+
+def ricevi_variante_aula():
+    """Variante del pool già estratto: una sola per partecipante, assegnata in O(1)."""
+    if not sessione_aula.compatibile(banca):
+        st.error("La banca domande è stata modificata dopo l'apertura della sessione: chiedi al docente di aprirne una nuova.")
+        return
+    variante = st.session_state.varianti_aula.get(sessione_aula.codice)
+    if variante is None:
+        variante = assegna_variante(sessione_aula)
+        if variante is None:
+            st.error("La sessione d'aula è stata chiusa.")
+            return
+        st.session_state.varianti_aula[sessione_aula.codice] = variante
+
+    righe, permutazioni = sessione_aula.variante(variante)
+    st.session_state.quiz_righe = righe
+    st.session_state.quiz_perm = permutazioni
+    st.session_state.quiz_banca = banca.path
+    st.session_state.quiz_versione = banca.versione
+    st.session_state.quiz_aula = sessione_aula.codice
+    st.session_state.quiz_seed = sessione_aula.seed_variante(variante)
+    st.session_state.quiz_sprt = None
 
 st.markdown("---")
-if st.button("🎲 Prepara test finale (estrai domande)"):
-    prepara_test()
-
-if st.session_state.quiz_df is None:
-    st.info("Premi **'Prepara test finale (estrai domande)'** per generare il test.")
+if sessione_aula is not None:
+    if st.button("🎓 Ricevi il test della sessione d'aula"):
+        with misura("variante_aula"):
+            ricevi_variante_aula()
+elif st.button("🎲 Prepara test finale (estrai domande)"):
+    with misura("prepara_test"):
+        prepara_test()
+
+if st.session_state.quiz_righe is None:
+    if sessione_aula is not None:
+        st.info("Premi **'Ricevi il test della sessione d'aula'** per iniziare.")
+    else:
+        st.info("Premi **'Prepara test finale (estrai domande)'** per generare il test.")
     st.stop()
 
-quiz_df = st.session_state.quiz_df
-quiz_options = st.session_state.quiz_options
-quiz_correct_idx = st.session_state.quiz_correct_idx
+if st.session_state.quiz_aula:
+    # il seed della variante riproduce il test con genera_test.py / correzione.py
+    seed = st.session_state.quiz_seed
 
-st.subheader(f"Test finale generato — {len(quiz_df)} domande")
+banca_quiz = banca if st.session_state.quiz_banca == banca.path else carica_banca(st.session_state.quiz_banca)
+if banca_quiz.versione != st.session_state.quiz_versione:
+    st.session_state.quiz_righe = None
+    st.warning("La banca domande è stata modificata dopo l'estrazione: prepara di nuovo il test finale.")
+    st.stop()
 
-# Visualizzazione domande
-risposte_utente = []
+quiz_righe = st.session_state.quiz_righe
+quiz_perm = st.session_state.quiz_perm
+df_banca = banca_quiz.df
+parametri_seq = st.session_state.quiz_sprt
+domande_estratte = len(quiz_righe)
 
-for i, row in quiz_df.iterrows():
-    domanda = row["domanda"]
-    codice = row["codice"]
-    riferimento = row["riferimento"] if "riferimento" in row and not pd.isna(row["riferimento"]) else ""
-    options = quiz_options[i]
+
+def mostra_domanda(i, pos, ordine):
+    """Domanda i del test; ritorna la posizione dell'opzione scelta (0..3) o None."""
+    domanda = df_banca.at[pos, "domanda"]
+    codice = df_banca.at[pos, "codice"]
+    riferimento = df_banca.at[pos, "riferimento"]
+    riferimento = riferimento if not pd.isna(riferimento) else ""
+    opzioni_testo = [banca_quiz.opzioni[pos][j] for j in ordine]
 
     with st.container(border=True):
         st.markdown(f"**{i+1}. {domanda}**")
         if riferimento:
             st.markdown(f"<span class='ref'>Rif.: {riferimento}</span>", unsafe_allow_html=True)
 
-        opzioni_testo = [t for _, t in options]
-        scelta = st.radio(
+        return st.radio(
             "Seleziona una risposta:",
-            options=opzioni_testo,
+            options=range(len(opzioni_testo)),
+            format_func=opzioni_testo.__getitem__,
             key=f"q_{i}_{codice}",
             index=None
         )
-        risposte_utente.append(scelta)
 
-st.markdown("---")
+
+def conferma_risposta(i, pos, ordine):
+    """Callback della conferma nel test adattivo: registra risposta e correttezza prima del rerun."""
+    scelta = st.session_state.get(f"q_{i}_{df_banca.at[pos, 'codice']}")
+    if scelta is None:
+        st.session_state.quiz_avviso_seq = True
+        return
+    st.session_state.quiz_risposte_seq.append(scelta)
+    st.session_state.quiz_esiti_seq.append(scelta == posizione_corretta(ordine, banca_quiz.corretta_idx[pos]))
+
+
+@st.fragment
+def domanda_sequenziale():
+    """
+    Test adattivo: una domanda alla volta. La conferma riesegue solo il
+    frammento (la domanda successiva); la pagina intera solo quando l'esito è deciso.
+    """
+    if arresto(st.session_state.quiz_esiti_seq, parametri_seq, domande_estratte)[1] is not None:
+        st.rerun()
+    i = len(st.session_state.quiz_esiti_seq)
+    pos, ordine = quiz_righe[i], quiz_perm[i]
+    st.progress(i / domande_estratte, text=f"Domanda {i+1} (al massimo {domande_estratte})")
+    with st.form(f"form_test_adattivo_{i}", border=False):
+        mostra_domanda(i, pos, ordine)
+        st.form_submit_button("➡️ Conferma risposta", on_click=conferma_risposta, args=(i, pos, ordine))
+    if st.session_state.pop("quiz_avviso_seq", False):
+        st.warning("Seleziona una risposta per continuare.")
+
+
+esito_seq = None
+t_rendering = time.perf_counter()
+if parametri_seq is not None:
+    n_usate, esito_seq = arresto(st.session_state.quiz_esiti_seq, parametri_seq, domande_estratte)
+    if esito_seq is None:
+        st.subheader(f"Test finale adattivo — al massimo {domande_estratte} domande")
+        domanda_sequenziale()
+        registra("rerun_pagina", time.perf_counter() - t_rerun)
+        st.stop()
+    # esito deciso: si correggono e si registrano solo le domande usate
+    quiz_righe = quiz_righe[:n_usate]
+    quiz_perm = quiz_perm[:n_usate]
+    risposte_utente = st.session_state.quiz_risposte_seq[:n_usate]
+    # consegna automatica una sola volta, alla decisione
+    correggi = st.session_state.quiz_chiave_seq is None
+    st.subheader(f"Test finale adattivo — esito deciso dopo {n_usate} domande su {domande_estratte}")
+else:
+    st.subheader(f"Test finale generato — {len(quiz_righe)} domande")
+
+    # Visualizzazione domande: dentro un form le risposte non provocano rerun,
+    # lo script viene rieseguito solo alla consegna.
+    risposte_utente = []  # per domanda: posizione dell'opzione scelta (0..3) o None
+
+    with st.form("form_test_finale", border=False):
+        for i, (pos, ordine) in enumerate(zip(quiz_righe, quiz_perm)):
+            risposte_utente.append(mostra_domanda(i, pos, ordine))
+
+        st.markdown("---")
+        correggi = st.form_submit_button("✅ Correggi test finale")
+registra("rendering_domande", time.perf_counter() - t_rendering)
+registra("rerun_pagina", time.perf_counter() - t_rerun)
 
 # ============================================================
 # CORREZIONE + PDF + CSV + EMAIL
 # ============================================================
-if st.button("✅ Correggi test finale"):
-    punteggio = 0
-    totale = len(quiz_df)
-    dettagli_errori = []
-    storico_domande = []
-
-    for i, row in quiz_df.iterrows():
-        scelta = risposte_utente[i]
-        options = quiz_options[i]
-        correct_idx = quiz_correct_idx[i]
-
-        if correct_idx is None:
-            testo_corretta = ""
-        else:
-            testo_corretta = options[correct_idx][1]
-
-        if scelta is None:
-            esito = "NON RISPOSTA"
-            corretta = testo_corretta
-        elif scelta == testo_corretta:
-            punteggio += 1
-            esito = "CORRETTA"
-            corretta = testo_corretta
-        else:
-            esito = "ERRATA"
-            corretta = testo_corretta
-
-        storico_domande.append({
-            "N": i + 1,
-            "Domanda": row["domanda"],
-            "Esito": esito,
-            "Risposta data": scelta if scelta else "NON RISPOSTA",
-        })
-
-        if esito != "CORRETTA":
-            dettagli_errori.append({
-                "N": i+1,
-                "Codice": row["codice"],
-                "Domanda": row["domanda"],
-                "Esito": esito,
-                "Risposta data": scelta if scelta else "",
-                "Risposta corretta": corretta,
-                "Riferimento": row.get("riferimento", "")
-            })
-
-    percentuale = round((punteggio / totale) * 100, 1) if totale > 0 else 0.0
-    superato = percentuale >= SOGLIA_SUPERAMENTO
+@st.cache_resource
+def get_cache_consegne():
+    return CacheLRU()
+
+
+def correggi_consegna():
+    """Esito della consegna corrente, senza effetti collaterali (salvataggio, email)."""
+    esito = motore.correggi(banca_quiz, quiz_righe, quiz_perm, risposte_utente)
+    if esito_seq is not None:
+        # test adattivo: decide il test sequenziale, non la soglia sulle domande usate
+        esito["superato"] = esito_seq
+    # i PDF non si generano qui: si ricostruiscono dal record di riproduzione
+    # quando vengono scaricati o allegati all'email (vedi archivio_report)
+    esito["riga"] = motore.riga_risultato(
+        esito, banca_quiz, selected_label, argomento_scelto, quiz_righe, quiz_perm, risposte_utente,
+        partecipante, utente, seed, chiave, sessione_aula=st.session_state.quiz_aula,
+        domande_estratte=domande_estratte,
+    )
+    return esito
+
+
+# Chiave della consegna: stesso utente, test, risposte e dati partecipante => stessa consegna
+utente = {
+    "login_user": st.session_state.logged_user,
+    "user_ente": st.session_state.user_ente,
+    "user_role": st.session_state.user_role,
+}
+partecipante = {"nome": nome, "email": email_partecipante, "corso": corso, "data_test": data_test}
+chiave = motore.chiave(
+    utente, selected_label, argomento_scelto, seed, banca_quiz, quiz_righe, quiz_perm, risposte_utente, partecipante
+)
+if esito_seq is not None:
+    # test adattivo: resta la consegna fatta alla decisione, anche se poi cambiano
+    # i dati del partecipante (altrimenti ogni modifica sarebbe una nuova consegna)
+    if st.session_state.quiz_chiave_seq is None:
+        st.session_state.quiz_chiave_seq = chiave
+    chiave = st.session_state.quiz_chiave_seq
+if correggi:
+    st.session_state.consegna_corrente = chiave
+
+if st.session_state.get("consegna_corrente") == chiave:
+    # rerun successivi (nuovo "Correggi", download) riusano esito e PDF dalla cache
+    with misura("correzione"):
+        consegna, nuova = get_cache_consegne().ottieni_o_crea(chiave, correggi_consegna)
+    punteggio = consegna["punteggio"]
+    totale = consegna["totale"]
+    percentuale = consegna["percentuale"]
+    superato = consegna["superato"]
+    riga_csv = consegna["riga"]
 
     col1, col2 = st.columns(2)
     with col1:
@@ -533,112 +923,93 @@ if st.button("✅ Correggi test finale"):
 
     st.markdown("---")
 
-    if dettagli_errori:
+    if consegna["dettagli_errori"]:
         st.subheader("Domande errate / non risposte")
-        df_err = pd.DataFrame(dettagli_errori)
+        df_err = pd.DataFrame(consegna["dettagli_errori"])
         st.dataframe(df_err, use_container_width=True)
     else:
         st.success("Tutte le risposte sono corrette. Ottimo lavoro!")
 
-    # PDF test finale
-    pdf_test = build_test_pdf(
-        nome=nome,
-        corso=corso,
-        argomento=argomento_scelto,
-        data_test=data_test,
-        punteggio=punteggio,
-        percentuale=percentuale,
-        superato=superato,
-        quiz_df=quiz_df,
-        quiz_options=quiz_options,
-        risposte_utente=risposte_utente
-    )
-
-    nome_sanit = nome.replace(" ", "_") if nome else "partecipante"
-    corso_sanit = (corso or argomento_scelto or "test_finale").replace(" ", "_")
-    data_str = data_test.strftime("%Y%m%d") if isinstance(data_test, date) else "data"
-    base_filename = f"{data_str}_{corso_sanit}_{nome_sanit}"
-
+    # PDF generati solo al clic (poi dalla cache su disco)
     st.download_button(
         "⬇️ Scarica report test finale in PDF",
-        data=pdf_test,
-        file_name=f"{base_filename}_test_finale.pdf",
-        mime="application/pdf"
+        data=lambda: pdf_report(riga_csv, "test"),
+        file_name=nome_file_report(riga_csv, "test"),
+        mime="application/pdf",
+        on_click="ignore"
     )
 
-    # Badge (solo se superato)
-    badge_pdf = None
     if superato:
-        badge_pdf = build_badge_pdf(
-            nome=nome,
-            corso=corso or argomento_scelto,
-            data_test=data_test,
-            percentuale=percentuale
-        )
         st.download_button(
             "⬇️ Scarica badge test finale (PDF)",
-            data=badge_pdf,
-            file_name=f"{base_filename}_badge_test_finale.pdf",
-            mime="application/pdf"
-        )
-
-    # Salvataggio CSV audit trail
-    riga_csv = {
-        "timestamp": datetime.now().isoformat(timespec="seconds"),
-        "login_user": st.session_state.logged_user,
-        "user_ente": st.session_state.user_ente,
-        "user_role": st.session_state.user_role,
-        "nome_partecipante": nome,
-        "email_partecipante": email_partecipante,
-        "corso": corso,
-        "argomento": argomento_scelto,
-        "banca_domande": selected_label,
-        "data_test": data_test.strftime("%Y-%m-%d") if isinstance(data_test, date) else str(data_test),
-        "n_domande": totale,
-        "punteggio": punteggio,
-        "percentuale": percentuale,
-        "superato": superato,
-        "seed": seed
-    }
-    salva_risultato_csv(riga_csv)
-
-    # Email sempre, con dettaglio domande nel corpo + allegati
-    oggetto_test = corso or argomento_scelto or "Test finale sicurezza"
-    subject = f"{nome or 'Partecipante'} - {oggetto_test} - Punteggio {percentuale}%"
-
-    body_lines = [
-        "Esito test finale di formazione sicurezza.",
-        "",
-        f"Nome: {nome or '-'}",
-        f"Corso / Modulo: {oggetto_test}",
-        f"Data test finale: {data_test.strftime('%d/%m/%Y') if isinstance(data_test, date) else str(data_test)}",
-        f"Punteggio: {punteggio} / {totale} ({percentuale}%)",
-        f"Esito: {'SUPERATO' if superato else 'NON SUPERATO'} (soglia {SOGLIA_SUPERAMENTO}%)",
-        "",
-        "Dettaglio domande:",
-        "-------------------",
-    ]
-
-    for d in storico_domande:
-        icon = get_icon(d["Esito"])
-        body_lines.append(f"{icon} {d['N']}. {d['Domanda']}")
-        body_lines.append(f"   Esito: {d['Esito']}")
-        body_lines.append(f"   Risposta data: {d['Risposta data']}")
-        body_lines.append("")
-
-    body_lines.append("In allegato il report PDF del test finale.")
-    if superato:
-        body_lines.append("È allegato anche il badge di superamento in formato PDF.")
-
-    body = "\n".join(body_lines)
-
-    attachments = [
-        (f"{base_filename}_test_finale.pdf", pdf_test, "application/pdf")
-    ]
-    if superato and badge_pdf is not None:
-        attachments.append(
-            (f"{base_filename}_badge_test_finale.pdf", badge_pdf, "application/pdf")
+            data=lambda: pdf_report(riga_csv, "badge"),
+            file_name=nome_file_report(riga_csv, "badge"),
+            mime="application/pdf",
+            on_click="ignore"
         )
 
-    extra_to = [email_partecipante] if email_partecipante else []
-    send_email_with_attachments(subject, body, attachments, extra_to=extra_to)
+    # Effetti collaterali una sola volta per consegna: la chiave è unica anche
+    # nell'archivio risultati, quindi l'email parte solo se la riga è nuova.
+    if nuova:
+        # Salvataggio audit trail
+        salvata = False
+        try:
+            with misura("salva_risultato"):
+                registrata = salvata = salva_risultato(riga_csv)
+        except Exception as e:
+            st.error(f"Errore nel salvataggio del risultato: {e}")
+            registrata = True  # il risultato non è salvato ma il report va comunque spedito
+        if errore_migrazione():
+            st.warning(errore_migrazione())
+
+        if registrata:
+            # Email sempre, con dettaglio domande nel corpo + allegati
+            oggetto_test = corso or argomento_scelto or "Test finale sicurezza"
+            subject = f"{nome or 'Partecipante'} - {oggetto_test} - Punteggio {percentuale}%"
+
+            body_lines = [
+                "Esito test finale di formazione sicurezza.",
+                "",
+                f"Nome: {nome or '-'}",
+                f"Corso / Modulo: {oggetto_test}",
+                f"Data test finale: {data_test.strftime('%d/%m/%Y') if isinstance(data_test, date) else str(data_test)}",
+                f"Punteggio: {punteggio} / {totale} ({percentuale}%)",
+                f"Esito: {'SUPERATO' if superato else 'NON SUPERATO'} (soglia {SOGLIA_SUPERAMENTO}%)",
+            ]
+            if esito_seq is not None:
+                body_lines.append(f"Test adattivo: esito deciso dopo {totale} domande su {domande_estratte} estratte")
+            body_lines += [
+                "",
+                "Dettaglio domande:",
+                "-------------------",
+            ]
+
+            from report_pdf import get_icon
+
+            for d in consegna["storico_domande"]:
+                icon = get_icon(d["Esito"])
+                body_lines.append(f"{icon} {d['N']}. {d['Domanda']}")
+                body_lines.append(f"   Esito: {d['Esito']}")
+                body_lines.append(f"   Risposta data: {d['Risposta data']}")
+                body_lines.append("")
+
+            body_lines.append("In allegato il report PDF del test finale.")
+            if superato:
+                body_lines.append("È allegato anche il badge di superamento in formato PDF.")
+
+            body = "\n".join(body_lines)
+
+            riferimenti = [{"chiave_consegna": chiave, "tipo": "test"}]
+            if superato:
+                riferimenti.append({"chiave_consegna": chiave, "tipo": "badge"})
+
+            extra_to = [email_partecipante] if email_partecipante else []
+            if salvata:
+                # allegati generati dal worker dell'outbox al momento dell'invio
+                send_email_with_attachments(
+                    subject, body, [], extra_to=extra_to, allegati_differiti=riferimenti, riga_digest=riga_csv
+                )
+            else:
+                # senza riga in archivio il worker non potrebbe ricostruirli
+                attachments = risolvi_allegati(riferimenti, righe_per_chiave=lambda _: riga_csv)
+                send_email_with_attachments(subject, body, attachments, extra_to=extra_to)
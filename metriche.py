@@ -0,0 +1,193 @@
+"""Misura dei tempi per fase (lettura banca, estrazione, rendering, PDF, salvataggio, SMTP).
+
+Uso:
+    with misura("build_test_pdf"):
+        pdf = build_test_pdf(...)
+
+Le misure restano in memoria nel processo e vengono scritte periodicamente in
+formato Prometheus (textfile collector) e JSON, così un monitoraggio esterno
+può leggerle senza passare dall'app. Conteggio e totale sono cumulativi
+dall'avvio del processo; p50, p95 e massimo sono calcolati solo sulle ultime
+MAX_CAMPIONI misure di ogni fase (finestra mobile).
+
+Ogni processo (server Streamlit, API, worker) scrive i propri file,
+metriche_app.<pid>.prom e metriche_app.<pid>.json, con l'etichetta pid nelle
+serie Prometheus: il collector li legge tutti senza che un processo
+sovrascriva le misure degli altri. I file vengono rimossi all'uscita del
+processo.
+"""
+import atexit
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# ============================================================
+# COSTANTI
+# ============================================================
+MAX_CAMPIONI = 2048
+METRICHE_PROM = "metriche_app.prom"   # nome base: il file effettivo è metriche_app.<pid>.prom
+METRICHE_JSON = "metriche_app.json"
+INTERVALLO_EXPORT_S = 10.0
+CARTELLA_PROFILI = "profili"
+
+_lock = threading.Lock()
+_campioni = {}   # fase -> deque di durate in secondi
+_conteggi = {}   # fase -> numero totale di misure
+_totali = {}     # fase -> somma delle durate
+_ultimo_export = 0.0
+_file_esportati = set()   # file di questo processo, rimossi all'uscita
+
+
+def registra(fase: str, durata_s: float) -> None:
+    global _ultimo_export
+    with _lock:
+        if fase not in _campioni:
+            _campioni[fase] = deque(maxlen=MAX_CAMPIONI)
+            _conteggi[fase] = 0
+            _totali[fase] = 0.0
+        _campioni[fase].append(durata_s)
+        _conteggi[fase] += 1
+        _totali[fase] += durata_s
+        da_esportare = time.monotonic() - _ultimo_export >= INTERVALLO_EXPORT_S
+        if da_esportare:
+            _ultimo_export = time.monotonic()
+    if da_esportare:
+        try:
+            esporta()
+        except OSError:
+            pass
+
+
+@contextmanager
+def misura(fase: str):
+    """Context manager che registra la durata del blocco (anche se solleva eccezioni)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        registra(fase, time.perf_counter() - t0)
+
+
+def riepilogo() -> list:
+    """
+    Lista di dict per fase: conteggio e totale (cumulativi) e p50, p95 e massimo
+    in millisecondi (sulle ultime MAX_CAMPIONI misure).
+    """
+    import numpy as np
+
+    with _lock:
+        fasi = {f: (np.fromiter(c, dtype=np.float64), _conteggi[f], _totali[f]) for f, c in _campioni.items()}
+    righe = []
+    for fase, (durate, conteggio, totale) in sorted(fasi.items()):
+        p50, p95 = np.percentile(durate, [50, 95]) if len(durate) else (0.0, 0.0)
+        righe.append({
+            "fase": fase,
+            "conteggio": conteggio,
+            "totale_s": round(totale, 6),
+            "p50_ms": round(float(p50) * 1000, 3),
+            "p95_ms": round(float(p95) * 1000, 3),
+            "max_ms": round(float(durate.max()) * 1000, 3) if len(durate) else 0.0,
+        })
+    return righe
+
+
+def formato_prometheus(righe=None) -> str:
+    righe = riepilogo() if righe is None else righe
+    linee = [
+        "# HELP test_finale_fase_secondi Durata delle fasi dell'app test finale "
+        f"(quantili sulle ultime {MAX_CAMPIONI} misure, sum e count dall'avvio del processo).",
+        "# TYPE test_finale_fase_secondi summary",
+    ]
+    pid = os.getpid()
+    for r in righe:
+        fase = r["fase"].replace("\\", "\\\\").replace('"', '\\"')
+        etichette = f'fase="{fase}",pid="{pid}"'
+        linee.append(f'test_finale_fase_secondi{{{etichette},quantile="0.5"}} {r["p50_ms"] / 1000:.6f}')
+        linee.append(f'test_finale_fase_secondi{{{etichette},quantile="0.95"}} {r["p95_ms"] / 1000:.6f}')
+        linee.append(f'test_finale_fase_secondi_sum{{{etichette}}} {r["totale_s"]:.6f}')
+        linee.append(f'test_finale_fase_secondi_count{{{etichette}}} {r["conteggio"]}')
+    return "\n".join(linee) + "\n"
+
+
+def _scrivi_atomico(path: str, testo: str) -> None:
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(testo)
+    os.replace(tmp, path)
+
+
+def path_processo(path_base: str, pid: int = None) -> str:
+    """metriche_app.prom -> metriche_app.<pid>.prom: un file per processo."""
+    radice, estensione = os.path.splitext(path_base)
+    return f"{radice}.{os.getpid() if pid is None else pid}{estensione}"
+
+
+def _rimuovi_file_esportati() -> None:
+    for path in list(_file_esportati):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    _file_esportati.clear()
+
+
+def esporta(path_prom: str = None, path_json: str = None) -> None:
+    """Scrive le metriche correnti in formato Prometheus e JSON (di default nei file di questo processo)."""
+    path_prom = path_prom or path_processo(METRICHE_PROM)
+    path_json = path_json or path_processo(METRICHE_JSON)
+    righe = riepilogo()
+    _scrivi_atomico(path_prom, formato_prometheus(righe))
+    _scrivi_atomico(path_json, json.dumps({"pid": os.getpid(), "timestamp": time.time(), "fasi": righe}, indent=2))
+    with _lock:
+        if not _file_esportati:
+            atexit.register(_rimuovi_file_esportati)
+        _file_esportati.update(os.path.abspath(p) for p in (path_prom, path_json))
+
+
+def azzera() -> None:
+    with _lock:
+        _campioni.clear()
+        _conteggi.clear()
+        _totali.clear()
+
+
+# ============================================================
+# PROFILAZIONE (opt-in, una sessione)
+# ============================================================
+
+class ProfiloSessione:
+    """cProfile attivato per una sola sessione: ogni rerun viene salvato in un file .pstats.
+
+    Il profiler è legato al thread che lo attiva: il rerun va eseguito per intero
+    dentro `with profilo.rerun():`, nello stesso thread dello script.
+    """
+
+    def __init__(self, id_sessione: str, cartella: str = CARTELLA_PROFILI):
+        self.id_sessione = id_sessione
+        self.cartella = cartella
+        self.n_rerun = 0
+        self.ultimo_file = None
+        self.attivo = False
+
+    @contextmanager
+    def rerun(self):
+        """Profila il blocco e lo salva (anche se termina con un'eccezione, es. st.stop)."""
+        profiler = cProfile.Profile()
+        self.attivo = True
+        profiler.enable()
+        try:
+            yield self
+        finally:
+            profiler.disable()
+            self.attivo = False
+            os.makedirs(self.cartella, exist_ok=True)
+            self.n_rerun += 1
+            self.ultimo_file = self.percorso(self.n_rerun)
+            profiler.dump_stats(self.ultimo_file)
+
+    def percorso(self, n_rerun: int) -> str:
+        return os.path.join(self.cartella, f"{self.id_sessione}_{n_rerun:04d}.pstats")
@@ -0,0 +1,424 @@
+"""Motore del test finale senza Streamlit: estrazione, correzione e risultato di una consegna.
+
+Le stesse funzioni sono usate dalla pagina Streamlit (main.py) e dall'API
+HTTP (api_test.py). Il motore non ha stato: un test emesso viaggia come
+ticket firmato (HMAC-SHA256) con banca, codici domanda e ordine delle
+opzioni, e torna indietro con le risposte; l'unico stato condiviso è
+l'archivio risultati, quindi più processi possono servire le stesse richieste.
+
+Il segreto dei ticket è la variabile d'ambiente TEST_FINALE_SEGRETO (uguale
+su tutti i worker); in sua assenza viene creato il file FILE_SEGRETO nella
+cartella di lavoro, condiviso dai processi della stessa macchina.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import tempfile
+import time
+from datetime import date, datetime
+
+import numpy as np
+
+from archivio_report import impronta_domande, record_riproduzione
+from banca_dati import CARTELLA_BANCHE, LABELS, BancaNonValida, carica_banca, list_quiz_files
+from cache_consegne import chiave_consegna
+from correzione import calcola_esito
+from duplicati import gruppi_banca
+from test_finale import (
+    MAX_DOMANDE, MIN_DOMANDE, dettaglio_risposte, estrai_stratificata, estrai_variante, interpreta_strati,
+    materializza_test,
+)
+
+# ============================================================
+# COSTANTI
+# ============================================================
+VARIABILE_SEGRETO = "TEST_FINALE_SEGRETO"
+FILE_SEGRETO = ".segreto_ticket"
+DURATA_TICKET_S = 24 * 3600
+CAMPI_PARTECIPANTE = ("nome", "email", "corso", "data_test")
+
+
+class RichiestaNonValida(ValueError):
+    """Parametri, ticket o risposte non utilizzabili (errore del chiamante)."""
+
+
+class TicketGiaConsegnato(RichiestaNonValida):
+    """Il ticket è già stato consegnato con altre risposte o altri dati del partecipante."""
+
+
+class BancaModificata(RichiestaNonValida):
+    """Domande, opzioni o risposte corrette del ticket sono cambiate nella banca dopo l'emissione."""
+
+
+# ============================================================
+# BANCHE
+# ============================================================
+
+def banca_per_label(label: str, cartella_banche: str = CARTELLA_BANCHE):
+    percorsi = dict(list_quiz_files(cartella_banche))
+    if label not in percorsi:
+        raise RichiestaNonValida(f"Banca domande '{label}' non trovata.")
+    try:
+        return carica_banca(percorsi[label])
+    except BancaNonValida as e:
+        raise RichiestaNonValida(str(e)) from e
+
+
+def elenco_banche(cartella_banche: str = CARTELLA_BANCHE) -> list:
+    """[{banca, argomenti: {argomento: domande disponibili}}, ...] delle banche leggibili."""
+    elenco = []
+    for label, path in list_quiz_files(cartella_banche):
+        try:
+            banca = carica_banca(path)
+        except BancaNonValida:
+            continue
+        elenco.append({
+            "banca": label,
+            "argomenti": {str(a): int(len(banca.righe_argomento(a))) for a in banca.argomenti},
+        })
+    return elenco
+
+
+# ============================================================
+# ESTRAZIONE E CORREZIONE
+# ============================================================
+
+def estrai(banca, argomento: str, n_domande: int, seed: str = "", testo_strati: str = "", codici_esclusi=(),
+           una_per_gruppo: bool = False):
+    """
+    (righe, permutazioni) del test. Senza strati, esclusioni né una_per_gruppo
+    è l'estrazione classica (stesso seed => stesso test di genera_test.py e
+    correzione.py). Con una_per_gruppo il test non contiene due domande dello
+    stesso gruppo di quasi duplicati (vedi duplicati.py).
+    """
+    righe_topic = banca.righe_argomento(argomento)
+    if len(righe_topic) == 0:
+        raise RichiestaNonValida(f"Nessuna domanda per l'argomento '{argomento}'.")
+    strati = interpreta_strati(testo_strati)
+    if not strati and not codici_esclusi and not una_per_gruppo:
+        return estrai_variante(righe_topic, n_domande, seed)
+
+    # estrazione sugli indici precompilati della banca, O(n_domande)
+    escludi = [banca.indice_codici[c] for c in codici_esclusi if c in banca.indice_codici]
+    righe, permutazioni = estrai_stratificata(
+        banca, strati or [([righe_topic], n_domande)], seed, escludi=escludi,
+        duplicati=gruppi_banca(banca) if una_per_gruppo else None,
+    )
+    if len(righe) == 0:
+        raise RichiestaNonValida("Nessuna domanda corrisponde agli strati indicati.")
+    return righe, permutazioni
+
+
+def domande_visibili(banca, righe, permutazioni) -> list:
+    """Testi del test come li vede il partecipante (senza la risposta corretta)."""
+    quiz_df, quiz_options, _ = materializza_test(banca, righe, permutazioni)
+    domande = []
+    for i, (row, opzioni) in enumerate(zip(quiz_df.to_dict(orient="records"), quiz_options)):
+        riferimento = row.get("riferimento")
+        domande.append({
+            "n": i + 1,
+            "codice": str(row["codice"]),
+            "domanda": str(row["domanda"]),
+            "riferimento": "" if riferimento is None or riferimento != riferimento else str(riferimento),
+            "opzioni": [str(testo) for _, testo in opzioni],
+        })
+    return domande
+
+
+def correggi(banca, righe, permutazioni, risposte) -> dict:
+    """
+    Esito di una consegna, senza effetti collaterali. risposte: per domanda la
+    posizione mostrata (0..3) o None. Ritorna punteggio, totale, percentuale,
+    superato, dettagli_errori e storico_domande.
+    """
+    quiz_df, quiz_options, quiz_correct_idx = materializza_test(banca, righe, permutazioni)
+    punteggio = 0
+    totale = len(quiz_df)
+    dettagli_errori = []
+    storico_domande = []
+
+    for i, row in quiz_df.iterrows():
+        scelta = risposte[i]
+        options = quiz_options[i]
+        correct_idx = quiz_correct_idx[i]
+
+        testo_corretta = options[correct_idx][1] if correct_idx is not None else ""
+        testo_scelta = options[scelta][1] if scelta is not None else None
+
+        # confronto per indice: due opzioni con lo stesso testo non falsano l'esito
+        if scelta is None:
+            esito = "NON RISPOSTA"
+        elif scelta == correct_idx:
+            punteggio += 1
+            esito = "CORRETTA"
+        else:
+            esito = "ERRATA"
+
+        storico_domande.append({
+            "N": i + 1,
+            "Domanda": row["domanda"],
+            "Esito": esito,
+            "Risposta data": testo_scelta if testo_scelta else "NON RISPOSTA",
+        })
+
+        if esito != "CORRETTA":
+            dettagli_errori.append({
+                "N": i+1,
+                "Codice": row["codice"],
+                "Domanda": row["domanda"],
+                "Esito": esito,
+                "Risposta data": testo_scelta if testo_scelta else "",
+                "Risposta corretta": testo_corretta,
+                "Riferimento": row.get("riferimento", "")
+            })
+
+    percentuale, superato = calcola_esito(punteggio, totale)
+    return {
+        "punteggio": punteggio,
+        "totale": totale,
+        "percentuale": percentuale,
+        "superato": superato,
+        "dettagli_errori": dettagli_errori,
+        "storico_domande": storico_domande,
+    }
+
+
+def _data_iso(data_test) -> str:
+    return data_test.strftime("%Y-%m-%d") if isinstance(data_test, date) else str(data_test or "")
+
+
+def chiave(utente: dict, banca_label: str, argomento: str, seed: str, banca, righe, permutazioni, risposte,
+           partecipante: dict) -> str:
+    """Chiave della consegna: stesso utente, test, risposte e dati partecipante => stessa consegna."""
+    return chiave_consegna(
+        utente.get("login_user"),
+        seed,
+        banca.df["codice"].to_numpy()[righe],
+        permutazioni,
+        risposte,
+        {
+            "nome": partecipante.get("nome", ""),
+            "email": partecipante.get("email", ""),
+            "corso": partecipante.get("corso", ""),
+            "data_test": partecipante.get("data_test", ""),
+            "argomento": argomento,
+            "banca": banca_label,
+        },
+    )
+
+
+def riga_risultato(esito: dict, banca, banca_label: str, argomento: str, righe, permutazioni, risposte,
+                   partecipante: dict, utente: dict, seed: str, chiave_consegna: str,
+                   sessione_aula: str = "", domande_estratte: int = None, ticket: str = None) -> dict:
+    """
+    Riga dell'archivio risultati; i PDF si ricostruiscono dal record di riproduzione (archivio_report).
+    Nel test adattivo (sequenziale.py) righe e risposte sono solo le domande usate,
+    domande_estratte è la lunghezza del test estratto. ticket identifica il
+    ticket dell'API consegnato (None dalla pagina Streamlit).
+    """
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "login_user": utente.get("login_user"),
+        "user_ente": utente.get("user_ente"),
+        "user_role": utente.get("user_role"),
+        "nome_partecipante": partecipante.get("nome", ""),
+        "email_partecipante": partecipante.get("email", ""),
+        "corso": partecipante.get("corso", ""),
+        "argomento": argomento,
+        "banca_domande": banca_label,
+        "data_test": _data_iso(partecipante.get("data_test")),
+        "n_domande": esito["totale"],
+        "punteggio": esito["punteggio"],
+        "percentuale": esito["percentuale"],
+        "superato": esito["superato"],
+        "seed": seed,
+        "chiave_consegna": chiave_consegna,
+        "risposte_domande": dettaglio_risposte(
+            banca.df["codice"].to_numpy()[righe],
+            banca.corretta_idx[righe],
+            permutazioni,
+            risposte,
+        ),
+        "riproduzione": record_riproduzione(banca, righe, permutazioni, risposte),
+        "sessione_aula": sessione_aula or "",
+        "domande_estratte": domande_estratte or esito["totale"],
+        "ticket": ticket,
+    }
+
+
+# ============================================================
+# TICKET FIRMATI (API senza stato)
+# ============================================================
+_segreto = None
+
+
+def _crea_file_segreto() -> None:
+    """
+    Crea FILE_SEGRETO solo se non esiste, già completo: il segreto si scrive in
+    un file temporaneo che viene poi collegato al nome definitivo (os.link fallisce
+    se un altro processo l'ha già creato). Chi legge il file non lo trova mai vuoto.
+    """
+    cartella = os.path.dirname(os.path.abspath(FILE_SEGRETO))
+    fd, tmp = tempfile.mkstemp(prefix=".segreto_", dir=cartella)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+            f.flush()
+            os.fsync(f.fileno())
+        os.link(tmp, FILE_SEGRETO)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+
+
+def segreto() -> bytes:
+    global _segreto
+    if _segreto is None:
+        valore = os.environ.get(VARIABILE_SEGRETO)
+        if not valore:
+            if not os.path.exists(FILE_SEGRETO):
+                _crea_file_segreto()
+            with open(FILE_SEGRETO) as f:
+                valore = f.read().strip()
+            if not valore:
+                raise RuntimeError(f"Il file {FILE_SEGRETO} è vuoto: eliminarlo o impostare {VARIABILE_SEGRETO}.")
+        _segreto = valore.encode("utf-8")
+    return _segreto
+
+
+def _b64(dati: bytes) -> str:
+    return base64.urlsafe_b64encode(dati).decode("ascii").rstrip("=")
+
+
+def crea_ticket(banca, banca_label: str, argomento: str, seed: str, righe, permutazioni, utente: dict,
+                sessione_aula: str = "") -> str:
+    """
+    payload.firma: il test è identificato dai codici domanda, non dalle posizioni di riga,
+    più l'impronta di testi e risposte corrette (la consegna si corregge sulla stessa chiave).
+    """
+    payload = {
+        "b": banca_label,
+        "a": argomento,
+        "s": seed or "",
+        "c": [str(c) for c in banca.df["codice"].to_numpy()[righe]],
+        "p": "".join(str(int(j)) for ordine in permutazioni for j in ordine),
+        "i": impronta_domande(banca, righe),
+        "u": {k: utente.get(k) or "" for k in ("login_user", "user_ente", "user_role")},
+        "sa": sessione_aula or "",
+        "t": int(time.time()),
+        "n": secrets.token_hex(8),  # ogni emissione è un ticket distinto (una consegna per ticket)
+    }
+    corpo = _b64(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    firma = hmac.new(segreto(), corpo.encode("ascii"), hashlib.sha256).hexdigest()
+    return f"{corpo}.{firma}"
+
+
+def leggi_ticket(ticket: str, cartella_banche: str = CARTELLA_BANCHE):
+    """
+    Verifica firma e scadenza; ritorna (payload, banca, righe, permutazioni).
+    BancaModificata se le domande del ticket non sono più quelle della banca.
+    """
+    corpo, _, firma = (ticket or "").partition(".")
+    atteso = hmac.new(segreto(), corpo.encode("ascii", "replace"), hashlib.sha256).hexdigest()
+    if not firma or not hmac.compare_digest(firma, atteso):
+        raise RichiestaNonValida("Ticket del test non valido.")
+    payload = json.loads(base64.urlsafe_b64decode(corpo + "=" * (-len(corpo) % 4)))
+    if time.time() - payload["t"] > DURATA_TICKET_S:
+        raise RichiestaNonValida("Ticket del test scaduto: richiedi un nuovo test.")
+
+    banca = banca_per_label(payload["b"], cartella_banche)
+    modificata = BancaModificata("La banca domande è stata modificata dopo l'emissione del test: richiedi un nuovo test.")
+    if any(c not in banca.indice_codici for c in payload["c"]):
+        raise modificata
+    righe = np.array([banca.indice_codici[c] for c in payload["c"]], dtype=np.int32)
+    if payload.get("i") != impronta_domande(banca, righe):
+        raise modificata
+    permutazioni = (np.frombuffer(payload["p"].encode("ascii"), dtype=np.uint8).reshape(-1, 4) - ord("0")).astype(np.uint8)
+    return payload, banca, righe, permutazioni
+
+
+def risposte_da_json(risposte, n: int) -> list:
+    """Risposte come posizioni mostrate (0..3), lettere 'A'..'D' o null; una per domanda."""
+    if not isinstance(risposte, list) or len(risposte) != n:
+        raise RichiestaNonValida(f"Servono {n} risposte (null per le domande non risposte).")
+    valide = []
+    for r in risposte:
+        if isinstance(r, str) and r.strip().upper() in LABELS:
+            r = LABELS.index(r.strip().upper())
+        if r is None or r == "":
+            valide.append(None)
+        elif isinstance(r, int) and not isinstance(r, bool) and 0 <= r <= 3:
+            valide.append(r)
+        else:
+            raise RichiestaNonValida(f"Risposta non valida: {r!r}")
+    return valide
+
+
+def numero_domande(valore) -> int:
+    """n_domande da una richiesta (intero o stringa di cifre) nei limiti della pagina."""
+    if isinstance(valore, str) and valore.strip().isdigit():
+        valore = int(valore)
+    if isinstance(valore, bool) or not isinstance(valore, int) or not MIN_DOMANDE <= valore <= MAX_DOMANDE:
+        raise RichiestaNonValida(f"n_domande deve essere un intero tra {MIN_DOMANDE} e {MAX_DOMANDE}.")
+    return valore
+
+
+def emetti_test(banca_label: str, argomento: str, n_domande: int, utente: dict, seed: str = "",
+                testo_strati: str = "", cartella_banche: str = CARTELLA_BANCHE,
+                una_per_gruppo: bool = False) -> dict:
+    """Nuovo test: {ticket, banca, argomento, domande}."""
+    n_domande = numero_domande(n_domande)
+    banca = banca_per_label(banca_label, cartella_banche)
+    righe, permutazioni = estrai(banca, argomento, n_domande, seed, testo_strati, una_per_gruppo=una_per_gruppo)
+    return {
+        "ticket": crea_ticket(banca, banca_label, argomento, seed, righe, permutazioni, utente),
+        "banca": banca_label,
+        "argomento": argomento,
+        "domande": domande_visibili(banca, righe, permutazioni),
+    }
+
+
+def consegna(ticket: str, risposte, partecipante: dict, login_user: str = None, salva=None,
+             cartella_banche: str = CARTELLA_BANCHE, consegnata=None) -> dict:
+    """
+    Corregge la consegna di un ticket e la registra con salva(riga) -> bool
+    (default risultati.salva_risultato; la stessa consegna ripetuta non crea un'altra riga).
+    Con login_user il ticket deve essere stato emesso per quell'utente.
+
+    Ogni ticket si consegna una sola volta: la riga porta la firma del ticket
+    (indice univoco nell'archivio) e consegnata(firma) -> chiave_consegna o None
+    (default risultati.consegna_del_ticket) dice se è già stato usato. Una
+    consegna diversa dello stesso ticket solleva TicketGiaConsegnato.
+    """
+    payload, banca, righe, permutazioni = leggi_ticket(ticket, cartella_banche)
+    if login_user is not None and payload["u"]["login_user"] != login_user:
+        raise RichiestaNonValida("Il ticket è stato emesso per un altro utente.")
+    if consegnata is None:
+        from risultati import consegna_del_ticket as consegnata
+    firma = ticket.partition(".")[2]
+    risposte = risposte_da_json(risposte, len(righe))
+    partecipante = {k: str(partecipante.get(k) or "") for k in CAMPI_PARTECIPANTE}
+    if not partecipante["data_test"]:
+        partecipante["data_test"] = date.today().isoformat()
+
+    chiave_c = chiave(payload["u"], payload["b"], payload["a"], payload["s"], banca, righe, permutazioni, risposte, partecipante)
+    precedente = consegnata(firma)
+    if precedente is not None and precedente != chiave_c:
+        raise TicketGiaConsegnato("Il test di questo ticket è già stato consegnato: richiedi un nuovo test.")
+
+    esito = correggi(banca, righe, permutazioni, risposte)
+    riga = riga_risultato(
+        esito, banca, payload["b"], payload["a"], righe, permutazioni, risposte, partecipante,
+        payload["u"], payload["s"], chiave_c, payload.get("sa", ""), ticket=firma,
+    )
+    if salva is None:
+        from risultati import salva_risultato as salva
+    nuova = salva(riga)
+    if not nuova and consegnata(firma) != chiave_c:
+        # un altro worker ha registrato nel frattempo una consegna diversa dello stesso ticket
+        raise TicketGiaConsegnato("Il test di questo ticket è già stato consegnato: richiedi un nuovo test.")
+    return {**esito, "chiave_consegna": chiave_c, "nuova": nuova, "riga": riga}
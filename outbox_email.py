@@ -0,0 +1,366 @@
+"""Outbox email persistente con invio in background.
+
+La correzione del test accoda il messaggio su disco (SQLite) e ritorna subito;
+un thread worker per processo svuota la coda riusando un'unica connessione
+SMTP, con retry a backoff esponenziale. Il trasporto è sostituibile (es. un
+server SMTP locale o TrasportoMemoria nei test).
+
+Gli allegati possono essere differiti: in coda resta solo un riferimento
+(JSON) e il worker li fa generare dal risolutore al momento dell'invio.
+"""
+import json
+import os
+import smtplib
+import sqlite3
+import ssl
+import threading
+import time
+from email import encoders, message_from_bytes
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import pandas as pd
+
+from metriche import misura
+
+# ============================================================
+# COSTANTI
+# ============================================================
+OUTBOX_DB = "outbox_email.sqlite3"
+MAX_TENTATIVI = 8
+BACKOFF_BASE_S = 5.0
+BACKOFF_MAX_S = 3600.0
+PRESA_IN_CARICO_S = 300.0    # dopo questo tempo un invio "in corso" orfano torna in coda
+SMTP_INATTIVITA_S = 60.0     # chiusura della connessione SMTP dopo inattività
+
+STATO_IN_CODA = "in_coda"
+STATO_IN_INVIO = "in_invio"
+STATO_INVIATA = "inviata"
+STATO_FALLITA = "fallita"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    creato TEXT NOT NULL,
+    mittente TEXT NOT NULL,
+    destinatari TEXT NOT NULL,
+    oggetto TEXT NOT NULL,
+    messaggio BLOB NOT NULL,
+    stato TEXT NOT NULL,
+    tentativi INTEGER NOT NULL DEFAULT 0,
+    prossimo_tentativo REAL NOT NULL,
+    ultimo_errore TEXT,
+    inviato TEXT,
+    allegati_differiti TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_stato ON outbox (stato, prossimo_tentativo);
+"""
+
+
+# ============================================================
+# MESSAGGI
+# ============================================================
+
+def componi_messaggio(sender: str, to_addrs, subject: str, body: str, attachments) -> bytes:
+    """
+    attachments: lista di tuple (filename, bytes_data, mime_type)
+    """
+    msg = MIMEMultipart()
+    msg["From"] = sender
+    msg["To"] = ", ".join(to_addrs)
+    msg["Subject"] = subject
+
+    msg.attach(MIMEText(body, "plain"))
+
+    for filename, data_bytes, mime_type in attachments:
+        msg.attach(_parte_allegato(filename, data_bytes, mime_type))
+
+    return msg.as_bytes()
+
+
+def _parte_allegato(filename: str, data_bytes: bytes, mime_type: str) -> MIMEBase:
+    maintype, subtype = mime_type.split("/", 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(data_bytes)
+    encoders.encode_base64(part)
+    part.add_header("Content-Disposition", f'attachment; filename="{filename}"')
+    return part
+
+
+def aggiungi_allegati(messaggio: bytes, attachments) -> bytes:
+    """Aggiunge allegati (filename, bytes_data, mime_type) a un messaggio già composto."""
+    attachments = list(attachments)
+    if not attachments:
+        return messaggio
+    msg = message_from_bytes(messaggio)
+    for filename, data_bytes, mime_type in attachments:
+        msg.attach(_parte_allegato(filename, data_bytes, mime_type))
+    return msg.as_bytes()
+
+
+# ============================================================
+# TRASPORTI
+# ============================================================
+
+class TrasportoSMTP:
+    """
+    Connessione SMTP mantenuta aperta tra un invio e l'altro: SSL (use_ssl),
+    STARTTLS (use_ssl=False) o in chiaro (use_ssl=False, starttls=False, es. un
+    server SMTP locale). Login solo se sono indicate le credenziali.
+    """
+
+    def __init__(self, host: str, port: int, username: str, password: str, use_ssl: bool = True,
+                 starttls: bool = True):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.starttls = starttls
+        self._server = None
+        self._ultimo_uso = 0.0
+
+    def _connetti(self):
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context(), timeout=30)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+            if self.starttls:
+                server.starttls(context=ssl.create_default_context())
+        if self.username and self.password:
+            server.login(self.username, self.password)
+        return server
+
+    def invia(self, mittente: str, destinatari, messaggio: bytes):
+        if self._server is not None and time.monotonic() - self._ultimo_uso > SMTP_INATTIVITA_S:
+            self.chiudi()
+        if self._server is None:
+            self._server = self._connetti()
+        try:
+            self._server.sendmail(mittente, destinatari, messaggio)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # connessione scaduta lato server: un solo nuovo tentativo con connessione fresca;
+            # gli altri errori SMTP (es. destinatari rifiutati) passano al backoff dell'outbox
+            self.chiudi()
+            self._server = self._connetti()
+            self._server.sendmail(mittente, destinatari, messaggio)
+        self._ultimo_uso = time.monotonic()
+
+    def chiudi(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+
+class TrasportoMemoria:
+    """Trasporto finto: conserva i messaggi in una lista (per test e sviluppo locale)."""
+
+    def __init__(self, errori_da_simulare: int = 0):
+        self.inviati = []
+        self.errori_da_simulare = errori_da_simulare
+
+    def invia(self, mittente: str, destinatari, messaggio: bytes):
+        if self.errori_da_simulare > 0:
+            self.errori_da_simulare -= 1
+            raise smtplib.SMTPServerDisconnected("errore simulato")
+        self.inviati.append((mittente, list(destinatari), messaggio))
+
+    def chiudi(self):
+        pass
+
+
+# ============================================================
+# CODA SU DISCO
+# ============================================================
+
+class Outbox:
+    """Coda persistente dei messaggi da inviare."""
+
+    def __init__(self, path: str = OUTBOX_DB):
+        self.path = os.path.abspath(path)
+        self._locale = threading.local()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        colonne = {r[1] for r in conn.execute("PRAGMA table_info(outbox)")}
+        if "allegati_differiti" not in colonne:
+            # code create prima degli allegati differiti
+            try:
+                conn.execute("ALTER TABLE outbox ADD COLUMN allegati_differiti TEXT")
+            except sqlite3.OperationalError as e:
+                if "duplicate column" not in str(e).lower():
+                    raise
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._locale, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._locale.conn = conn
+        return conn
+
+    def accoda(self, mittente: str, destinatari, oggetto: str, messaggio: bytes, allegati_differiti=None) -> int:
+        cur = self._conn().execute(
+            "INSERT INTO outbox (creato, mittente, destinatari, oggetto, messaggio, stato, prossimo_tentativo, "
+            "allegati_differiti) VALUES (datetime('now', 'localtime'), ?, ?, ?, ?, ?, ?, ?)",
+            (
+                mittente, ", ".join(destinatari), oggetto, messaggio, STATO_IN_CODA, time.time(),
+                json.dumps(allegati_differiti, ensure_ascii=False) if allegati_differiti else None,
+            ),
+        )
+        return cur.lastrowid
+
+    def prendi_in_carico(self, limite: int = 20):
+        """Riserva i messaggi pronti per l'invio (anche tra più processi)."""
+        conn = self._conn()
+        adesso = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            righe = conn.execute(
+                "SELECT id, mittente, destinatari, messaggio, tentativi, allegati_differiti FROM outbox "
+                "WHERE stato IN (?, ?) AND prossimo_tentativo <= ? ORDER BY id LIMIT ?",
+                (STATO_IN_CODA, STATO_IN_INVIO, adesso, limite),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE outbox SET stato = ?, prossimo_tentativo = ? WHERE id = ?",
+                [(STATO_IN_INVIO, adesso + PRESA_IN_CARICO_S, r[0]) for r in righe],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return righe
+
+    def segna_inviato(self, id_msg: int):
+        self._conn().execute(
+            "UPDATE outbox SET stato = ?, inviato = datetime('now', 'localtime'), ultimo_errore = NULL WHERE id = ?",
+            (STATO_INVIATA, id_msg),
+        )
+
+    def segna_errore(self, id_msg: int, tentativi: int, errore: str):
+        tentativi += 1
+        if tentativi >= MAX_TENTATIVI:
+            stato, prossimo = STATO_FALLITA, time.time()
+        else:
+            stato = STATO_IN_CODA
+            prossimo = time.time() + min(BACKOFF_BASE_S * 2 ** (tentativi - 1), BACKOFF_MAX_S)
+        self._conn().execute(
+            "UPDATE outbox SET stato = ?, tentativi = ?, prossimo_tentativo = ?, ultimo_errore = ? WHERE id = ?",
+            (stato, tentativi, prossimo, errore[:500], id_msg),
+        )
+
+    def riprova_falliti(self) -> int:
+        cur = self._conn().execute(
+            "UPDATE outbox SET stato = ?, tentativi = 0, prossimo_tentativo = ? WHERE stato = ?",
+            (STATO_IN_CODA, time.time(), STATO_FALLITA),
+        )
+        return cur.rowcount
+
+    def conteggi(self) -> dict:
+        righe = self._conn().execute("SELECT stato, COUNT(*) FROM outbox GROUP BY stato").fetchall()
+        return {stato: n for stato, n in righe}
+
+    def elenco(self, limite: int = 50) -> pd.DataFrame:
+        return pd.read_sql_query(
+            "SELECT id, creato, destinatari, oggetto, stato, tentativi, ultimo_errore, inviato "
+            "FROM outbox ORDER BY id DESC LIMIT ?",
+            self._conn(), params=(limite,),
+        )
+
+
+# ============================================================
+# WORKER
+# ============================================================
+
+class OutboxWorker(threading.Thread):
+    """Thread daemon che invia i messaggi in coda tramite il trasporto configurato."""
+
+    def __init__(self, outbox: Outbox, trasporto, intervallo_s: float = 2.0, risolutore_allegati=None, periodico=None):
+        super().__init__(name="outbox-email", daemon=True)
+        self.outbox = outbox
+        self.trasporto = trasporto
+        self.intervallo_s = intervallo_s
+        # riferimenti (lista JSON) -> lista di (filename, bytes_data, mime_type)
+        self.risolutore_allegati = risolutore_allegati
+        # eseguita a ogni giro prima dell'invio (es. digest_email.controllo_periodico)
+        self.periodico = periodico
+        self._sveglia = threading.Event()
+        self._fermato = threading.Event()
+
+    def sveglia(self):
+        self._sveglia.set()
+
+    def ferma(self, timeout: float = 10.0):
+        self._fermato.set()
+        self._sveglia.set()
+        self.join(timeout)
+
+    def svuota_una_volta(self) -> int:
+        inviati = 0
+        for id_msg, mittente, destinatari, messaggio, tentativi, differiti in self.outbox.prendi_in_carico():
+            try:
+                if differiti:
+                    if self.risolutore_allegati is None:
+                        raise RuntimeError("allegati differiti senza risolutore configurato")
+                    with misura("allegati_differiti"):
+                        messaggio = aggiungi_allegati(messaggio, self.risolutore_allegati(json.loads(differiti)))
+                with misura("smtp_invio"):
+                    self.trasporto.invia(mittente, destinatari.split(", "), messaggio)
+            except Exception as e:
+                self.outbox.segna_errore(id_msg, tentativi, f"{type(e).__name__}: {e}")
+                self.trasporto.chiudi()
+            else:
+                self.outbox.segna_inviato(id_msg)
+                inviati += 1
+        return inviati
+
+    def run(self):
+        while not self._fermato.is_set():
+            try:
+                if self.periodico is not None:
+                    self.periodico()
+                self.svuota_una_volta()
+            except Exception:
+                # errore sul database: si ritenta al giro successivo
+                pass
+            self._sveglia.wait(self.intervallo_s)
+            self._sveglia.clear()
+        self.trasporto.chiudi()
+
+
+_lock_worker = threading.Lock()
+_worker = None
+
+
+def avvia_worker(trasporto, path: str = OUTBOX_DB, risolutore_allegati=None, periodico=None) -> OutboxWorker:
+    """
+    Avvia (una sola volta per processo) il worker dell'outbox e lo ritorna.
+    periodico(outbox) -> callable: attività da eseguire a ogni giro sulla coda del worker.
+    """
+    global _worker
+    with _lock_worker:
+        if _worker is None or not _worker.is_alive():
+            outbox = Outbox(path)
+            _worker = OutboxWorker(
+                outbox, trasporto, risolutore_allegati=risolutore_allegati,
+                periodico=periodico(outbox) if periodico is not None else None,
+            )
+            _worker.start()
+        return _worker
+
+
+def accoda_email(outbox: Outbox, sender: str, to_addrs, subject: str, body: str, attachments,
+                 allegati_differiti=None) -> int:
+    """
+    Compone e accoda un messaggio; se il worker è attivo viene svegliato subito.
+    allegati_differiti: riferimenti serializzabili in JSON, risolti dal worker all'invio.
+    """
+    messaggio = componi_messaggio(sender, to_addrs, subject, body, attachments)
+    id_msg = outbox.accoda(sender, to_addrs, subject, messaggio, allegati_differiti)
+    if _worker is not None:
+        _worker.sveglia()
+    return id_msg
@@ -0,0 +1,375 @@
+"""Generazione dei PDF del test finale: report, badge e fogli d'esame cartacei.
+
+L'impaginazione è in un solo passaggio: i testi vanno a capo sulla larghezza
+della pagina (righe_a_capo, con le larghezze delle parole in cache: le stesse
+domande e opzioni ricorrono in tutti i report di una banca), le righe si
+scrivono in un unico oggetto testo per pagina e le parti fisse (intestazione
+delle pagine successive, sfondo del badge) sono form XObject definiti una volta
+per documento e richiamati su ogni pagina.
+
+Gli stream delle pagine sono compressi (pageCompression sul canvas). La
+codifica ASCII85 che reportlab aggiunge per default è un'impostazione di
+processo: per PDF più piccoli e veloci da salvare si può disattivarla
+all'avvio con la variabile d'ambiente RL_useA85=0.
+"""
+import io
+from datetime import date
+from functools import lru_cache
+
+import pandas as pd
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import A4, landscape
+
+from test_finale import SOGLIA_SUPERAMENTO
+
+# ============================================================
+# IMPAGINAZIONE
+# ============================================================
+MARGINE = 50
+MARGINE_BASSO = 50
+FONT = "Helvetica"
+FONT_GRASSETTO = "Helvetica-Bold"
+CORPO = 9
+INTERLINEA = 12
+SPAZIO_DOMANDE = 4                       # spazio extra tra una domanda e la successiva
+LARGHEZZA_RIGA = A4[0] - 2 * MARGINE     # ~495 pt utili in verticale
+
+NERO = (0.0, 0.0, 0.0)
+GRIGIO = (0.45, 0.45, 0.45)
+VERDE = (0.0, 0.5, 0.0)
+ROSSO = (0.75, 0.0, 0.0)
+ARANCIO = (0.8, 0.5, 0.0)
+COLORI_ESITO = {"CORRETTA": VERDE, "ERRATA": ROSSO, "NON RISPOSTA": ARANCIO}
+
+INTESTAZIONE = "intestazione"            # form XObject delle pagine dalla seconda in poi
+MODELLO_BADGE = "modello_badge"          # form XObject con sfondo, titolo e piè di pagina del badge
+
+
+@lru_cache(maxsize=65536)
+def larghezza_testo(testo: str, font: str = FONT, corpo: float = CORPO) -> float:
+    return stringWidth(testo, font, corpo)
+
+
+def _taglio(parola: str, limite: float, font: str, corpo: float) -> int:
+    """Quanti caratteri di una parola troppo lunga stanno in limite (almeno uno)."""
+    usata = 0.0
+    for k, carattere in enumerate(parola):
+        usata += larghezza_testo(carattere, font, corpo)
+        if usata > limite:
+            return max(k, 1)
+    return len(parola)
+
+
+@lru_cache(maxsize=16384)
+def righe_a_capo(testo: str, larghezza: float = LARGHEZZA_RIGA, font: str = FONT, corpo: float = CORPO,
+                 rientro: float = 0.0) -> tuple:
+    """
+    Testo spezzato a parole in righe larghe al più larghezza (le righe dopo la
+    prima al più larghezza - rientro); una parola più lunga della riga si spezza
+    a caratteri. Costo lineare nel numero di parole, le cui larghezze sono in cache.
+    """
+    spazio = larghezza_testo(" ", font, corpo)
+    righe, parole, usata, limite = [], [], 0.0, larghezza
+    for parola in testo.split():
+        w = larghezza_testo(parola, font, corpo)
+        if parole and usata + spazio + w > limite:
+            righe.append(" ".join(parole))
+            parole, usata, limite = [], 0.0, larghezza - rientro
+        while not parole and w > limite and len(parola) > 1:
+            k = _taglio(parola, limite, font, corpo)
+            righe.append(parola[:k])
+            parola = parola[k:]
+            w = larghezza_testo(parola, font, corpo)
+            limite = larghezza - rientro
+        usata = usata + spazio + w if parole else w
+        parole.append(parola)
+    if parole or not righe:
+        righe.append(" ".join(parole))
+    return tuple(righe)
+
+
+class _Impaginatore:
+    """
+    Scrive le righe di un documento in un solo passaggio: un oggetto testo per
+    pagina (non uno per riga), font, colore e posizione emessi solo quando
+    cambiano, nuova pagina quando il blocco successivo non ci sta.
+    """
+
+    def __init__(self, c, pagesize, intestazione: str = None):
+        self.c = c
+        self.larghezza, self.altezza = pagesize
+        self.intestazione = intestazione  # testo ripetuto in cima alle pagine dopo la prima
+        self._form_intestazione = False
+        self.y = self.altezza - MARGINE
+        self._apri_testo()
+
+    def _apri_testo(self):
+        self._testo = self.c.beginText()
+        self._font = self._colore = self._cursore = None
+
+    def spazio(self, pt: float) -> None:
+        self.y -= pt
+
+    def richiedi(self, altezza: float) -> None:
+        """Nuova pagina se un blocco alto altezza non sta in quella corrente (e la pagina non è vuota)."""
+        if self.y - altezza < MARGINE_BASSO and self.y < self.altezza - MARGINE:
+            self.nuova_pagina()
+
+    def nuova_pagina(self) -> None:
+        self.c.drawText(self._testo)
+        self.c.showPage()
+        if self.intestazione:
+            if not self._form_intestazione:  # definita alla prima pagina in più: i report di una pagina non la portano
+                _definisci_intestazione(self.c, self.intestazione, self.larghezza, self.altezza)
+                self._form_intestazione = True
+            self.c.doForm(INTESTAZIONE)
+        self.y = self.altezza - MARGINE
+        self._apri_testo()
+
+    def riga(self, testo: str, x: float = MARGINE, font: str = FONT, corpo: float = CORPO,
+             colore=NERO, interlinea: float = INTERLINEA) -> None:
+        if self.y < MARGINE_BASSO:
+            self.nuova_pagina()
+        t = self._testo
+        if self._font != (font, corpo, interlinea):
+            t.setFont(font, corpo, interlinea)
+            self._font = (font, corpo, interlinea)
+        if self._colore != colore:
+            t.setFillColorRGB(*colore)
+            self._colore = colore
+        if self._cursore != (x, self.y):
+            t.setTextOrigin(x, self.y)
+        t.textLine(testo)   # il cursore scende di interlinea (T*)
+        self.y -= interlinea
+        self._cursore = (x, self.y)
+
+    def paragrafo(self, righe, x: float = MARGINE, rientro: float = 0.0, **stile) -> None:
+        for k, testo in enumerate(righe):
+            self.riga(testo, x if k == 0 else x + rientro, **stile)
+
+    def chiudi(self) -> None:
+        self.c.drawText(self._testo)
+        self.c.showPage()
+        self.c.save()
+
+
+def _definisci_intestazione(c, testo: str, larghezza: float, altezza: float) -> None:
+    """Intestazione delle pagine successive alla prima: un form scritto una volta sola nel documento."""
+    c.beginForm(INTESTAZIONE)
+    c.setFillColorRGB(*GRIGIO)
+    c.setFont(FONT, 8)
+    c.drawString(MARGINE, altezza - 30, righe_a_capo(testo, larghezza - 2 * MARGINE, FONT, 8)[0])
+    c.setStrokeColorRGB(*GRIGIO)
+    c.setLineWidth(0.5)
+    c.line(MARGINE, altezza - 35, larghezza - MARGINE, altezza - 35)
+    c.endForm()
+
+
+def _data_str(data_test) -> str:
+    return data_test.strftime("%d/%m/%Y") if isinstance(data_test, date) else str(data_test)
+
+
+def _rientro(prefisso: str) -> float:
+    return larghezza_testo(prefisso, FONT, CORPO)
+
+
+def _intestazione_documento(pagine: _Impaginatore, titolo: str, dati: list, sezione: str, avviso: str = "") -> None:
+    """Titolo, righe di dati del partecipante, avviso (in rosso) e titolo della sezione delle domande."""
+    pagine.paragrafo(righe_a_capo(titolo, LARGHEZZA_RIGA, FONT_GRASSETTO, 16), font=FONT_GRASSETTO, corpo=16,
+                     interlinea=25)
+    for testo in dati:
+        pagine.paragrafo(righe_a_capo(testo, LARGHEZZA_RIGA, FONT, 10), corpo=10, interlinea=15)
+    if avviso:
+        pagine.spazio(5)
+        pagine.paragrafo(righe_a_capo(avviso, LARGHEZZA_RIGA, FONT_GRASSETTO, 10), font=FONT_GRASSETTO, corpo=10,
+                         interlinea=15, colore=ROSSO)
+    pagine.spazio(15)
+    pagine.paragrafo(righe_a_capo(sezione, LARGHEZZA_RIGA, FONT_GRASSETTO, 12), font=FONT_GRASSETTO, corpo=12,
+                     interlinea=20)
+
+
+def get_icon(esito: str) -> str:
+    esito = esito.upper()
+    if esito == "CORRETTA":
+        return "✅"
+    if esito == "ERRATA":
+        return "❌"
+    return "⚠️"
+
+
+def build_test_pdf(
+    nome: str,
+    corso: str,
+    argomento: str,
+    data_test: date,
+    punteggio: int,
+    percentuale: float,
+    superato: bool,
+    quiz_df: pd.DataFrame,
+    quiz_options,
+    quiz_correct_idx,
+    risposte_utente,
+    avviso: str = ""
+) -> bytes:
+    """
+    Genera un PDF con riepilogo completo del test finale (domande, risposte date, correttezza).
+    risposte_utente e quiz_correct_idx sono posizioni (0..3) in quiz_options, None se assenti.
+    avviso: testo evidenziato sotto i dati del partecipante (es. testi cambiati dopo il test).
+    """
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4, pageCompression=1)
+
+    data_str = _data_str(data_test)
+    corso_o_argomento = corso or argomento or "-"
+    esito_txt = "SUPERATO" if superato else "NON SUPERATO"
+
+    titolo = "Report Test finale formazione sicurezza"
+    pagine = _Impaginatore(c, A4, intestazione=f"{titolo} — {nome or '-'} — {corso_o_argomento} — {data_str}")
+    _intestazione_documento(pagine, titolo, [
+        f"Nome: {nome or '-'}",
+        f"Corso / Modulo: {corso_o_argomento}",
+        f"Data test finale: {data_str}",
+        f"Punteggio: {punteggio} / {len(quiz_df)} ({percentuale}%)",
+        f"Esito: {esito_txt} (soglia {SOGLIA_SUPERAMENTO}%)",
+    ], "Dettaglio domande test finale:", avviso)
+
+    rientro_risposta = _rientro("   ")
+    for i, domanda in enumerate(quiz_df["domanda"].astype(str).tolist()):
+        options = quiz_options[i]
+        scelta = risposte_utente[i]
+        correct_idx = quiz_correct_idx[i]
+
+        testo_corretta = options[correct_idx][1] if correct_idx is not None else ""
+        testo_scelta = options[scelta][1] if scelta is not None else None
+
+        # esito
+        if scelta is None:
+            esito = "NON RISPOSTA"
+        elif scelta == correct_idx:
+            esito = "CORRETTA"
+        else:
+            esito = "ERRATA"
+
+        prefisso = f"{i+1}. "
+        righe_domanda = righe_a_capo(prefisso + domanda, LARGHEZZA_RIGA, rientro=_rientro(prefisso))
+        larghezza_risposte = LARGHEZZA_RIGA - rientro_risposta
+        righe_data = righe_a_capo(f"Risposta data: {testo_scelta if testo_scelta else 'NON RISPOSTA'}",
+                                  larghezza_risposte, rientro=rientro_risposta)
+        righe_corretta = righe_a_capo(f"Risposta corretta: {testo_corretta}", larghezza_risposte,
+                                      rientro=rientro_risposta)
+
+        # la domanda resta intera sulla stessa pagina
+        pagine.richiedi((len(righe_domanda) + 1 + len(righe_data) + len(righe_corretta)) * INTERLINEA)
+        pagine.paragrafo(righe_domanda, rientro=_rientro(prefisso))
+        colore = COLORI_ESITO[esito]
+        pagine.riga(f"{get_icon(esito)} Esito: {esito}", colore=colore)
+        pagine.paragrafo(righe_data, x=MARGINE + rientro_risposta, rientro=rientro_risposta, colore=colore)
+        pagine.paragrafo(righe_corretta, x=MARGINE + rientro_risposta, rientro=rientro_risposta)
+        pagine.spazio(SPAZIO_DOMANDE)
+
+    pagine.chiudi()
+    pdf_bytes = buf.getvalue()
+    buf.close()
+    return pdf_bytes
+
+
+def _modello_badge(c, width: float, height: float) -> None:
+    """Sfondo, titolo e piè di pagina del badge: uguali per tutti i partecipanti."""
+    c.setFillColorRGB(0.94, 0.97, 0.99)
+    c.rect(0, 0, width, height, fill=1, stroke=0)
+
+    c.setFillColorRGB(0, 0, 0)
+    c.setFont("Helvetica-Bold", 22)
+    c.drawCentredString(width / 2, height - 70, "Badge superamento test finale")
+
+    c.setFont("Helvetica-Oblique", 10)
+    c.drawRightString(width - 40, 40, "Rilasciato automaticamente dal sistema di test finale sicurezza")
+
+
+def build_badges_pdf(badge) -> bytes:
+    """
+    Badge di più partecipanti in un unico PDF, una pagina ciascuno (A4 orizzontale).
+    badge: dict con nome, corso, data_test, percentuale; con più badge la parte
+    fissa è un solo form XObject condiviso da tutte le pagine.
+    """
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=landscape(A4), pageCompression=1)
+    width, height = landscape(A4)
+    condiviso = len(badge) > 1
+    if condiviso:
+        c.beginForm(MODELLO_BADGE)
+        _modello_badge(c, width, height)
+        c.endForm()
+
+    for b in badge:
+        if condiviso:
+            c.doForm(MODELLO_BADGE)
+        else:
+            _modello_badge(c, width, height)
+        c.setFillColorRGB(0, 0, 0)
+        c.setFont("Helvetica", 14)
+        c.drawCentredString(width / 2, height - 110, f"Nome: {b.get('nome') or '-'}")
+        c.drawCentredString(width / 2, height - 140, f"Corso: {b.get('corso') or '-'}")
+        c.drawCentredString(width / 2, height - 170, f"Data test finale: {_data_str(b.get('data_test'))}")
+        c.drawCentredString(width / 2, height - 200, f"Punteggio: {b.get('percentuale')}%")
+        c.showPage()
+
+    c.save()
+    pdf_bytes = buf.getvalue()
+    buf.close()
+    return pdf_bytes
+
+
+def build_badge_pdf(nome: str, corso: str, data_test: date, percentuale: float) -> bytes:
+    """Badge semplice di superamento test finale (A4 orizzontale)."""
+    return build_badges_pdf([{"nome": nome, "corso": corso, "data_test": data_test, "percentuale": percentuale}])
+
+
+def build_exam_pdf(
+    nome: str,
+    corso: str,
+    argomento: str,
+    data_test: date,
+    codice_variante: str,
+    quiz_df: pd.DataFrame,
+    quiz_options
+) -> bytes:
+    """Foglio d'esame cartaceo (stessa impaginazione del report): domande con opzioni A-D nell'ordine mescolato."""
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4, pageCompression=1)
+
+    data_str = _data_str(data_test)
+    corso_o_argomento = corso or argomento or "-"
+
+    titolo = "Test finale formazione sicurezza"
+    pagine = _Impaginatore(c, A4, intestazione=f"{titolo} — variante {codice_variante} — {nome or ''}")
+    _intestazione_documento(pagine, titolo, [
+        f"Nome: {nome or '_______________________________'}",
+        f"Corso / Modulo: {corso_o_argomento}",
+        f"Data test finale: {data_str}",
+        f"Codice variante: {codice_variante}",
+        f"Domande: {len(quiz_df)} — soglia di superamento {SOGLIA_SUPERAMENTO}%",
+    ], "Segnare una sola risposta per ogni domanda:")
+
+    lettere = "ABCD"
+    rientro_opzione = _rientro("   ")
+    for i, domanda in enumerate(quiz_df["domanda"].astype(str).tolist()):
+        prefisso = f"{i+1}. "
+        righe_domanda = righe_a_capo(prefisso + domanda, LARGHEZZA_RIGA, rientro=_rientro(prefisso))
+        righe_opzioni = []
+        for k, (_, txt) in enumerate(quiz_options[i]):
+            casella = f"[ ] {lettere[k]}) "
+            righe_opzioni.append((righe_a_capo(casella + str(txt), LARGHEZZA_RIGA - rientro_opzione,
+                                               rientro=_rientro(casella)), _rientro(casella)))
+
+        pagine.richiedi((len(righe_domanda) + sum(len(r) for r, _ in righe_opzioni)) * INTERLINEA)
+        pagine.paragrafo(righe_domanda, rientro=_rientro(prefisso))
+        for righe, rientro in righe_opzioni:
+            pagine.paragrafo(righe, x=MARGINE + rientro_opzione, rientro=rientro)
+        pagine.spazio(SPAZIO_DOMANDE)
+
+    pagine.chiudi()
+    pdf_bytes = buf.getvalue()
+    buf.close()
+    return pdf_bytes
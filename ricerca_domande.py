@@ -0,0 +1,328 @@
+"""Ricerca full-text nelle banche domande con un indice invertito per banca.
+
+Domanda, opzioni e riferimento normativo di ogni riga vengono normalizzati
+(minuscole, accenti rimossi, apostrofi separati, stopword italiane escluse,
+vocale finale tolta così singolare/plurale e maschile/femminile coincidono:
+'lavoratore' e 'lavoratori' -> 'lavorator') e indicizzati in un dizionario
+termine -> (righe, pesi). Una query interseca le liste dei suoi termini, con
+l'ultimo termine trattato come prefisso (ricerca mentre si scrive), e ordina
+per punteggio tf-idf (la domanda pesa il doppio di opzioni e riferimento).
+
+L'indice di ogni banca segue la cache di banca_dati: viene ricostruito solo
+quando cambia la versione del file, le altre banche restano indicizzate.
+
+Esempio:
+    python ricerca_domande.py "dispositivi protezione"
+"""
+import argparse
+import bisect
+import functools
+import math
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from banca_dati import CARTELLA_BANCHE, COLONNE_OPZIONI, BancaNonValida, carica_banca, list_quiz_files
+from metriche import misura
+
+# ============================================================
+# COSTANTI
+# ============================================================
+PESO_DOMANDA = 2.0
+PESO_ALTRI_CAMPI = 1.0
+MAX_ESPANSIONI_PREFISSO = 50
+LIMITE_RISULTATI = 100
+COLONNE_RISULTATO = [
+    "banca", "codice", "argomento", "domanda", *COLONNE_OPZIONI, "corretta", "riferimento", "scartata", "punteggio",
+]
+
+STOPWORD = frozenset("""
+a ad al allo ai agli all alla alle agl anche c ce che chi ci col come con contro cui da dal dallo dai dagli dall
+dalla dalle de degli dei del dell della delle dello di dov dove e ed era essere gli ha hanno i il in io l la le lei
+li lo loro lui ma mi ne negli nei nel nell nella nelle nello noi non o per piu po qual quale quali quando quanto
+quella quelle quelli quello questa queste questi questo se si sia sono su sua sue sugli sui sul sull sulla sulle
+sullo suo suoi tra tu un una uno vi voi
+""".split())
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_VOCALI = frozenset("aeiou")
+
+
+def _tabella_accenti() -> dict:
+    """Lettere latine accentate -> lettera base (è -> e, ò -> o, ...)."""
+    tabella = {}
+    for codice in range(0xC0, 0x250):
+        base = unicodedata.normalize("NFKD", chr(codice))[0]
+        if base != chr(codice) and base.isascii():
+            tabella[codice] = base
+    return tabella
+
+
+_ACCENTI = _tabella_accenti()
+
+
+# ============================================================
+# NORMALIZZAZIONE
+# ============================================================
+
+def radice(parola: str) -> str:
+    """Toglie la vocale finale alle parole lunghe: 'lavoratori'/'lavoratore' -> 'lavorator'."""
+    if len(parola) >= 5 and parola[-1] in _VOCALI:
+        return parola[:-1]
+    return parola
+
+
+@functools.lru_cache(maxsize=200_000)
+def _termine(parola: str) -> str:
+    """Termine indicizzato di una parola già in minuscolo e senza accenti ('' se esclusa)."""
+    if parola in STOPWORD or (len(parola) == 1 and not parola.isdigit()):
+        return ""
+    return radice(parola)
+
+
+def termini(testo) -> list:
+    """Termini normalizzati di un testo (senza stopword e parole di una lettera, numeri inclusi)."""
+    if not isinstance(testo, str) or not testo:
+        return []
+    return [t for t in map(_termine, _TOKEN.findall(testo.lower().translate(_ACCENTI))) if t]
+
+
+# ============================================================
+# INDICE PER BANCA
+# ============================================================
+
+@dataclass(frozen=True)
+class IndiceBanca:
+    """Indice invertito immutabile di una banca compilata."""
+    label: str
+    versione: tuple                 # versione della banca indicizzata (BancaCompilata.versione)
+    banca: object                   # BancaCompilata
+    postings: dict                  # termine -> (np.ndarray int32 righe ordinate, np.ndarray float32 pesi)
+    vocabolario: list               # termini ordinati (ricerca per prefisso)
+
+    def __len__(self):
+        return len(self.banca)
+
+    def frequenza(self, termine: str) -> int:
+        voce = self.postings.get(termine)
+        return 0 if voce is None else len(voce[0])
+
+    def espandi(self, prefisso: str) -> list:
+        """Termini del vocabolario che iniziano con prefisso (al più MAX_ESPANSIONI_PREFISSO)."""
+        i = bisect.bisect_left(self.vocabolario, prefisso)
+        trovati = []
+        while i < len(self.vocabolario) and self.vocabolario[i].startswith(prefisso):
+            trovati.append(self.vocabolario[i])
+            if len(trovati) >= MAX_ESPANSIONI_PREFISSO:
+                break
+            i += 1
+        return trovati
+
+
+def costruisci_indice(banca, label: str = "") -> IndiceBanca:
+    df = banca.df
+    altri = [
+        " ".join(str(v) for v in valori)
+        for valori in zip(*(df[c].tolist() for c in (*COLONNE_OPZIONI, "riferimento")))
+    ]
+    # (termine, riga, peso) per ogni occorrenza, poi raggruppati in blocco con numpy;
+    # le parole si normalizzano una sola volta (id -1 = parola esclusa)
+    id_termini = {}
+    id_parole = {}
+
+    def nuova_parola(parola):
+        t = _termine(parola)
+        id_parole[parola] = id_termini.setdefault(t, len(id_termini)) if t else -1
+        return id_parole[parola]
+
+    ids, lunghezze, pesi = [], [], []
+    for peso, testi in ((PESO_DOMANDA, df["domanda"].tolist()), (PESO_ALTRI_CAMPI, altri)):
+        for testo in testi:
+            testo = testo.lower() if isinstance(testo, str) else ""
+            if not testo.isascii():
+                testo = testo.translate(_ACCENTI)
+            parole = _TOKEN.findall(testo)
+            ids.extend([id_parole[p] if p in id_parole else nuova_parola(p) for p in parole])
+            lunghezze.append(len(parole))
+        pesi.append(peso)
+
+    ids = np.asarray(ids, dtype=np.int64)
+    lunghezze = np.asarray(lunghezze, dtype=np.int64)
+    n = max(len(df), 1)
+    righe = np.repeat(np.tile(np.arange(len(df), dtype=np.int64), len(pesi)), lunghezze)
+    pesi = np.repeat(np.repeat(np.asarray(pesi, dtype=np.float32), len(df)), lunghezze)
+    validi = ids >= 0
+    ids, righe, pesi = ids[validi], righe[validi], pesi[validi]
+
+    vocabolario = list(id_termini)
+    # una voce per (termine, riga) con i pesi sommati, ordinata per termine e riga
+    chiavi, inverso = np.unique(ids * n + righe, return_inverse=True)
+    pesi_uniti = np.bincount(inverso, weights=pesi, minlength=len(chiavi)).astype(np.float32)
+    termine_di, riga_di = np.divmod(chiavi, n)
+    confini = np.searchsorted(termine_di, np.arange(len(vocabolario) + 1))
+    postings = {
+        t: (riga_di[confini[i]:confini[i + 1]].astype(np.int32), pesi_uniti[confini[i]:confini[i + 1]])
+        for i, t in enumerate(vocabolario)
+    }
+    return IndiceBanca(label=label, versione=banca.versione, banca=banca, postings=postings,
+                       vocabolario=sorted(vocabolario))
+
+
+_lock = threading.Lock()
+_cache_indici = {}   # path -> IndiceBanca
+
+
+def indice_banca(label: str, path: str) -> IndiceBanca:
+    """Indice della banca, ricostruito solo se la banca è cambiata (stessa cache di carica_banca)."""
+    banca = carica_banca(path)
+    indice = _cache_indici.get(banca.path)
+    if indice is not None and indice.versione == banca.versione:
+        return indice
+    with _lock:
+        indice = _cache_indici.get(banca.path)
+        if indice is None or indice.versione != banca.versione:
+            with misura("indice_ricerca"):
+                indice = costruisci_indice(banca, label)
+            _cache_indici[banca.path] = indice
+        return indice
+
+
+def indici_cartella(cartella: str = CARTELLA_BANCHE) -> list:
+    """Indici di tutte le banche della cartella (le banche non leggibili vengono saltate)."""
+    indici = []
+    for label, path in list_quiz_files(cartella):
+        try:
+            indici.append(indice_banca(label, path))
+        except BancaNonValida:
+            continue
+    with _lock:
+        # scarta gli indici di banche non più presenti nella cartella
+        attivi = {ind.banca.path for ind in indici}
+        cartella_abs = os.path.abspath(cartella)
+        for p in list(_cache_indici):
+            if os.path.dirname(p) == cartella_abs and p not in attivi:
+                del _cache_indici[p]
+    return indici
+
+
+def svuota_cache():
+    with _lock:
+        _cache_indici.clear()
+
+
+# ============================================================
+# QUERY
+# ============================================================
+
+def _punteggi_banca(indice: IndiceBanca, gruppi, idf: dict, limite: int):
+    """
+    (righe, punteggi) delle migliori righe della banca che contengono un termine
+    di ogni gruppo (alternative di un termine della query, più di una per il prefisso).
+    """
+    n = len(indice)
+    totale = np.zeros(n, dtype=np.float32)
+    coperti = np.zeros(n, dtype=np.int16)
+    # dal gruppo più raro: se manca, la banca si scarta senza toccare le liste lunghe
+    for gruppo in sorted(gruppi, key=lambda g: sum(indice.frequenza(t) for t in g)):
+        voci = [(indice.postings[t], idf[t]) for t in gruppo if t in indice.postings]
+        if not voci:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        del_gruppo = np.zeros(n, dtype=np.float32)
+        for (righe, pesi), peso_idf in voci:
+            del_gruppo[righe] += pesi * peso_idf   # righe senza ripetizioni in ogni lista
+        totale += del_gruppo
+        coperti += del_gruppo > 0
+    righe = np.flatnonzero(coperti == len(gruppi))
+    punteggi = totale[righe]
+    if len(righe) > limite:
+        migliori = np.argpartition(-punteggi, limite - 1)[:limite]
+        righe, punteggi = righe[migliori], punteggi[migliori]
+    return righe, punteggi
+
+
+def cerca(query: str, cartella: str = CARTELLA_BANCHE, banche=None, limite: int = LIMITE_RISULTATI,
+          prefisso: bool = True) -> pd.DataFrame:
+    """
+    Righe che contengono tutti i termini della query, ordinate per punteggio.
+    banche: label delle banche in cui cercare (None = tutte). Con prefisso=True
+    l'ultimo termine vale anche come inizio di parola (se la query non finisce con uno spazio).
+    """
+    parole = termini(query)
+    if not parole:
+        return pd.DataFrame(columns=COLONNE_RISULTATO)
+    indici = [ind for ind in indici_cartella(cartella) if banche is None or ind.label in banche]
+
+    gruppi_per_indice = []
+    for ind in indici:
+        gruppi = [[p] for p in dict.fromkeys(parole)]
+        if prefisso and query == query.rstrip() and len(parole[-1]) >= 2:
+            gruppi[-1] = ind.espandi(parole[-1]) or [parole[-1]]
+        gruppi_per_indice.append(gruppi)
+
+    # idf sul totale delle banche selezionate
+    n_totale = sum(len(ind) for ind in indici) or 1
+    frequenze = defaultdict(int)
+    for ind, gruppi in zip(indici, gruppi_per_indice):
+        for t in {t for g in gruppi for t in g}:
+            frequenze[t] += ind.frequenza(t)
+    idf = {t: math.log(1 + n_totale / f) for t, f in frequenze.items() if f}
+
+    with misura("ricerca_domande"):
+        trovati = [(i, *_punteggi_banca(ind, gruppi, idf, limite))
+                   for i, (ind, gruppi) in enumerate(zip(indici, gruppi_per_indice))]
+        trovati = [(i, righe, punteggi) for i, righe, punteggi in trovati if len(righe)]
+        if not trovati:
+            return pd.DataFrame(columns=COLONNE_RISULTATO)
+        quale = np.concatenate([np.full(len(righe), i) for i, righe, _ in trovati])
+        righe = np.concatenate([righe for _, righe, _ in trovati])
+        punteggi = np.concatenate([punteggi for _, _, punteggi in trovati])
+        # punteggio decrescente, poi banca e riga (ordine stabile tra query uguali)
+        ordine = np.lexsort((righe, quale, -punteggi))[:limite]
+
+        parti = []
+        for i in np.unique(quale[ordine]):
+            posizioni = np.flatnonzero(quale[ordine] == i)   # posizioni nella classifica finale
+            sel = ordine[posizioni]
+            ind = indici[i]
+            colonne = [c for c in COLONNE_RISULTATO if c in ind.banca.df.columns]
+            parte = ind.banca.df.iloc[righe[sel]][colonne].reset_index(drop=True)
+            parte["banca"] = ind.label
+            parte["scartata"] = ind.banca.scartate[righe[sel]]
+            parte["punteggio"] = np.round(punteggi[sel].astype(np.float64), 2)
+            parte.index = posizioni
+            parti.append(parte)
+        risultati = pd.concat(parti).sort_index()
+    return risultati.reindex(columns=COLONNE_RISULTATO).reset_index(drop=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ricerca full-text nelle banche domande.")
+    parser.add_argument("query")
+    parser.add_argument("--cartella", default=CARTELLA_BANCHE)
+    parser.add_argument("--banca", action="append", help="cerca solo in questa banca (ripetibile)")
+    parser.add_argument("--limite", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    indici_cartella(args.cartella)
+    t_indice = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    risultati = cerca(args.query, args.cartella, args.banca, args.limite)
+    t_query = time.perf_counter() - t0
+
+    with pd.option_context("display.max_colwidth", 80, "display.width", 200):
+        print(risultati[["banca", "codice", "domanda", "punteggio"]].to_string(index=False))
+    print(f"{len(risultati)} risultati — indice {t_indice * 1000:.0f} ms, query {t_query * 1000:.1f} ms", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,427 @@
+"""Archivio risultati dei test finali su SQLite in modalità WAL.
+
+Ogni consegna è un INSERT in append (O(1)), serializzato da SQLite anche tra
+più processi; il vecchio risultati_test_finale.csv viene importato una sola
+volta alla prima apertura dell'archivio.
+
+Nella stessa transazione di ogni consegna vengono aggiornati gli aggregati per
+la dashboard (esiti per argomento/banca/ente/data e statistiche per domanda),
+così la lettura costa O(aggregati) e non O(storico).
+"""
+import json
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+# ============================================================
+# COSTANTI
+# ============================================================
+RISULTATI_DB = "risultati_test_finale.sqlite3"
+RISULTATI_CSV = "risultati_test_finale.csv"
+
+COLONNE_RISULTATI = (
+    "timestamp", "login_user", "user_ente", "user_role",
+    "nome_partecipante", "email_partecipante", "corso", "argomento",
+    "banca_domande", "data_test", "n_domande", "punteggio",
+    "percentuale", "superato", "seed", "chiave_consegna",
+    "risposte_domande", "riproduzione", "sessione_aula", "domande_estratte", "ticket",
+)
+
+# dimensioni degli aggregati esiti (colonne di risultati)
+DIMENSIONI_ANALISI = ("argomento", "banca_domande", "user_ente", "data_test")
+VERSIONE_AGGREGATI = "aggregati_v1"
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS risultati (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    {", ".join(f'"{c}"' for c in COLONNE_RISULTATI)}
+);
+CREATE INDEX IF NOT EXISTS idx_risultati_ente_data ON risultati (user_ente, data_test);
+CREATE TABLE IF NOT EXISTS meta (chiave TEXT PRIMARY KEY, valore TEXT);
+CREATE TABLE IF NOT EXISTS agg_esiti (
+    dimensione TEXT NOT NULL,
+    valore TEXT NOT NULL,
+    consegne INTEGER NOT NULL,
+    superati INTEGER NOT NULL,
+    somma_percentuale REAL NOT NULL,
+    PRIMARY KEY (dimensione, valore)
+);
+CREATE TABLE IF NOT EXISTS agg_domande (
+    banca_domande TEXT NOT NULL,
+    codice TEXT NOT NULL,
+    corretta TEXT,
+    presentazioni INTEGER NOT NULL,
+    corrette INTEGER NOT NULL,
+    non_risposte INTEGER NOT NULL,
+    scelte_a INTEGER NOT NULL,
+    scelte_b INTEGER NOT NULL,
+    scelte_c INTEGER NOT NULL,
+    scelte_d INTEGER NOT NULL,
+    PRIMARY KEY (banca_domande, codice)
+);
+"""
+
+_locale = threading.local()
+_lock_init = threading.Lock()
+_inizializzati = set()
+_errori_migrazione = {}  # path db -> messaggio dell'ultima migrazione CSV fallita
+
+
+# ============================================================
+# CONNESSIONE
+# ============================================================
+
+def connessione(path: str = RISULTATI_DB) -> sqlite3.Connection:
+    """Connessione per-thread all'archivio; crea schema e migra il CSV al primo uso."""
+    path = os.path.abspath(path)
+    conns = getattr(_locale, "conns", None)
+    if conns is None:
+        conns = _locale.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        conns[path] = conn
+    if path not in _inizializzati:
+        with _lock_init:
+            if path not in _inizializzati:
+                conn.executescript(_SCHEMA)
+                # archivi creati prima delle colonne chiave_consegna / risposte_domande / riproduzione /
+                # sessione_aula / domande_estratte / ticket
+                _assicura_colonne(conn, [
+                    "chiave_consegna", "risposte_domande", "riproduzione", "sessione_aula", "domande_estratte", "ticket",
+                ])
+                conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS idx_risultati_chiave ON risultati (chiave_consegna)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_risultati_sessione ON risultati (sessione_aula)")
+                # un ticket dell'API si consegna una volta sola (NULL per le consegne dalla pagina)
+                conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_risultati_ticket ON risultati (ticket)")
+                # codici_gia_estratti filtra per banca e partecipante: senza indice scandirebbe lo storico
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_risultati_email ON risultati (banca_domande, email_partecipante)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_risultati_nome ON risultati (banca_domande, nome_partecipante)"
+                )
+                csv_legacy = os.path.join(os.path.dirname(path), RISULTATI_CSV)
+                try:
+                    migra_da_csv(conn, csv_legacy)
+                    _errori_migrazione.pop(path, None)
+                except Exception as e:
+                    # il CSV resta intatto e verrà ritentato al prossimo avvio; i nuovi risultati si salvano comunque
+                    _errori_migrazione[path] = f"Migrazione di '{csv_legacy}' non riuscita: {e}"
+                if not conn.execute("SELECT 1 FROM meta WHERE chiave = ?", (VERSIONE_AGGREGATI,)).fetchone():
+                    ricostruisci_aggregati(conn)
+                _inizializzati.add(path)
+    return conn
+
+
+def errore_migrazione(path: str = RISULTATI_DB):
+    return _errori_migrazione.get(os.path.abspath(path))
+
+
+def _colonna(nome) -> str:
+    """Nome di colonna come identificatore SQL quotato (le intestazioni dei CSV migrati sono testo libero)."""
+    return '"' + str(nome).replace('"', '""') + '"'
+
+
+def _colonne_tabella(conn: sqlite3.Connection) -> set:
+    return {r[1] for r in conn.execute("PRAGMA table_info(risultati)")}
+
+
+def _assicura_colonne(conn: sqlite3.Connection, chiavi) -> None:
+    """Aggiunge alla tabella le colonne non ancora presenti (campi nuovi di riga_csv)."""
+    mancanti = [k for k in chiavi if k not in _colonne_tabella(conn)]
+    for k in mancanti:
+        try:
+            conn.execute(f"ALTER TABLE risultati ADD COLUMN {_colonna(k)}")
+        except sqlite3.OperationalError as e:
+            # aggiunta concorrente da un altro processo
+            if "duplicate column" not in str(e):
+                raise
+
+
+def _valore(v):
+    if v is None:
+        return None
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, (int, float, str, bytes)):
+        return v
+    try:
+        if pd.isna(v):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(v, "item"):  # scalari numpy
+        return v.item()
+    return str(v)
+
+
+# ============================================================
+# SCRITTURA
+# ============================================================
+
+def salva_risultati(righe, conn: sqlite3.Connection = None) -> int:
+    """
+    Inserisce più righe in un'unica transazione e aggiorna gli aggregati.
+    Ritorna il numero di righe scritte: quelle con una chiave_consegna già
+    presente vengono ignorate.
+    """
+    righe = list(righe)
+    if not righe:
+        return 0
+    conn = conn or connessione()
+    chiavi = list(dict.fromkeys(k for r in righe for k in r))
+    _assicura_colonne(conn, chiavi)
+
+    col_sql = ", ".join(_colonna(k) for k in chiavi)
+    segnaposto = ", ".join("?" for _ in chiavi)
+    sql = f"INSERT OR IGNORE INTO risultati ({col_sql}) VALUES ({segnaposto})"
+
+    scritte = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for r in righe:
+            cur = conn.execute(sql, tuple(_valore(r.get(k)) for k in chiavi))
+            if cur.rowcount == 1:
+                scritte += 1
+                _aggiorna_aggregati(conn, r)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return scritte
+
+
+def salva_risultato(riga: dict, conn: sqlite3.Connection = None) -> bool:
+    """Salva una riga; False se la stessa consegna (chiave_consegna) era già registrata."""
+    return salva_risultati([riga], conn=conn) == 1
+
+
+# ============================================================
+# AGGREGATI INCREMENTALI
+# ============================================================
+
+def _vero(v) -> int:
+    if isinstance(v, str):
+        return int(v.strip().lower() in ("1", "true", "vero", "si", "sì"))
+    return int(bool(v)) if v is not None and not pd.isna(v) else 0
+
+
+def _numero(v) -> float:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _aggiorna_aggregati(conn: sqlite3.Connection, riga: dict) -> None:
+    """Aggiunge una consegna agli aggregati (da chiamare dentro la transazione dell'INSERT)."""
+    superato = _vero(riga.get("superato"))
+    percentuale = _numero(riga.get("percentuale"))
+    conn.executemany(
+        "INSERT INTO agg_esiti (dimensione, valore, consegne, superati, somma_percentuale) VALUES (?, ?, 1, ?, ?) "
+        "ON CONFLICT (dimensione, valore) DO UPDATE SET consegne = consegne + 1, "
+        "superati = superati + excluded.superati, somma_percentuale = somma_percentuale + excluded.somma_percentuale",
+        [(dim, str(_valore(riga.get(dim)) or ""), superato, percentuale) for dim in DIMENSIONI_ANALISI],
+    )
+
+    dettaglio = riga.get("risposte_domande")
+    if not dettaglio or not isinstance(dettaglio, str):
+        return
+    banca = str(riga.get("banca_domande") or "")
+    valori = []
+    for codice, scelta, corretta in json.loads(dettaglio):
+        valori.append((
+            banca, str(codice), corretta,
+            int(bool(scelta) and scelta == corretta), int(not scelta),
+            int(scelta == "A"), int(scelta == "B"), int(scelta == "C"), int(scelta == "D"),
+        ))
+    conn.executemany(
+        "INSERT INTO agg_domande (banca_domande, codice, corretta, presentazioni, corrette, non_risposte, "
+        "scelte_a, scelte_b, scelte_c, scelte_d) VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (banca_domande, codice) DO UPDATE SET corretta = excluded.corretta, "
+        "presentazioni = presentazioni + 1, corrette = corrette + excluded.corrette, "
+        "non_risposte = non_risposte + excluded.non_risposte, scelte_a = scelte_a + excluded.scelte_a, "
+        "scelte_b = scelte_b + excluded.scelte_b, scelte_c = scelte_c + excluded.scelte_c, "
+        "scelte_d = scelte_d + excluded.scelte_d",
+        valori,
+    )
+
+
+def ricostruisci_aggregati(conn: sqlite3.Connection, blocco: int = 5000) -> None:
+    """Ricalcola da zero gli aggregati leggendo lo storico a blocchi (una tantum, es. dopo una migrazione)."""
+    colonne = ["id", "superato", "percentuale", "risposte_domande", *DIMENSIONI_ANALISI]
+    col_sql = ", ".join(_colonna(c) for c in colonne)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM agg_esiti")
+        conn.execute("DELETE FROM agg_domande")
+        ultimo_id = 0
+        while True:
+            righe = conn.execute(
+                f"SELECT {col_sql} FROM risultati "
+                "WHERE id > ? ORDER BY id LIMIT ?",
+                (ultimo_id, blocco),
+            ).fetchall()
+            if not righe:
+                break
+            for r in righe:
+                _aggiorna_aggregati(conn, dict(zip(colonne, r)))
+            ultimo_id = righe[-1][0]
+        conn.execute("INSERT OR REPLACE INTO meta (chiave, valore) VALUES (?, '1')", (VERSIONE_AGGREGATI,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def leggi_aggregati_esiti(dimensione: str, conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """Consegne, superati, tasso di superamento e percentuale media per valore della dimensione."""
+    conn = conn or connessione()
+    df = pd.read_sql_query(
+        "SELECT valore, consegne, superati, somma_percentuale FROM agg_esiti WHERE dimensione = ? ORDER BY valore",
+        conn, params=(dimensione,),
+    )
+    df["tasso_superamento"] = (df["superati"] / df["consegne"] * 100).round(1)
+    df["percentuale_media"] = (df["somma_percentuale"] / df["consegne"]).round(1)
+    return df.drop(columns="somma_percentuale").rename(columns={"valore": dimensione})
+
+
+def leggi_statistiche_domande(banca_domande: str = None, conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """
+    Statistiche per domanda: difficoltà (quota di risposte corrette), non risposte
+    e distribuzione delle scelte A-D con il distrattore più scelto.
+    """
+    conn = conn or connessione()
+    sql = "SELECT * FROM agg_domande"
+    params = ()
+    if banca_domande:
+        sql += " WHERE banca_domande = ?"
+        params = (banca_domande,)
+    df = pd.read_sql_query(sql, conn, params=params)
+    if df.empty:
+        return df
+    scelte = df[["scelte_a", "scelte_b", "scelte_c", "scelte_d"]].to_numpy()
+    corretta_idx = df["corretta"].map({"A": 0, "B": 1, "C": 2, "D": 3}).fillna(-1).astype(int).to_numpy()
+    distrattori = scelte.copy()
+    righe_valide = corretta_idx >= 0
+    distrattori[righe_valide, corretta_idx[righe_valide]] = -1
+    df["indice_difficolta"] = (df["corrette"] / df["presentazioni"]).round(3)
+    df["quota_non_risposte"] = (df["non_risposte"] / df["presentazioni"]).round(3)
+    df["distrattore_principale"] = [("ABCD"[i] if m > 0 else "") for i, m in zip(distrattori.argmax(axis=1), distrattori.max(axis=1))]
+    return df.sort_values("indice_difficolta").reset_index(drop=True)
+
+
+# ============================================================
+# MIGRAZIONE / LETTURA
+# ============================================================
+
+def migra_da_csv(conn: sqlite3.Connection, csv_path: str = RISULTATI_CSV) -> int:
+    """Importa una sola volta lo storico dal vecchio CSV. Il file originale non viene toccato."""
+    if not os.path.exists(csv_path):
+        return 0
+    chiave = f"migrato:{os.path.abspath(csv_path)}"
+    if conn.execute("SELECT 1 FROM meta WHERE chiave = ?", (chiave,)).fetchone():
+        return 0
+
+    # errori di parsing: si interrompe senza segnare la migrazione, lo storico resta nel CSV
+    df_old = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    if "superato" in df_old.columns:
+        df_old["superato"] = df_old["superato"].replace({"True": "1", "False": "0"})
+    righe = df_old.to_dict(orient="records")
+    _assicura_colonne(conn, df_old.columns)
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE chiave = ?", (chiave,)).fetchone():
+            conn.execute("ROLLBACK")
+            return 0
+        if righe:
+            col_sql = ", ".join(_colonna(k) for k in df_old.columns)
+            segnaposto = ", ".join("?" for _ in df_old.columns)
+            conn.executemany(
+                f"INSERT INTO risultati ({col_sql}) VALUES ({segnaposto})",
+                [tuple(r[k] if r[k] != "" else None for k in df_old.columns) for r in righe],
+            )
+        conn.execute("INSERT INTO meta (chiave, valore) VALUES (?, ?)", (chiave, str(len(righe))))
+        # lo storico importato entra negli aggregati alla prossima ricostruzione
+        conn.execute("DELETE FROM meta WHERE chiave = ?", (VERSIONE_AGGREGATI,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(righe)
+
+
+def leggi_risultati(where: str = "", params=(), conn: sqlite3.Connection = None) -> pd.DataFrame:
+    """Ritorna i risultati come DataFrame (filtro SQL opzionale, es. 'user_ente = ?')."""
+    conn = conn or connessione()
+    sql = "SELECT * FROM risultati"
+    if where:
+        sql += f" WHERE {where}"
+    sql += " ORDER BY id"
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+def itera_risultati(where: str = "", params=(), colonne=None, blocco: int = 1000,
+                    conn: sqlite3.Connection = None):
+    """
+    Risultati come dizionari, letti a blocchi di 'blocco' righe in ordine di id
+    (paginazione per id, memoria costante anche su tutto lo storico).
+    """
+    conn = conn or connessione()
+    col_sql = "*" if colonne is None else ", ".join(_colonna(c) for c in ["id", *colonne])
+    filtro = f"({where}) AND " if where else ""
+    ultimo_id = 0
+    while True:
+        cur = conn.execute(
+            f"SELECT {col_sql} FROM risultati WHERE {filtro}id > ? ORDER BY id LIMIT ?",
+            (*params, ultimo_id, blocco),
+        )
+        nomi = [d[0] for d in cur.description]
+        righe = cur.fetchall()
+        if not righe:
+            return
+        for r in righe:
+            yield dict(zip(nomi, r))
+        ultimo_id = righe[-1][nomi.index("id")]
+
+
+def conta_risultati(where: str = "", params=(), conn: sqlite3.Connection = None) -> int:
+    conn = conn or connessione()
+    sql = "SELECT COUNT(*) FROM risultati"
+    if where:
+        sql += f" WHERE {where}"
+    return conn.execute(sql, params).fetchone()[0]
+
+
+def consegna_del_ticket(ticket: str, conn: sqlite3.Connection = None):
+    """chiave_consegna registrata con questo ticket dell'API, None se non è ancora stato consegnato."""
+    conn = conn or connessione()
+    riga = conn.execute("SELECT chiave_consegna FROM risultati WHERE ticket = ?", (ticket,)).fetchone()
+    return riga[0] if riga else None
+
+
+def codici_gia_estratti(banca_domande: str, nome: str = "", email: str = "", conn: sqlite3.Connection = None) -> set:
+    """Codici delle domande già proposte al partecipante (per email se indicata, altrimenti per nome)."""
+    conn = conn or connessione()
+    if email:
+        filtro, valore = "email_partecipante = ?", email
+    elif nome:
+        filtro, valore = "nome_partecipante = ?", nome
+    else:
+        return set()
+    codici = set()
+    for (dettaglio,) in conn.execute(
+        f"SELECT risposte_domande FROM risultati WHERE banca_domande = ? AND {filtro} AND risposte_domande IS NOT NULL",
+        (banca_domande, valore),
+    ):
+        codici.update(codice for codice, _, _ in json.loads(dettaglio))
+    return codici
@@ -0,0 +1,144 @@
+"""Test adattivo: esito deciso con meno domande appena è statisticamente certo (SPRT di Wald).
+
+Le domande del test estratto si presentano una alla volta. Dopo ogni risposta
+si aggiorna il logaritmo del rapporto di verosimiglianza tra due ipotesi sulla
+probabilità p di rispondere correttamente: H1 p = p1 (preparato, sopra la
+soglia di SOGLIA_SUPERAMENTO) e H0 p = p0 (non preparato, sotto la soglia).
+Il test si ferma quando il rapporto supera i limiti di Wald, con errori
+alfa = superare pur essendo non preparato e beta = non superare pur essendo
+preparato; mai prima di `minimo` domande. Se si arriva a tutte le domande
+estratte senza decisione, vale la soglia come nel test classico.
+
+Una risposta non data conta come errata, come nella correzione classica.
+
+Esempio (simulazione: probabilità di superare e domande usate in media,
+confrontate con il test classico di --massimo domande):
+    python sequenziale.py --massimo 30 --alfa 0.05 --beta 0.05 --minimo 10
+"""
+import argparse
+import math
+import sys
+from dataclasses import dataclass
+
+import numpy as np
+
+from correzione import calcola_esito
+from test_finale import SOGLIA_SUPERAMENTO
+
+# ============================================================
+# COSTANTI
+# ============================================================
+ALFA = 0.05
+BETA = 0.05
+MARGINE = 0.10          # p0 = soglia - margine, p1 = soglia + margine (zona di indifferenza)
+MINIMO_DOMANDE = 10
+
+
+@dataclass(frozen=True)
+class ParametriSPRT:
+    alfa: float = ALFA
+    beta: float = BETA
+    minimo: int = MINIMO_DOMANDE
+    margine: float = MARGINE
+
+    def __post_init__(self):
+        soglia = SOGLIA_SUPERAMENTO / 100
+        if not (0 < self.alfa < 0.5 and 0 < self.beta < 0.5):
+            raise ValueError("alfa e beta devono essere tra 0 e 0.5")
+        if not (0 < self.margine < min(soglia, 1 - soglia)):
+            raise ValueError(f"margine deve essere tra 0 e {min(soglia, 1 - soglia):.2f}")
+        if self.minimo < 1:
+            raise ValueError("minimo deve essere almeno 1")
+
+    @property
+    def p0(self) -> float:
+        return SOGLIA_SUPERAMENTO / 100 - self.margine
+
+    @property
+    def p1(self) -> float:
+        return SOGLIA_SUPERAMENTO / 100 + self.margine
+
+    @property
+    def passi(self) -> tuple:
+        """Incremento del log-rapporto per risposta (corretta, errata)."""
+        return math.log(self.p1 / self.p0), math.log((1 - self.p1) / (1 - self.p0))
+
+    @property
+    def limiti(self) -> tuple:
+        """(limite di non superamento, limite di superamento) del log-rapporto."""
+        return math.log(self.beta / (1 - self.alfa)), math.log((1 - self.beta) / self.alfa)
+
+
+def arresto(esiti, parametri: ParametriSPRT, massimo: int) -> tuple:
+    """
+    (domande usate, superato) per le risposte date finora (esiti: True =
+    corretta, in ordine di presentazione), con superato = None se il test deve
+    continuare. Al massimo di domande decide la soglia (correzione.calcola_esito).
+    """
+    esiti = np.asarray(esiti, dtype=bool)[:massimo]
+    if len(esiti) == 0:
+        return 0, None
+    corretta, errata = parametri.passi
+    basso, alto = parametri.limiti
+    rapporto = np.cumsum(np.where(esiti, corretta, errata))
+    fuori = (rapporto <= basso) | (rapporto >= alto)
+    fuori[:min(parametri.minimo, massimo) - 1] = False
+    primi = np.flatnonzero(fuori)
+    if len(primi):
+        n = int(primi[0]) + 1
+        return n, bool(rapporto[n - 1] >= alto)
+    if len(esiti) >= massimo:
+        return massimo, calcola_esito(int(esiti.sum()), massimo)[1]
+    return len(esiti), None
+
+
+def simula(probabilita, parametri: ParametriSPRT, massimo: int, n: int = 20000, seed: int = 0) -> dict:
+    """
+    Monte Carlo per partecipanti con probabilità di risposta corretta p:
+    p -> (frazione di superati, domande usate in media, frazione di superati
+    del test classico con tutte le domande). Tutti i percorsi insieme con
+    numpy: costo O(n x massimo) per ogni p.
+    """
+    rng = np.random.default_rng(seed)
+    corretta, errata = parametri.passi
+    basso, alto = parametri.limiti
+    risultato = {}
+    for p in probabilita:
+        esiti = rng.random((n, massimo)) < p
+        rapporto = np.cumsum(np.where(esiti, corretta, errata), axis=1)
+        fuori = (rapporto <= basso) | (rapporto >= alto)
+        fuori[:, :min(parametri.minimo, massimo) - 1] = False
+        fermati = fuori.any(axis=1)
+        indice = np.where(fermati, fuori.argmax(axis=1), massimo - 1)
+        usate = indice + 1
+        classico = calcola_esito(esiti.sum(axis=1), massimo)[1]
+        superati = np.where(fermati, rapporto[np.arange(n), indice] >= alto, classico)
+        risultato[float(p)] = (float(superati.mean()), float(usate.mean()), float(classico.mean()))
+    return risultato
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulazione del test adattivo (SPRT): esiti e domande usate.")
+    parser.add_argument("--massimo", type=int, default=30, help="domande estratte (lunghezza massima)")
+    parser.add_argument("--alfa", type=float, default=ALFA, help="probabilità di superare da non preparato (p0)")
+    parser.add_argument("--beta", type=float, default=BETA, help="probabilità di non superare da preparato (p1)")
+    parser.add_argument("--minimo", type=int, default=MINIMO_DOMANDE)
+    parser.add_argument("--margine", type=float, default=MARGINE)
+    parser.add_argument("--simulazioni", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    try:
+        parametri = ParametriSPRT(args.alfa, args.beta, args.minimo, args.margine)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"p0 = {parametri.p0:.2f}, p1 = {parametri.p1:.2f}, massimo {args.massimo} domande, minimo {parametri.minimo}")
+    print(f"{'p':>5} {'superati':>9} {'domande':>8} {'superati classico':>18}")
+    for p, (superati, usate, classico) in simula(
+        np.arange(0.5, 1.0001, 0.05), parametri, args.massimo, args.simulazioni
+    ).items():
+        print(f"{p:5.2f} {superati:9.1%} {usate:8.1f} {classico:18.1%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
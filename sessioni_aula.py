@@ -0,0 +1,266 @@
+"""Sessioni d'aula: un docente apre una sessione e i partecipanti vi accedono con un codice.
+
+All'apertura vengono estratte una volta sola K varianti del test (banca,
+argomento e numero domande scelti dal docente) e salvate nell'archivio
+risultati; ogni partecipante che entra con il codice riceve la variante
+successiva con un solo UPDATE (O(1)), senza rieseguire l'estrazione.
+Le consegne portano il codice della sessione (colonna sessione_aula) per
+l'avanzamento in tempo reale e la correzione in blocco dei fogli cartacei.
+
+La variante i ha seed '<codice>-<i>': lo stesso test si ottiene con
+genera_test.py / correzione.py o inserendo il seed nell'app.
+"""
+import secrets
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from correzione import correggi_consegne
+from risultati import connessione
+from test_finale import estrai_variante
+
+# ============================================================
+# COSTANTI
+# ============================================================
+K_VARIANTI = 20
+MAX_VARIANTI = 500
+LUNGHEZZA_CODICE = 6
+ALFABETO_CODICE = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # senza 0/O e 1/I
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessioni_aula (
+    codice TEXT PRIMARY KEY,
+    aperta_il TEXT NOT NULL,
+    docente TEXT,
+    ente TEXT,
+    banca_domande TEXT NOT NULL,
+    path_banca TEXT NOT NULL,
+    versione_banca TEXT NOT NULL,
+    argomento TEXT NOT NULL,
+    corso TEXT,
+    data_test TEXT,
+    n_domande INTEGER NOT NULL,
+    k_varianti INTEGER NOT NULL,
+    righe BLOB NOT NULL,
+    permutazioni BLOB NOT NULL,
+    assegnate INTEGER NOT NULL DEFAULT 0,
+    aperta INTEGER NOT NULL DEFAULT 1
+);
+"""
+
+
+@dataclass(frozen=True)
+class SessioneAula:
+    """Sessione con il pool di varianti già estratto (immutabile: lo stato aperta/chiusa resta nel DB)."""
+    codice: str
+    docente: str
+    ente: str
+    banca_domande: str
+    path_banca: str
+    versione_banca: str      # firma del file della banca all'apertura (vedi _versione_contenuto)
+    argomento: str
+    corso: str
+    data_test: str
+    n_domande: int
+    righe: np.ndarray        # int32 K x n: posizioni di riga nella banca
+    permutazioni: np.ndarray  # uint8 K x n x 4, come estrai_variante
+
+    @property
+    def k_varianti(self) -> int:
+        return len(self.righe)
+
+    def seed_variante(self, i: int) -> str:
+        return f"{self.codice}-{i + 1}"
+
+    def compatibile(self, banca) -> bool:
+        """False se la banca è cambiata dopo l'apertura (le posizioni del pool non varrebbero più)."""
+        return _versione_contenuto(banca) == self.versione_banca
+
+    def variante(self, i: int):
+        """(righe, permutazioni) della variante i (0..K-1)."""
+        return self.righe[i], self.permutazioni[i]
+
+
+_lock = threading.Lock()
+_cache_sessioni = {}   # codice -> SessioneAula
+_inizializzati = set()
+
+
+def _connessione(conn: sqlite3.Connection = None) -> sqlite3.Connection:
+    conn = conn or connessione()
+    if id(conn) not in _inizializzati:
+        conn.executescript(_SCHEMA)
+        _inizializzati.add(id(conn))
+    return conn
+
+
+def _versione_contenuto(banca) -> str:
+    # firma del CSV (o del .arrow se la banca è solo compilata): compilare il CSV non cambia le righe
+    firma_csv, firma_arrow = banca.versione
+    return repr(firma_csv if firma_csv is not None else firma_arrow)
+
+
+def _nuovo_codice() -> str:
+    return "".join(secrets.choice(ALFABETO_CODICE) for _ in range(LUNGHEZZA_CODICE))
+
+
+# ============================================================
+# APERTURA E LETTURA
+# ============================================================
+
+def apri_sessione(banca, banca_domande: str, argomento: str, n_domande: int, k_varianti: int = K_VARIANTI,
+                  docente: str = "", ente: str = "", corso: str = "", data_test: str = "",
+                  conn: sqlite3.Connection = None) -> SessioneAula:
+    """Estrae il pool di K varianti e registra la sessione; ritorna la sessione con il nuovo codice."""
+    conn = _connessione(conn)
+    k_varianti = max(1, min(int(k_varianti), MAX_VARIANTI))
+    righe_argomento = banca.righe_argomento(argomento)
+    if len(righe_argomento) == 0:
+        raise ValueError(f"Nessuna domanda per l'argomento '{argomento}'.")
+
+    for _ in range(10):
+        codice = _nuovo_codice()
+        varianti = [estrai_variante(righe_argomento, n_domande, f"{codice}-{i + 1}") for i in range(k_varianti)]
+        righe = np.stack([r for r, _ in varianti]).astype(np.int32)
+        permutazioni = np.stack([p for _, p in varianti]).astype(np.uint8)
+        try:
+            conn.execute(
+                "INSERT INTO sessioni_aula (codice, aperta_il, docente, ente, banca_domande, path_banca, "
+                "versione_banca, argomento, corso, data_test, n_domande, k_varianti, righe, permutazioni) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    codice, datetime.now().isoformat(timespec="seconds"), docente, ente, banca_domande,
+                    banca.path, _versione_contenuto(banca), argomento, corso, str(data_test),
+                    righe.shape[1], k_varianti, righe.tobytes(), permutazioni.tobytes(),
+                ),
+            )
+        except sqlite3.IntegrityError:
+            continue  # codice già usato
+        return leggi_sessione(codice, conn=conn, anche_chiusa=True)
+    raise RuntimeError("Impossibile generare un codice di sessione univoco.")
+
+
+def _da_riga(r) -> SessioneAula:
+    (codice, docente, ente, banca_domande, path_banca, versione_banca, argomento, corso, data_test,
+     n_domande, k_varianti, righe, permutazioni) = r
+    return SessioneAula(
+        codice=codice,
+        docente=docente or "",
+        ente=ente or "",
+        banca_domande=banca_domande,
+        path_banca=path_banca,
+        versione_banca=versione_banca,
+        argomento=argomento,
+        corso=corso or "",
+        data_test=data_test or "",
+        n_domande=n_domande,
+        righe=np.frombuffer(righe, dtype=np.int32).reshape(k_varianti, n_domande),
+        permutazioni=np.frombuffer(permutazioni, dtype=np.uint8).reshape(k_varianti, n_domande, 4),
+    )
+
+
+def leggi_sessione(codice: str, conn: sqlite3.Connection = None, anche_chiusa: bool = False):
+    """Sessione con quel codice (None se inesistente o chiusa); il pool resta in cache nel processo."""
+    codice = (codice or "").strip().upper()
+    if not codice:
+        return None
+    conn = _connessione(conn)
+    stato = conn.execute("SELECT aperta FROM sessioni_aula WHERE codice = ?", (codice,)).fetchone()
+    if stato is None or (not stato[0] and not anche_chiusa):
+        return None
+
+    sessione = _cache_sessioni.get(codice)
+    if sessione is None:
+        r = conn.execute(
+            "SELECT codice, docente, ente, banca_domande, path_banca, versione_banca, argomento, corso, "
+            "data_test, n_domande, k_varianti, righe, permutazioni FROM sessioni_aula WHERE codice = ?",
+            (codice,),
+        ).fetchone()
+        sessione = _da_riga(r)
+        with _lock:
+            _cache_sessioni[codice] = sessione
+    return sessione
+
+
+def assegna_variante(sessione: SessioneAula, conn: sqlite3.Connection = None):
+    """Indice della variante del prossimo partecipante (a rotazione); None se la sessione è stata chiusa."""
+    conn = _connessione(conn)
+    r = conn.execute(
+        "UPDATE sessioni_aula SET assegnate = assegnate + 1 WHERE codice = ? AND aperta = 1 RETURNING assegnate",
+        (sessione.codice,),
+    ).fetchone()
+    if r is None:
+        return None
+    return (r[0] - 1) % sessione.k_varianti
+
+
+def chiudi_sessione_aula(codice: str, conn: sqlite3.Connection = None) -> None:
+    """Nessun nuovo ingresso; le consegne dei partecipanti già entrati restano valide."""
+    conn = _connessione(conn)
+    conn.execute("UPDATE sessioni_aula SET aperta = 0 WHERE codice = ?", (codice,))
+
+
+def sessioni_aperte(docente: str = None, conn: sqlite3.Connection = None) -> pd.DataFrame:
+    conn = _connessione(conn)
+    sql = ("SELECT codice, aperta_il, docente, banca_domande, argomento, corso, n_domande, k_varianti, assegnate "
+           "FROM sessioni_aula WHERE aperta = 1")
+    params = ()
+    if docente:
+        sql += " AND docente = ?"
+        params = (docente,)
+    return pd.read_sql_query(sql + " ORDER BY aperta_il DESC", conn, params=params)
+
+
+# ============================================================
+# AVANZAMENTO E CORREZIONE IN BLOCCO
+# ============================================================
+
+def avanzamento(codice: str, conn: sqlite3.Connection = None) -> dict:
+    """Partecipanti entrati, consegne, superati e percentuale media della sessione."""
+    conn = _connessione(conn)
+    r = conn.execute("SELECT assegnate FROM sessioni_aula WHERE codice = ?", (codice,)).fetchone()
+    consegne, superati, media = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(superato), 0), AVG(percentuale) FROM risultati WHERE sessione_aula = ?",
+        (codice,),
+    ).fetchone()
+    return {
+        "entrati": r[0] if r else 0,
+        "consegne": consegne,
+        "superati": int(superati),
+        "percentuale_media": round(media, 1) if media is not None else None,
+    }
+
+
+def correggi_fogli(sessione: SessioneAula, banca, consegne: pd.DataFrame, comuni: dict = None) -> pd.DataFrame:
+    """
+    Corregge in blocco fogli cartacei della sessione: colonne nome, risposte e
+    variante (1..K, come stampata sul foglio) oppure seed. Ritorna le righe dei risultati
+    (con chiave_consegna: ricorreggere gli stessi fogli non li salva due volte).
+    ValueError se la banca è cambiata dopo l'apertura: i seed estrarrebbero
+    domande diverse da quelle stampate sui fogli.
+    """
+    if not sessione.compatibile(banca):
+        raise ValueError(
+            "La banca domande è stata modificata dopo l'apertura della sessione: "
+            "i fogli non corrispondono più alle varianti e non possono essere corretti."
+        )
+    consegne = consegne.copy()
+    if "variante" in consegne:
+        varianti = pd.to_numeric(consegne["variante"], errors="coerce")
+        if varianti.isna().any() or not varianti.between(1, sessione.k_varianti).all():
+            raise ValueError(f"La colonna 'variante' deve contenere numeri tra 1 e {sessione.k_varianti}.")
+        consegne["seed"] = [sessione.seed_variante(int(v) - 1) for v in varianti]
+    elif "seed" not in consegne:
+        raise ValueError("Il CSV delle consegne deve avere le colonne 'risposte' e 'variante' o 'seed'.")
+
+    comuni = {
+        "banca_domande": sessione.banca_domande, "corso": sessione.corso, **(comuni or {}),
+        "sessione_aula": sessione.codice,
+    }
+    if sessione.data_test and "data_test" not in comuni:
+        comuni["data_test"] = sessione.data_test
+    return correggi_consegne(banca, sessione.argomento, sessione.n_domande, consegne, comuni)
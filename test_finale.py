@@ -0,0 +1,229 @@
+"""Logica del test finale indipendente da Streamlit: seed ed estrazione domande.
+
+Usata sia dall'app (prepara_test) sia dagli strumenti a riga di comando, così
+uno stesso seed produce ovunque lo stesso test.
+"""
+import hashlib
+import json
+import random
+import re
+from bisect import bisect_right
+
+import numpy as np
+import pandas as pd
+
+from banca_dati import LABELS
+
+# ============================================================
+# COSTANTI
+# ============================================================
+SOGLIA_SUPERAMENTO = 80.0
+MIN_DOMANDE = 10   # numero di domande ammesso per un test (pagina e API)
+MAX_DOMANDE = 50
+
+
+def seed_da_stringa(seed_str: str):
+    """Seed intero a 32 bit derivato via SHA-256 dalla stringa inserita (None se vuota)."""
+    seed_str = (seed_str or "").strip()
+    if not seed_str:
+        return None
+    return int(hashlib.sha256(seed_str.encode("utf-8")).hexdigest(), 16) % (2**32)
+
+
+def estrai_variante(righe_argomento, n_domande: int, seed_str: str = ""):
+    """
+    Forma compatta di un test: (righe, permutazioni).
+    righe: array int32 delle posizioni estratte tra righe_argomento;
+    permutazioni: matrice uint8 n x 4, per ogni domanda l'indice originale (0=A..3=D)
+    dell'opzione mostrata in ciascuna posizione.
+    """
+    seed_int = seed_da_stringa(seed_str)
+    righe_argomento = np.asarray(righe_argomento)
+
+    n = min(n_domande, len(righe_argomento))
+    righe = pd.Series(righe_argomento).sample(n=n, random_state=seed_int).to_numpy(dtype=np.int32)
+    rng = random.Random(seed_int)
+
+    permutazioni = np.empty((n, 4), dtype=np.uint8)
+    for k in range(n):
+        ordine = [0, 1, 2, 3]
+        rng.shuffle(ordine)
+        permutazioni[k] = ordine
+    return righe, permutazioni
+
+
+# ============================================================
+# ESTRAZIONE STRATIFICATA
+# ============================================================
+
+def interpreta_strati(testo: str) -> list:
+    """
+    'Art. 18-20: 10' / 'DVR: 5' (una riga o un ';' per strato) -> [(filtro, n), ...].
+    Righe vuote o senza numero vengono ignorate.
+    """
+    strati = []
+    for parte in re.split(r"[;\n]", testo or ""):
+        filtro, sep, n = parte.rpartition(":")
+        if sep and filtro.strip() and n.strip().isdigit() and int(n) > 0:
+            strati.append((filtro.strip(), int(n)))
+    return strati
+
+
+def gruppi_strato(banca, filtro: str) -> list:
+    """
+    Posizioni di riga selezionate da un filtro: un argomento (nome esatto) oppure
+    i riferimenti che contengono il testo; 'Art. 18-20' vale per Art. 18, 19 e 20.
+    Lavora sugli indici precompilati della banca, senza scorrere le righe.
+    """
+    filtro_lower = filtro.lower()
+    for arg in banca.argomenti:
+        if str(arg).lower() == filtro_lower:
+            return [banca.righe_argomento(arg)]
+
+    intervallo = re.fullmatch(r"(.*?)(\d+)\s*[-–]\s*(\d+)", filtro.strip())
+    if intervallo and abs(int(intervallo.group(3)) - int(intervallo.group(2))) <= 500:
+        prefisso, da, a = intervallo.group(1), int(intervallo.group(2)), int(intervallo.group(3))
+        testi = [f"{prefisso}{k}" for k in range(min(da, a), max(da, a) + 1)]
+    else:
+        testi = [filtro]
+    modelli = [re.compile(re.escape(t) + r"(?!\d)", re.IGNORECASE) for t in testi]
+    return [
+        pos for rif, pos in banca.indice_riferimenti.items()
+        if any(m.search(rif) for m in modelli)
+    ]
+
+
+def _estrai_da_gruppi(rng, gruppi, k: int, escludi, scelte: set, duplicati=None, usati=None) -> list:
+    """
+    k posizioni distinte dall'unione dei gruppi con Fisher-Yates parziale su un
+    indice virtuale (dict degli scambi): costo O(k + esclusi incontrati), non
+    O(dimensione dei gruppi). Le posizioni in escludi si usano solo se non basta il resto.
+    Con duplicati (gruppo di quasi duplicati per posizione, -1 = nessuno) si
+    prende al più una posizione per gruppo; usati raccoglie i gruppi già presi.
+    """
+    inizi = []
+    totale = 0
+    for g in gruppi:
+        inizi.append(totale)
+        totale += len(g)
+
+    scambi = {}
+    estratte = []
+    rimandate = []
+    j = 0
+    while len(estratte) < k and j < totale:
+        r = rng.randrange(j, totale)
+        virtuale = scambi.get(r, r)
+        scambi[r] = scambi.get(j, j)
+        j += 1
+        g = bisect_right(inizi, virtuale) - 1
+        pos = int(gruppi[g][virtuale - inizi[g]])
+        if pos in scelte:
+            continue
+        if pos in escludi:
+            rimandate.append(pos)
+            continue
+        if duplicati is not None and not _gruppo_libero(duplicati, usati, pos):
+            continue
+        scelte.add(pos)
+        estratte.append(pos)
+    for pos in rimandate:
+        if len(estratte) >= k:
+            break
+        if duplicati is not None and not _gruppo_libero(duplicati, usati, pos):
+            continue
+        scelte.add(pos)
+        estratte.append(pos)
+    return estratte
+
+
+def _gruppo_libero(duplicati, usati: set, pos: int) -> bool:
+    """True (e il gruppo di pos diventa usato) se nessun quasi duplicato di pos è già nel test."""
+    gruppo = int(duplicati[pos])
+    if gruppo < 0:
+        return True
+    if gruppo in usati:
+        return False
+    usati.add(gruppo)
+    return True
+
+
+def estrai_stratificata(banca, strati, seed_str: str = "", escludi=(), duplicati=None):
+    """
+    Come estrai_variante, ma da più strati [(filtro, n), ...] (vedi gruppi_strato)
+    e senza ripetere le posizioni in escludi (domande dei tentativi precedenti)
+    finché ce ne sono altre. Con duplicati (duplicati.gruppi_banca) al più una
+    domanda per gruppo di quasi duplicati. Deterministica per seed; costo O(n_domande).
+    """
+    rng = random.Random(seed_da_stringa(seed_str))
+    escludi = set(int(p) for p in escludi)
+    scelte = set()
+    usati = set()
+    righe = []
+    for filtro, n in strati:
+        gruppi = filtro if not isinstance(filtro, str) else gruppi_strato(banca, filtro)
+        righe.extend(_estrai_da_gruppi(rng, gruppi, n, escludi, scelte, duplicati, usati))
+
+    permutazioni = np.empty((len(righe), 4), dtype=np.uint8)
+    for k in range(len(righe)):
+        ordine = [0, 1, 2, 3]
+        rng.shuffle(ordine)
+        permutazioni[k] = ordine
+    return np.asarray(righe, dtype=np.int32), permutazioni
+
+
+def posizione_corretta(ordine, corretta_idx: int):
+    """Posizione (0..3) in cui è mostrata l'opzione corretta; None se 'corretta' non è valida."""
+    if corretta_idx < 0:
+        return None
+    return int(np.flatnonzero(np.asarray(ordine) == corretta_idx)[0])
+
+
+def estrai_test(df_topic: pd.DataFrame, n_domande: int, seed_str: str = ""):
+    """
+    Estrae n_domande dal DataFrame dell'argomento e mescola le opzioni di ogni domanda.
+    Ritorna (quiz_df, quiz_options, quiz_correct_idx) con i testi già risolti.
+    """
+    righe, permutazioni = estrai_variante(np.arange(len(df_topic)), n_domande, seed_str)
+    quiz_df = df_topic.iloc[righe].reset_index(drop=True)
+
+    quiz_options = []
+    quiz_correct_idx = []
+
+    colonne = ("opzione_a", "opzione_b", "opzione_c", "opzione_d", "corretta")
+    for ordine, (a, b, c, d, corretta) in zip(permutazioni, zip(*(quiz_df[col].tolist() for col in colonne))):
+        testi = (a, b, c, d)
+        options = [(LABELS[j], testi[j]) for j in ordine]
+        corretta_label = str(corretta).strip().upper()
+        corretta_idx = LABELS.index(corretta_label) if corretta_label in LABELS else -1
+        quiz_options.append(options)
+        quiz_correct_idx.append(posizione_corretta(ordine, corretta_idx))
+
+    return quiz_df, quiz_options, quiz_correct_idx
+
+
+def materializza_test(banca, righe, permutazioni):
+    """Risolve dalla banca condivisa i testi di un test in forma compatta: (quiz_df, quiz_options, quiz_correct_idx)."""
+    quiz_df = banca.df.iloc[righe].reset_index(drop=True)
+    quiz_options = []
+    quiz_correct_idx = []
+    for pos, ordine in zip(righe, permutazioni):
+        testi = banca.opzioni[pos]
+        quiz_options.append([(LABELS[j], testi[j]) for j in ordine])
+        quiz_correct_idx.append(posizione_corretta(ordine, banca.corretta_idx[pos]))
+    return quiz_df, quiz_options, quiz_correct_idx
+
+
+def dettaglio_risposte(codici, corretta_idx, permutazioni, risposte) -> str:
+    """
+    JSON compatto per le statistiche per domanda: [[codice, scelta, corretta], ...]
+    con lettere riferite all'ordine originale della banca ("" = non risposta / non valida).
+    risposte: posizioni mostrate (0..3) o None/-1; permutazioni None = ordine originale.
+    """
+    dettaglio = []
+    for k, (codice, corretta, scelta) in enumerate(zip(codici, corretta_idx, risposte)):
+        originale = ""
+        if scelta is not None and 0 <= int(scelta) <= 3:
+            originale = LABELS[int(permutazioni[k][int(scelta)]) if permutazioni is not None else int(scelta)]
+        dettaglio.append([str(codice), originale, LABELS[int(corretta)] if int(corretta) >= 0 else ""])
+    return json.dumps(dettaglio, ensure_ascii=False, separators=(",", ":"))
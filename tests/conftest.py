@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# i moduli dell'app sono file al primo livello del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(autouse=True)
+def cartella_di_lavoro(tmp_path, monkeypatch):
+    """Archivi, outbox e metriche (path relativi) in una cartella temporanea per ogni test."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
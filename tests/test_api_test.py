@@ -0,0 +1,114 @@
+import base64
+import http.client
+import json
+import os
+import threading
+
+import pytest
+
+import api_test
+import utenti
+from test_banca_dati import _banca_df
+
+PASSWORD = "segreta"
+
+
+@pytest.fixture
+def server(cartella_di_lavoro):
+    # cartella predefinita delle banche, relativa alla cartella di lavoro del test
+    (cartella_di_lavoro / "banche_dati_quiz").mkdir()
+    _banca_df(["X"] * 60).to_csv(cartella_di_lavoro / "banche_dati_quiz" / "B.csv", index=False)
+    hash_pw = utenti.hash_password(PASSWORD, iterazioni=1000)
+    (cartella_di_lavoro / "utenti_test_finale.csv").write_text(
+        "username,password,ruolo,ente\n"
+        f"u1,{hash_pw},Partecipante,E1\n"
+        f"u2,{hash_pw},Partecipante,E2\n"
+        f"doc1,{hash_pw},Docente,E1\n"
+        f"doc2,{hash_pw},Docente,E2\n"
+        f"admin,{hash_pw},RSPP,E2\n",
+        encoding="utf-8",
+    )
+    srv = api_test.crea_server("127.0.0.1", 0)
+    threading.Thread(target=srv.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+    yield srv.server_address[1]
+    srv.shutdown()
+    srv.server_close()
+
+
+def _richiesta(porta, metodo, percorso, corpo=None, utente="u1", header=None):
+    conn = http.client.HTTPConnection("127.0.0.1", porta, timeout=5)
+    credenziali = base64.b64encode(f"{utente}:{PASSWORD}".encode()).decode()
+    intestazioni = {"Authorization": f"Basic {credenziali}", **(header or {})}
+    dati = json.dumps(corpo).encode() if corpo is not None else None
+    if dati is not None and "Content-Length" not in intestazioni:
+        intestazioni["Content-Length"] = str(len(dati))
+    conn.putrequest(metodo, percorso)
+    for k, v in intestazioni.items():
+        conn.putheader(k, v)
+    conn.endheaders(dati)
+    risposta = conn.getresponse()
+    contenuto = risposta.read()
+    conn.close()
+    if risposta.getheader("Content-Type", "").startswith("application/json"):
+        contenuto = json.loads(contenuto)
+    return risposta.status, contenuto
+
+
+@pytest.mark.parametrize("lunghezza", ["-1", "abc", "1e3"])
+def test_content_length_non_valido(server, lunghezza):
+    stato, corpo = _richiesta(server, "POST", "/api/test", {"banca": "B"}, header={"Content-Length": lunghezza})
+    assert stato == 400
+    assert "Content-Length" in corpo["errore"]
+
+
+def test_corpo_troppo_grande(server):
+    stato, _ = _richiesta(server, "POST", "/api/test", {}, header={"Content-Length": str(api_test.MAX_CORPO_BYTE + 1)})
+    assert stato == 413
+
+
+@pytest.mark.parametrize("n_domande", ["abc", 5000, 0, 9, 51, -3, 12.5, True, None])
+def test_n_domande_fuori_limiti(server, n_domande):
+    stato, corpo = _richiesta(server, "POST", "/api/test", {"banca": "B", "argomento": "X", "n_domande": n_domande})
+    assert stato == 400
+    assert "n_domande" in corpo["errore"]
+
+
+@pytest.mark.parametrize("n_domande, attese", [(None, 30), ("20", 20), (50, 50)])
+def test_n_domande_nei_limiti(server, n_domande, attese):
+    richiesta = {"banca": "B", "argomento": "X"}
+    if n_domande is not None:
+        richiesta["n_domande"] = n_domande
+    stato, corpo = _richiesta(server, "POST", "/api/test", richiesta)
+    assert stato == 200
+    assert len(corpo["domande"]) == attese
+
+
+def _consegna(porta, utente="u1"):
+    _, test = _richiesta(porta, "POST", "/api/test", {"banca": "B", "argomento": "X"}, utente=utente)
+    stato, esito = _richiesta(porta, "POST", "/api/consegne", {
+        "ticket": test["ticket"], "risposte": [0] * len(test["domande"]), "partecipante": {"nome": "Mario"},
+    }, utente=utente)
+    assert stato == 201
+    return esito["chiave_consegna"]
+
+
+@pytest.mark.parametrize("utente, stato_atteso", [
+    ("u1", 200), ("doc1", 200), ("admin", 200), ("u2", 404), ("doc2", 404),
+])
+def test_risultati_visibili_per_ente(server, utente, stato_atteso):
+    chiave = _consegna(server)
+    assert _richiesta(server, "GET", f"/api/risultati/{chiave}", utente=utente)[0] == stato_atteso
+    assert _richiesta(server, "GET", f"/api/risultati/{chiave}/pdf", utente=utente)[0] == stato_atteso
+
+
+def test_consegna_con_banca_cambiata(server):
+    _, test = _richiesta(server, "POST", "/api/test", {"banca": "B", "argomento": "X"})
+    df = _banca_df(["X"] * 60)
+    df["corretta"] = "B"
+    df.to_csv(os.path.join("banche_dati_quiz", "B.csv"), index=False)
+    os.utime(os.path.join("banche_dati_quiz", "B.csv"), ns=(1, 1))
+    stato, corpo = _richiesta(server, "POST", "/api/consegne", {
+        "ticket": test["ticket"], "risposte": [0] * len(test["domande"]), "partecipante": {"nome": "Mario"},
+    })
+    assert stato == 409
+    assert "banca" in corpo["errore"].lower()
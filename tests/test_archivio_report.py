@@ -0,0 +1,71 @@
+import base64
+import os
+import re
+import zlib
+
+import numpy as np
+
+import archivio_report
+from archivio_report import CacheDiscoPDF, genera_pdf, record_riproduzione
+from banca_dati import carica_banca
+from test_banca_dati import _banca_df
+
+
+def _testo_pdf(dati: bytes) -> bytes:
+    flussi = re.findall(rb"stream\r?\n(.*?)endstream", dati, re.DOTALL)
+    # stream compressi e codificati ASCII85 (predefinito di reportlab)
+    return b"".join(zlib.decompress(base64.a85decode(f.strip().removesuffix(b"~>"))) for f in flussi)
+
+
+def _riga(cartella):
+    (cartella / "banche").mkdir()
+    path = cartella / "banche" / "B.csv"
+    _banca_df(["X"] * 5).to_csv(path, index=False)
+    banca = carica_banca(str(path))
+    righe = np.array([0, 1, 2])
+    permutazioni = np.tile(np.arange(4, dtype=np.uint8), (3, 1))
+    riga = {
+        "banca_domande": "B", "nome_partecipante": "Mario", "data_test": "2025-01-01",
+        "punteggio": 3, "percentuale": 100.0, "superato": True,
+        "riproduzione": record_riproduzione(banca, righe, permutazioni, [0, 0, 0]),
+    }
+    return riga, path
+
+
+def test_report_dichiara_testi_cambiati(cartella_di_lavoro):
+    riga, path = _riga(cartella_di_lavoro)
+    cartella_banche = str(cartella_di_lavoro / "banche")
+    assert not archivio_report.testi_cambiati(riga, cartella_banche)
+    assert b"ATTENZIONE" not in _testo_pdf(genera_pdf(riga, "test", cartella_banche))
+
+    df = _banca_df(["X"] * 5)
+    df.loc[1, "domanda"] = "Domanda riscritta?"
+    df.to_csv(path, index=False)
+    os.utime(path, ns=(1, 1))
+    assert archivio_report.testi_cambiati(riga, cartella_banche)
+    assert b"ATTENZIONE" in _testo_pdf(genera_pdf(riga, "test", cartella_banche))
+
+
+def test_cache_pdf_potata_senza_riscorrere_a_ogni_scrittura(cartella_di_lavoro, monkeypatch):
+    cache = CacheDiscoPDF(str(cartella_di_lavoro / "cache"), max_byte=1000)
+    scansioni = []
+    originale = cache._scansiona
+    monkeypatch.setattr(cache, "_scansiona", lambda: scansioni.append(1) or originale())
+
+    for i in range(20):
+        cache.put(f"k{i}", b"x" * 100)
+        dimensione = sum(e.stat().st_size for e in os.scandir(cache.cartella))
+        assert dimensione <= 1000
+    assert cache.get("k19") == b"x" * 100
+    assert cache.get("k0") is None
+    # prima scrittura più una potatura ogni ~100 byte oltre la quota (90%)
+    assert len(scansioni) < 20 / 2
+
+
+def test_nome_file_report_senza_percorsi():
+    riga = {"nome_partecipante": "../../etc/passwd", "corso": "Corso A: base", "data_test": "2025-01-01"}
+    nome = archivio_report.nome_file_report(riga, "test")
+
+    assert nome == "20250101_Corso_A__base__._etc_passwd_test_finale.pdf"
+    assert "/" not in nome and "\\" not in nome and ".." not in nome
+    assert archivio_report.nome_file_report({}, "badge") == "data_test_finale_partecipante_badge_test_finale.pdf"
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from banca_dati import carica_banca, compila_banca, leggi_banca_compilata, salva_banca_compilata
+from test_finale import estrai_stratificata, interpreta_strati
+
+
+def _banca_df(argomenti, riferimenti=None):
+    n = len(argomenti)
+    df = pd.DataFrame({
+        "argomento": argomenti,
+        "codice": [f"c{i}" for i in range(n)],
+        "domanda": [f"Domanda {i}?" for i in range(n)],
+        "opzione_a": [f"a{i}" for i in range(n)],
+        "opzione_b": [f"b{i}" for i in range(n)],
+        "opzione_c": [f"c{i}" for i in range(n)],
+        "opzione_d": [f"d{i}" for i in range(n)],
+        "corretta": ["A"] * n,
+    })
+    if riferimenti is not None:
+        df["riferimento"] = riferimenti
+    return df
+
+
+def _codici(banca, righe):
+    return banca.df["codice"].to_numpy()[righe].tolist()
+
+
+def test_indice_argomenti_con_argomento_mancante():
+    # le posizioni devono essere righe del DataFrame, non della serie senza NaN
+    banca = compila_banca(_banca_df([np.nan, "X", "Y", "X"]))
+    assert banca.argomenti == ["X", "Y"]
+    assert _codici(banca, banca.righe_argomento("X")) == ["c1", "c3"]
+    assert _codici(banca, banca.righe_argomento("Y")) == ["c2"]
+    assert banca.df_argomento("X")["codice"].tolist() == ["c1", "c3"]
+
+
+def test_indice_argomenti_da_csv_con_argomento_vuoto(tmp_path):
+    path = tmp_path / "banca.csv"
+    _banca_df(["", "X", "Y", "X"]).to_csv(path, index=False)
+    banca = carica_banca(str(path))
+    assert _codici(banca, banca.righe_argomento("X")) == ["c1", "c3"]
+
+
+def test_indice_riferimenti_con_riferimento_vuoto():
+    # le righe senza riferimento sono filtrate prima del groupby: le posizioni vanno riportate a df
+    banca = compila_banca(_banca_df(["X"] * 5, ["", "Art. 18", "DVR", "Art. 18", np.nan]))
+    assert _codici(banca, banca.righe_riferimento("Art. 18")) == ["c1", "c3"]
+    assert _codici(banca, banca.righe_riferimento("DVR")) == ["c2"]
+
+
+def test_strato_per_riferimento_estrae_le_righe_giuste():
+    banca = compila_banca(_banca_df(["X"] * 6, ["", "Art. 18", "", "Art. 19", "DVR", "Art. 20"]))
+    for seed in ("a", "b", "c"):
+        righe, _ = estrai_stratificata(banca, interpreta_strati("Art. 18-20: 3"), seed)
+        assert sorted(_codici(banca, righe)) == ["c1", "c3", "c5"]
+
+
+def test_indici_dopo_compilazione_arrow(tmp_path):
+    banca = compila_banca(_banca_df([np.nan, "X", "Y", "X", "X"], ["", "Art. 18", "DVR", "Art. 18", np.nan]))
+    path = str(tmp_path / "banca.arrow")
+    salva_banca_compilata(banca, path)
+    letta = leggi_banca_compilata(path)
+    assert _codici(letta, letta.righe_argomento("X")) == ["c1", "c3", "c4"]
+    assert _codici(letta, letta.righe_riferimento("Art. 18")) == ["c1", "c3"]
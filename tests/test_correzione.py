@@ -0,0 +1,87 @@
+import json
+
+import pandas as pd
+import pytest
+
+from archivio_report import genera_pdf, ricostruisci_test
+from banca_dati import carica_banca, compila_banca
+from correzione import correggi_consegne
+from risultati import connessione, salva_risultati
+from test_banca_dati import _banca_df
+
+
+def test_consegna_senza_seed_ne_codici_rifiutata():
+    banca = compila_banca(_banca_df(["X"] * 12))
+    consegne = pd.DataFrame({
+        "nome": ["A", "B", "C"],
+        "seed": ["s1", "", " "],
+        "codici": ["", "", ""],
+        "risposte": ["AAAAA", "AAAAA", "AAAAA"],
+    })
+    with pytest.raises(ValueError, match="righe del CSV: 3, 4"):
+        correggi_consegne(banca, "X", 5, consegne)
+
+
+def test_consegne_con_seed_o_codici():
+    banca = compila_banca(_banca_df(["X"] * 12))
+    consegne = pd.DataFrame({
+        "nome": ["A", "B"],
+        "seed": ["s1", ""],
+        "codici": ["", "c0;c1;c2"],
+        "risposte": ["AAAAA", "AAB"],
+    })
+    out = correggi_consegne(banca, "X", 5, consegne)
+    assert out["n_domande"].tolist() == [5, 3]
+    assert out["punteggio"].tolist()[1] == 2
+
+
+def _consegne_cartacee():
+    return pd.DataFrame({
+        "nome": ["Anna", "Bruno", "Carla"],
+        "seed": ["s1", "s2", ""],
+        "codici": ["", "", "c0;c1;c2"],
+        "risposte": ["ABCDA", "A;B;;D;A", "AAB"],
+    })
+
+
+def test_reimportare_gli_stessi_fogli_non_duplica(cartella_di_lavoro):
+    (cartella_di_lavoro / "banche").mkdir()
+    _banca_df(["X"] * 12).to_csv(cartella_di_lavoro / "banche" / "B.csv", index=False)
+    banca = carica_banca(str(cartella_di_lavoro / "banche" / "B.csv"))
+    conn = connessione(str(cartella_di_lavoro / "risultati.sqlite3"))
+    comuni = {"banca_domande": "B", "corso": "Preposti", "data_test": "2025-02-01"}
+
+    prima = correggi_consegne(banca, "X", 5, _consegne_cartacee(), comuni)
+    assert prima["chiave_consegna"].is_unique
+    assert salva_risultati(prima.to_dict(orient="records"), conn=conn) == 3
+    # stesso CSV, con le risposte scritte nell'altro formato
+    seconda = _consegne_cartacee()
+    seconda.loc[1, "risposte"] = "AB-DA"
+    assert salva_risultati(correggi_consegne(banca, "X", 5, seconda, comuni).to_dict(orient="records"), conn=conn) == 0
+    assert conn.execute("SELECT COUNT(*) FROM risultati").fetchone()[0] == 3
+    assert conn.execute("SELECT SUM(consegne) FROM agg_esiti WHERE dimensione = 'argomento'").fetchone()[0] == 3
+
+    # un altro partecipante con lo stesso foglio è un'altra consegna
+    altra = _consegne_cartacee().iloc[:1].assign(nome="Dario")
+    assert salva_risultati(correggi_consegne(banca, "X", 5, altra, comuni).to_dict(orient="records"), conn=conn) == 1
+
+
+def test_fogli_cartacei_riproducibili(cartella_di_lavoro):
+    (cartella_di_lavoro / "banche").mkdir()
+    _banca_df(["X"] * 12).to_csv(cartella_di_lavoro / "banche" / "B.csv", index=False)
+    banca = carica_banca(str(cartella_di_lavoro / "banche" / "B.csv"))
+    out = correggi_consegne(banca, "X", 5, _consegne_cartacee(), {"banca_domande": "B"})
+
+    for riga in out.to_dict(orient="records"):
+        _, righe, _, risposte, testi_cambiati = ricostruisci_test(riga, str(cartella_di_lavoro / "banche"))
+        codici = [c for c, _, _ in json.loads(riga["risposte_domande"])]
+        assert banca.df["codice"].to_numpy()[righe].tolist() == codici
+        assert not testi_cambiati
+        assert genera_pdf(riga, "test", str(cartella_di_lavoro / "banche")).startswith(b"%PDF")
+    assert risposte == [0, 0, 1]   # Carla, per codici: lettere nell'ordine della banca
+
+
+def test_codici_sconosciuti_senza_riproduzione():
+    banca = compila_banca(_banca_df(["X"] * 12))
+    consegne = pd.DataFrame({"nome": ["A"], "codici": ["c0;zz"], "risposte": ["AA"]})
+    assert correggi_consegne(banca, "X", 5, consegne)["riproduzione"].tolist() == [None]
@@ -0,0 +1,57 @@
+import json
+import time
+
+import pytest
+
+from digest_email import accoda_per_digest, chiudi_finestra_sessione, in_attesa, invia_digest_pronti
+from outbox_email import Outbox
+
+DESTINATARI = ["rspp@example.com"]
+
+
+@pytest.fixture
+def outbox(cartella_di_lavoro):
+    return Outbox(str(cartella_di_lavoro / "outbox.sqlite3"))
+
+
+def _riga(chiave, ente, corso="Preposti", sessione=""):
+    return {
+        "chiave_consegna": chiave, "user_ente": ente, "corso": corso, "data_test": "2025-03-01",
+        "sessione_aula": sessione, "nome_partecipante": f"Nome {chiave}", "punteggio": 8, "n_domande": 10,
+        "percentuale": 80.0, "superato": True,
+    }
+
+
+def _messaggi(outbox):
+    return outbox._conn().execute("SELECT oggetto, destinatari, allegati_differiti FROM outbox ORDER BY id").fetchall()
+
+
+def test_un_messaggio_per_gruppo_alla_scadenza(outbox):
+    righe = {r["chiave_consegna"]: r for r in [_riga("k1", "E1"), _riga("k2", "E1"), _riga("k3", "E2")]}
+    for r in righe.values():
+        assert accoda_per_digest(outbox, r, "app@example.com", DESTINATARI, finestra_s=60)
+    assert not accoda_per_digest(outbox, righe["k1"], "app@example.com", DESTINATARI, finestra_s=60)
+
+    def leggi(chiavi):
+        return [righe[c] for c in chiavi]
+
+    assert invia_digest_pronti(outbox, ora=time.time(), leggi_righe=leggi) == 0
+    assert invia_digest_pronti(outbox, ora=time.time() + 61, leggi_righe=leggi) == 2
+    assert in_attesa(outbox) == 0
+    assert invia_digest_pronti(outbox, ora=time.time() + 61, leggi_righe=leggi) == 0
+
+    messaggi = _messaggi(outbox)
+    assert [m[0].endswith("2 consegne, 2 superati") for m in messaggi].count(True) == 1
+    assert [m[0].endswith("1 consegne, 1 superati") for m in messaggi].count(True) == 1
+    allegati = sorted(sorted(json.loads(m[2])[0]["chiavi"]) for m in messaggi)
+    assert allegati == [["k1", "k2"], ["k3"]]
+
+
+def test_chiusura_sessione_anticipa_il_digest(outbox):
+    righe = {"k1": _riga("k1", "E1", sessione="AULA1"), "k2": _riga("k2", "E2")}
+    for r in righe.values():
+        accoda_per_digest(outbox, r, "app@example.com", DESTINATARI, finestra_s=600)
+
+    assert chiudi_finestra_sessione(outbox, "AULA1") == 1
+    assert invia_digest_pronti(outbox, leggi_righe=lambda chiavi: [righe[c] for c in chiavi]) == 1
+    assert in_attesa(outbox) == 1
@@ -0,0 +1,42 @@
+import numpy as np
+
+from banca_dati import compila_banca
+import duplicati
+from duplicati import gruppi_tra_banche, rileva_gruppi
+from test_banca_dati import _banca_df
+
+TESTI = [
+    "Chi deve indossare i dispositivi di protezione individuale durante il lavoro in quota? Il lavoratore",
+    "Cosa contiene il documento di valutazione dei rischi? L'elenco dei rischi e delle misure",
+    "Durante il lavoro in quota, chi deve indossare i dispositivi di protezione individuale? Il lavoratore",
+    "Chi nomina il responsabile del servizio di prevenzione e protezione? Il datore di lavoro",
+    "CHI NOMINA IL RESPONSABILE DEL SERVIZIO DI PREVENZIONE E PROTEZIONE? Il datore di lavoro.",
+    "Ogni quanto si aggiorna la formazione dei preposti? Ogni due anni",
+]
+
+
+def test_riformulazioni_nello_stesso_gruppo():
+    gruppi = rileva_gruppi(TESTI)
+    assert gruppi.tolist() == [0, -1, 0, 1, 1, -1]
+    # stesse firme in ogni processo: gruppi riproducibili
+    assert np.array_equal(rileva_gruppi(TESTI), gruppi)
+    assert rileva_gruppi([]).tolist() == []
+
+
+def test_stessa_domanda_con_risposta_diversa_non_e_duplicato():
+    df = _banca_df(["X"] * 3)
+    df["domanda"] = ["Il preposto deve:"] * 3
+    df["opzione_a"] = ["sovrintendere al lavoro", "sovrintendere al lavoro", "redigere il DVR da solo"]
+    banca = compila_banca(df)
+    assert rileva_gruppi(duplicati.testi_confronto(banca)).tolist() == [0, 0, -1]
+
+
+def test_gruppi_tra_banche():
+    b1, b2 = _banca_df(["X"] * 3), _banca_df(["Y"] * 2)
+    b1["domanda"], b2["domanda"] = TESTI[:3], TESTI[3:5]
+    b1["opzione_a"] = b2["opzione_a"] = ""  # confronto sulla sola domanda
+    b1["corretta"] = b2["corretta"] = "B"
+    gruppi = gruppi_tra_banche([("B1", compila_banca(b1, path="b1")), ("B2", compila_banca(b2, path="b2"))])
+    assert list(zip(gruppi["gruppo"], gruppi["banca"], gruppi["codice"])) == [
+        (0, "B1", "c0"), (0, "B1", "c2"), (1, "B2", "c0"), (1, "B2", "c1"),
+    ]
@@ -0,0 +1,46 @@
+import csv
+import io
+import zipfile
+
+from export_audit import esporta_audit, nome_file_export
+from risultati import salva_risultati
+
+
+def _indice(path):
+    with zipfile.ZipFile(path) as zf:
+        testo = zf.read("indice.csv").decode("utf-8-sig")
+    return list(csv.DictReader(io.StringIO(testo)))
+
+
+def test_export_diviso_in_parti(cartella_di_lavoro):
+    salva_risultati([
+        {"chiave_consegna": f"k{i}", "user_ente": "E", "nome_partecipante": f"P{i}", "data_test": "2025-01-01",
+         "superato": False, "punteggio": 1, "percentuale": 10.0}
+        for i in range(5)
+    ])
+    conteggi = esporta_audit("export/audit.zip", formato_indice="csv", risultati_per_parte=2)
+
+    assert conteggi["risultati"] == 5
+    assert [p.rsplit("/", 1)[-1] for p in conteggi["file"]] == [
+        "audit_parte1di3.zip", "audit_parte2di3.zip", "audit_parte3di3.zip",
+    ]
+    righe = [_indice(p) for p in conteggi["file"]]
+    assert [len(r) for r in righe] == [2, 2, 1]
+    assert sorted(r["nome_partecipante"] for parte in righe for r in parte) == [f"P{i}" for i in range(5)]
+    # senza record di riproduzione il motivo è nella colonna note
+    assert all(r["note"] for parte in righe for r in parte)
+
+
+def test_export_in_un_solo_zip(cartella_di_lavoro):
+    salva_risultati([{"chiave_consegna": "k0", "user_ente": "E", "data_test": "2025-01-01"}])
+    conteggi = esporta_audit("export/audit.zip", formato_indice="xlsx")
+    assert conteggi["file"] == ["export/audit.zip"]
+    with zipfile.ZipFile("export/audit.zip") as zf:
+        assert "indice.xlsx" in zf.namelist()
+
+
+def test_nome_file_export_sanificato():
+    assert nome_file_export() == "audit_tutti.zip"
+    assert nome_file_export("Studio Rossi", "2025-01-01", "2025-03-31") == "audit_Studio_Rossi_20250101-20250331.zip"
+    for nome in (nome_file_export("../../etc/x", al="2025/01"), nome_file_export('a\\b:"c"\r\n', dal="..")):
+        assert "/" not in nome and "\\" not in nome and ".." not in nome and "\n" not in nome and '"' not in nome
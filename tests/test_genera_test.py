@@ -0,0 +1,22 @@
+import csv
+import io
+import zipfile
+
+import genera_test
+from test_banca_dati import _banca_df
+
+
+def test_nomi_dei_partecipanti_non_creano_percorsi(cartella_di_lavoro):
+    _banca_df(["X"] * 5).to_csv("B.csv", index=False)
+    (cartella_di_lavoro / "iscritti.txt").write_text("../Mario Rossi\nC:\\Anna\n", encoding="utf-8")
+
+    genera_test.main([
+        "--banca", "B.csv", "--argomento", "X", "--n-domande", "3",
+        "--partecipanti", "iscritti.txt", "--output", "sessione.zip", "--processi", "1",
+    ])
+
+    with zipfile.ZipFile("sessione.zip") as z:
+        nomi = z.namelist()
+        chiavi = list(csv.DictReader(io.StringIO(z.read("chiavi_risposte.csv").decode("utf-8"))))
+    assert nomi == ["0001__Mario_Rossi_test_finale.pdf", "0002_C__Anna_test_finale.pdf", "chiavi_risposte.csv"]
+    assert {r["file"] for r in chiavi} == set(nomi[:2])
@@ -0,0 +1,56 @@
+import json
+import pstats
+import os
+import subprocess
+import sys
+
+import metriche
+
+
+def test_un_file_per_processo_con_etichetta_pid(cartella_di_lavoro):
+    metriche.registra("prova", 0.01)
+    metriche.esporta()
+    pid = os.getpid()
+    prom = cartella_di_lavoro / f"metriche_app.{pid}.prom"
+
+    assert prom.exists() and (cartella_di_lavoro / f"metriche_app.{pid}.json").exists()
+    assert not (cartella_di_lavoro / "metriche_app.prom").exists()
+    assert f'test_finale_fase_secondi_count{{fase="prova",pid="{pid}"}}' in prom.read_text()
+
+    metriche._rimuovi_file_esportati()
+    assert not list(cartella_di_lavoro.glob("metriche_app.*"))
+
+
+def test_processi_diversi_non_si_sovrascrivono(cartella_di_lavoro):
+    radice = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    codice = (
+        f"import json, os, sys; sys.path.insert(0, {radice!r}); import metriche; "
+        "metriche.registra('figlio', 0.01); metriche.esporta(); "
+        "print(json.dumps(os.listdir('.')))"
+    )
+    metriche.esporta()
+    figlio = subprocess.run([sys.executable, "-c", codice], capture_output=True, text=True, check=True)
+
+    visti = json.loads(figlio.stdout)
+    assert f"metriche_app.{os.getpid()}.prom" in visti
+    assert len([n for n in visti if n.endswith(".prom")]) == 2
+    # all'uscita il figlio ha rimosso i suoi file, non quelli di questo processo
+    assert [p.name for p in cartella_di_lavoro.glob("*.prom")] == [f"metriche_app.{os.getpid()}.prom"]
+    metriche._rimuovi_file_esportati()
+
+
+def _lavoro_profilato():
+    return sum(i * i for i in range(1000))
+
+
+def test_profilo_di_un_rerun(cartella_di_lavoro):
+    profilo = metriche.ProfiloSessione("s")
+    with profilo.rerun():
+        assert profilo.attivo
+        _lavoro_profilato()
+    assert not profilo.attivo
+
+    stats = pstats.Stats(profilo.ultimo_file)
+    assert stats.total_calls > 0
+    assert any(funzione == "_lavoro_profilato" for _, _, funzione in stats.stats)
+    assert profilo.ultimo_file == profilo.percorso(1)
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+import motore
+from risultati import connessione, consegna_del_ticket, salva_risultato
+from test_banca_dati import _banca_df
+
+
+@pytest.fixture
+def archivio(cartella_di_lavoro):
+    (cartella_di_lavoro / "banche").mkdir()
+    _banca_df(["X"] * 12).to_csv(cartella_di_lavoro / "banche" / "B.csv", index=False)
+    conn = connessione(str(cartella_di_lavoro / "risultati.sqlite3"))
+    return {
+        "cartella_banche": str(cartella_di_lavoro / "banche"),
+        "salva": lambda riga: salva_risultato(riga, conn),
+        "consegnata": lambda firma: consegna_del_ticket(firma, conn),
+        "conn": conn,
+    }
+
+
+def _ticket(archivio):
+    utente = {"login_user": "u1", "user_ente": "E", "user_role": "Partecipante"}
+    return motore.emetti_test("B", "X", 10, utente, seed="s", cartella_banche=archivio["cartella_banche"])["ticket"]
+
+
+def _consegna(archivio, ticket, risposte, nome="Mario"):
+    return motore.consegna(
+        ticket, risposte, {"nome": nome}, login_user="u1", salva=archivio["salva"],
+        cartella_banche=archivio["cartella_banche"], consegnata=archivio["consegnata"],
+    )
+
+
+def test_ticket_consegnato_una_volta(archivio):
+    ticket = _ticket(archivio)
+    prima = _consegna(archivio, ticket, [0] * 10)
+    assert prima["nuova"]
+
+    # la stessa consegna ripetuta è idempotente
+    ripetuta = _consegna(archivio, ticket, [0] * 10)
+    assert not ripetuta["nuova"]
+    assert ripetuta["chiave_consegna"] == prima["chiave_consegna"]
+
+    # altre risposte o altri dati del partecipante: rifiutata
+    with pytest.raises(motore.TicketGiaConsegnato):
+        _consegna(archivio, ticket, [1] * 10)
+    with pytest.raises(motore.TicketGiaConsegnato):
+        _consegna(archivio, ticket, [0] * 10, nome="Maria")
+    assert archivio["conn"].execute("SELECT COUNT(*) FROM risultati").fetchone()[0] == 1
+
+
+def test_nuovo_ticket_nuovo_tentativo(archivio):
+    # stesso seed, quindi stesso test: un nuovo ticket è un nuovo tentativo
+    assert _consegna(archivio, _ticket(archivio), [0] * 10)["nuova"]
+    assert _consegna(archivio, _ticket(archivio), [1] * 10)["nuova"]
+
+
+def test_segreto_creato_completo(monkeypatch):
+    monkeypatch.delenv(motore.VARIABILE_SEGRETO, raising=False)
+    monkeypatch.setattr(motore, "_segreto", None)
+    valore = motore.segreto()
+    assert len(valore) == 64
+    with open(motore.FILE_SEGRETO) as f:
+        assert f.read().strip().encode() == valore
+
+
+def test_segreto_vuoto_rifiutato(monkeypatch):
+    monkeypatch.delenv(motore.VARIABILE_SEGRETO, raising=False)
+    monkeypatch.setattr(motore, "_segreto", None)
+    open(motore.FILE_SEGRETO, "w").close()
+    with pytest.raises(RuntimeError):
+        motore.segreto()
+
+
+@pytest.mark.parametrize("campo, valore", [("domanda", "Testo cambiato?"), ("corretta", "B")])
+def test_ticket_rifiutato_se_la_banca_cambia(archivio, campo, valore):
+    ticket = _ticket(archivio)
+    path = os.path.join(archivio["cartella_banche"], "B.csv")
+    df = _banca_df(["X"] * 12)
+    df[campo] = valore   # stessi codici, testi o chiave diversi
+    df.to_csv(path, index=False)
+    os.utime(path, ns=(1, 1))
+
+    with pytest.raises(motore.BancaModificata):
+        _consegna(archivio, ticket, [0] * 10)
+    assert archivio["conn"].execute("SELECT COUNT(*) FROM risultati").fetchone()[0] == 0
+
+
+def test_ticket_valido_se_la_banca_cambia_altrove(archivio):
+    ticket = _ticket(archivio)
+    path = os.path.join(archivio["cartella_banche"], "B.csv")
+    df = _banca_df(["X"] * 13)   # una domanda in più: le domande del ticket sono invariate
+    df.to_csv(path, index=False)
+    os.utime(path, ns=(1, 1))
+    assert _consegna(archivio, ticket, [0] * 10)["nuova"]
@@ -0,0 +1,165 @@
+import smtplib
+import time
+from email import message_from_bytes
+
+import pytest
+
+import outbox_email
+from outbox_email import (
+    MAX_TENTATIVI, STATO_FALLITA, STATO_IN_CODA, STATO_INVIATA, Outbox, OutboxWorker, TrasportoMemoria,
+    TrasportoSMTP, accoda_email,
+)
+
+
+@pytest.fixture
+def outbox(cartella_di_lavoro):
+    return Outbox(str(cartella_di_lavoro / "outbox.sqlite3"))
+
+
+def _stato(outbox, id_msg):
+    return outbox._conn().execute(
+        "SELECT stato, tentativi, prossimo_tentativo, ultimo_errore FROM outbox WHERE id = ?", (id_msg,)
+    ).fetchone()
+
+
+def _scaduto(outbox, id_msg):
+    """Come se fosse passato il tempo di backoff."""
+    outbox._conn().execute("UPDATE outbox SET prossimo_tentativo = 0 WHERE id = ?", (id_msg,))
+
+
+def test_worker_invia_con_trasporto_memoria(outbox):
+    trasporto = TrasportoMemoria()
+    id_msg = accoda_email(outbox, "da@example.com", ["a@example.com", "b@example.com"], "Oggetto", "Testo", [])
+    worker = OutboxWorker(outbox, trasporto)
+
+    assert worker.svuota_una_volta() == 1
+    assert worker.svuota_una_volta() == 0
+    mittente, destinatari, messaggio = trasporto.inviati[0]
+    assert (mittente, destinatari) == ("da@example.com", ["a@example.com", "b@example.com"])
+    assert message_from_bytes(messaggio)["Subject"] == "Oggetto"
+    assert _stato(outbox, id_msg)[0] == STATO_INVIATA
+
+
+def test_allegati_differiti_risolti_all_invio(outbox):
+    trasporto = TrasportoMemoria()
+    richiesti = []
+
+    def risolutore(riferimenti):
+        richiesti.append(riferimenti)
+        return [("report.pdf", b"%PDF-", "application/pdf")]
+
+    accoda_email(outbox, "da@example.com", ["a@example.com"], "Oggetto", "Testo", [],
+                 allegati_differiti=[{"chiave_consegna": "k", "tipo": "test"}])
+    assert OutboxWorker(outbox, trasporto, risolutore_allegati=risolutore).svuota_una_volta() == 1
+    assert richiesti == [[{"chiave_consegna": "k", "tipo": "test"}]]
+    parti = [p.get_filename() for p in message_from_bytes(trasporto.inviati[0][2]).walk()]
+    assert "report.pdf" in parti
+
+
+def test_backoff_esponenziale_e_fallimento(outbox):
+    trasporto = TrasportoMemoria(errori_da_simulare=MAX_TENTATIVI)
+    id_msg = accoda_email(outbox, "da@example.com", ["a@example.com"], "Oggetto", "Testo", [])
+    worker = OutboxWorker(outbox, trasporto)
+
+    attese = []
+    for tentativo in range(1, MAX_TENTATIVI):
+        prima = time.time()
+        assert worker.svuota_una_volta() == 0
+        stato, tentativi, prossimo, errore = _stato(outbox, id_msg)
+        assert (stato, tentativi) == (STATO_IN_CODA, tentativo)
+        assert "SMTPServerDisconnected" in errore
+        attese.append(prossimo - prima)
+        # prima della scadenza del backoff il messaggio non viene ripreso
+        assert worker.svuota_una_volta() == 0
+        _scaduto(outbox, id_msg)
+    assert attese == sorted(attese)
+    assert attese[1] == pytest.approx(2 * attese[0], rel=0.1)
+
+    assert worker.svuota_una_volta() == 0
+    assert _stato(outbox, id_msg)[:2] == (STATO_FALLITA, MAX_TENTATIVI)
+
+    # riprova_falliti rimette in coda: il trasporto ora funziona
+    assert outbox.riprova_falliti() == 1
+    assert worker.svuota_una_volta() == 1
+    assert _stato(outbox, id_msg)[0] == STATO_INVIATA
+
+
+def test_worker_in_background(outbox):
+    trasporto = TrasportoMemoria(errori_da_simulare=1)
+    worker = OutboxWorker(outbox, trasporto, intervallo_s=0.05)
+    worker.start()
+    try:
+        id_msg = accoda_email(outbox, "da@example.com", ["a@example.com"], "Oggetto", "Testo", [])
+        worker.sveglia()
+        limite = time.monotonic() + 5
+        while _stato(outbox, id_msg)[1] == 0 and time.monotonic() < limite:
+            time.sleep(0.01)
+        _scaduto(outbox, id_msg)
+        while not trasporto.inviati and time.monotonic() < limite:
+            time.sleep(0.01)
+    finally:
+        worker.ferma()
+    assert len(trasporto.inviati) == 1
+    assert _stato(outbox, id_msg)[:2] == (STATO_INVIATA, 1)
+
+
+# ============================================================
+# TRASPORTO SMTP (server finto)
+# ============================================================
+
+class _ServerFinto:
+    connessioni = []
+
+    def __init__(self, host, port, timeout=None):
+        self.comandi = []
+        _ServerFinto.connessioni.append(self)
+
+    def starttls(self, context=None):
+        self.comandi.append("starttls")
+
+    def login(self, username, password):
+        self.comandi.append("login")
+
+    def sendmail(self, mittente, destinatari, messaggio):
+        if _ServerFinto.errori:  # errori da simulare, condivisi tra le connessioni
+            raise _ServerFinto.errori.pop(0)
+        self.comandi.append("sendmail")
+
+    def quit(self):
+        self.comandi.append("quit")
+
+
+@pytest.fixture
+def smtp_finto(monkeypatch):
+    _ServerFinto.connessioni = []
+    _ServerFinto.errori = []
+    monkeypatch.setattr(outbox_email.smtplib, "SMTP", _ServerFinto)
+    return _ServerFinto
+
+
+def test_smtp_in_chiaro_senza_starttls_ne_login(smtp_finto):
+    TrasportoSMTP("localhost", 1025, "da@example.com", "", use_ssl=False, starttls=False).invia(
+        "da@example.com", ["a@example.com"], b"x"
+    )
+    assert smtp_finto.connessioni[0].comandi == ["sendmail"]
+
+
+def test_smtp_starttls_con_login(smtp_finto):
+    TrasportoSMTP("localhost", 587, "da@example.com", "pw", use_ssl=False).invia("da@example.com", ["a"], b"x")
+    assert smtp_finto.connessioni[0].comandi == ["starttls", "login", "sendmail"]
+
+
+def test_smtp_riconnessione_solo_per_errori_di_connessione(smtp_finto):
+    trasporto = TrasportoSMTP("localhost", 1025, "", "", use_ssl=False, starttls=False)
+
+    smtp_finto.errori = [smtplib.SMTPServerDisconnected("chiusa")]
+    trasporto.invia("da@example.com", ["a"], b"x")
+    assert len(smtp_finto.connessioni) == 2
+
+    trasporto.chiudi()
+    smtp_finto.connessioni = []
+    smtp_finto.errori = [smtplib.SMTPRecipientsRefused({"a": (550, b"no")})]
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        trasporto.invia("da@example.com", ["a"], b"x")
+    assert len(smtp_finto.connessioni) == 1
+    assert "sendmail" not in smtp_finto.connessioni[0].comandi
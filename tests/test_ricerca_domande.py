@@ -0,0 +1,47 @@
+import pytest
+
+from ricerca_domande import cerca, svuota_cache
+from test_banca_dati import _banca_df
+
+
+@pytest.fixture
+def cartella(cartella_di_lavoro):
+    cartella = cartella_di_lavoro / "banche"
+    cartella.mkdir()
+    b1 = _banca_df(["X"] * 4)
+    b1["domanda"] = [
+        "Quali dispositivi di protezione individuale usa il lavoratore?",
+        "Chi fornisce i DPI?",
+        "Cosa contiene il documento di valutazione dei rischi?",
+        "Quando si usano i dispositivi?",
+    ]
+    b1.loc[1, "opzione_a"] = "I dispositivi sono forniti dal datore di lavoro"
+    b1.to_csv(cartella / "B1.csv", index=False)
+    b2 = _banca_df(["Y"])
+    b2["domanda"] = ["I lavoratori ricevono la formazione?"]
+    b2.to_csv(cartella / "B2.csv", index=False)
+    yield str(cartella)
+    svuota_cache()
+
+
+def _trovati(risultati):
+    return list(zip(risultati["banca"], risultati["codice"]))
+
+
+def test_la_domanda_pesa_piu_delle_opzioni(cartella):
+    risultati = cerca("dispositivi", cartella=cartella, prefisso=False)
+    assert _trovati(risultati) == [("B1", "c0"), ("B1", "c3"), ("B1", "c1")]
+    assert risultati["punteggio"].iloc[0] == 2 * risultati["punteggio"].iloc[2]
+
+
+def test_tutti_i_termini_e_singolare_plurale(cartella):
+    assert _trovati(cerca("dispositivi protezione", cartella=cartella, prefisso=False)) == [("B1", "c0")]
+    assert _trovati(cerca("lavoratori", cartella=cartella, prefisso=False)) == [("B1", "c0"), ("B2", "c0")]
+    assert _trovati(cerca("lavoratori", cartella=cartella, banche=["B2"], prefisso=False)) == [("B2", "c0")]
+
+
+def test_ultimo_termine_come_prefisso(cartella):
+    assert _trovati(cerca("documento valut", cartella=cartella)) == [("B1", "c2")]
+    # con lo spazio finale la parola è completa: 'valut' non è un termine indicizzato
+    assert cerca("documento valut ", cartella=cartella).empty
+    assert cerca("documento valut", cartella=cartella, prefisso=False).empty
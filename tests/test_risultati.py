@@ -0,0 +1,102 @@
+import csv
+import json
+import random
+
+import pytest
+
+from risultati import (
+    codici_gia_estratti, connessione, leggi_statistiche_domande, migra_da_csv, ricostruisci_aggregati, salva_risultati,
+)
+
+
+@pytest.fixture
+def conn(cartella_di_lavoro):
+    return connessione(str(cartella_di_lavoro / "risultati.sqlite3"))
+
+
+def _aggregati(conn):
+    return (
+        conn.execute("SELECT * FROM agg_esiti ORDER BY dimensione, valore").fetchall(),
+        conn.execute("SELECT * FROM agg_domande ORDER BY banca_domande, codice").fetchall(),
+    )
+
+
+def test_aggregati_incrementali_uguali_alla_ricostruzione(conn):
+    rng = random.Random(0)
+    righe = []
+    for i in range(60):
+        codici = rng.sample([f"c{k}" for k in range(12)], 5)
+        dettaglio = [[c, rng.choice(["A", "B", "C", "D", ""]), "A"] for c in codici]
+        righe.append({
+            "chiave_consegna": f"k{i}", "banca_domande": rng.choice(["B1", "B2"]),
+            "argomento": rng.choice(["X", "Y"]), "user_ente": rng.choice(["E1", "E2", ""]),
+            "data_test": f"2025-01-0{1 + i % 3}", "superato": rng.choice([True, False, "True", "False"]),
+            "percentuale": rng.choice([40.0, 80.0, 100.0]), "risposte_domande": json.dumps(dettaglio),
+        })
+    # a blocchi, con consegne ripetute che non devono contare due volte
+    for inizio in range(0, 60, 7):
+        salva_risultati(righe[inizio:inizio + 7] + righe[:2], conn=conn)
+
+    incrementali = _aggregati(conn)
+    ricostruisci_aggregati(conn, blocco=9)
+    assert _aggregati(conn) == incrementali
+    assert sum(r[2] for r in incrementali[0] if r[0] == "argomento") == 60
+
+
+def test_statistiche_per_domanda(conn):
+    salva_risultati([
+        {"chiave_consegna": "k1", "banca_domande": "B", "risposte_domande": json.dumps([["c1", "A", "A"], ["c2", "B", "C"]])},
+        {"chiave_consegna": "k2", "banca_domande": "B", "risposte_domande": json.dumps([["c1", "", "A"], ["c2", "B", "C"]])},
+    ], conn=conn)
+    stat = leggi_statistiche_domande("B", conn=conn).set_index("codice")
+
+    assert stat.loc["c1", "indice_difficolta"] == 0.5
+    assert stat.loc["c1", "quota_non_risposte"] == 0.5
+    assert stat.loc["c2", "indice_difficolta"] == 0.0
+    assert stat.loc["c2", "distrattore_principale"] == "B"
+
+
+def _riga(i, banca, nome, email, codici):
+    return {
+        "chiave_consegna": f"k{i}", "banca_domande": banca, "nome_partecipante": nome,
+        "email_partecipante": email, "risposte_domande": json.dumps([[c, "A", 1] for c in codici]),
+    }
+
+
+def test_codici_gia_estratti_per_email_e_per_nome(conn):
+    salva_risultati([
+        _riga(0, "B", "Anna", "anna@example.com", ["c1", "c2"]),
+        _riga(1, "B", "Anna", "anna@example.com", ["c3"]),
+        _riga(2, "B", "Anna", "", ["c4"]),
+        _riga(3, "ALTRA", "Anna", "anna@example.com", ["c9"]),
+    ], conn=conn)
+
+    assert codici_gia_estratti("B", email="anna@example.com", conn=conn) == {"c1", "c2", "c3"}
+    assert codici_gia_estratti("B", nome="Anna", conn=conn) == {"c1", "c2", "c3", "c4"}
+    assert codici_gia_estratti("B", conn=conn) == set()
+
+
+@pytest.mark.parametrize("colonna, indice", [
+    ("email_partecipante", "idx_risultati_email"),
+    ("nome_partecipante", "idx_risultati_nome"),
+])
+def test_codici_gia_estratti_usa_un_indice(conn, colonna, indice):
+    piano = " ".join(r[-1] for r in conn.execute(
+        f"EXPLAIN QUERY PLAN SELECT risposte_domande FROM risultati WHERE banca_domande = ? AND {colonna} = ?",
+        ("B", "x"),
+    ))
+    assert indice in piano
+
+
+def test_migrazione_con_intestazioni_ostili(conn, cartella_di_lavoro):
+    ostile = 'x" TEXT); DROP TABLE meta; --'
+    path = cartella_di_lavoro / "vecchio.csv"
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows([["nome_partecipante", ostile, 'a"b'], ["Mario", "1", "2"]])
+
+    assert migra_da_csv(conn, str(path)) == 1
+    assert conn.execute("SELECT COUNT(*) FROM meta").fetchone()[0] >= 1
+    riga = conn.execute("SELECT * FROM risultati").fetchone()
+    colonne = [d[0] for d in conn.execute("SELECT * FROM risultati").description]
+    assert dict(zip(colonne, riga))[ostile] == "1"
+    assert dict(zip(colonne, riga))['a"b'] == "2"
@@ -0,0 +1,52 @@
+import math
+import random
+
+import pytest
+
+from correzione import calcola_esito
+from sequenziale import ParametriSPRT, arresto
+
+PARAMETRI = ParametriSPRT()
+
+
+def _arresto_passo_passo(esiti, parametri, massimo):
+    """Riferimento: un passo alla volta, come lo descrive il modulo."""
+    corretta, errata = parametri.passi
+    basso, alto = parametri.limiti
+    rapporto = 0.0
+    for n, esito in enumerate(esiti[:massimo], start=1):
+        rapporto += corretta if esito else errata
+        if n >= parametri.minimo and (rapporto <= basso or rapporto >= alto):
+            return n, rapporto >= alto
+    if len(esiti) >= massimo:
+        return massimo, calcola_esito(sum(esiti[:massimo]), massimo)[1]
+    return len(esiti[:massimo]), None
+
+
+def test_tutte_corrette_si_ferma_al_limite_di_wald():
+    corretta, _ = PARAMETRI.passi
+    attese = max(PARAMETRI.minimo, math.ceil(PARAMETRI.limiti[1] / corretta))
+    assert arresto([True] * 30, PARAMETRI, 30) == (attese, True)
+    assert arresto([True] * (attese - 1), PARAMETRI, 30) == (attese - 1, None)
+
+
+def test_mai_prima_del_minimo():
+    # tre errori bastano a superare il limite basso, ma si decide solo al minimo
+    assert arresto([False] * 3, PARAMETRI, 30) == (3, None)
+    assert arresto([False] * 30, PARAMETRI, 30) == (PARAMETRI.minimo, False)
+    assert arresto([False] * 30, ParametriSPRT(minimo=1), 30)[0] < PARAMETRI.minimo
+
+
+def test_senza_decisione_vale_la_soglia_al_massimo():
+    esiti = [True, True, True, True, False] * 6
+    assert arresto(esiti[:24], PARAMETRI, 30) == (24, None)
+    assert arresto(esiti, PARAMETRI, 30) == (30, calcola_esito(24, 30)[1])
+    assert arresto([], PARAMETRI, 30) == (0, None)
+
+
+@pytest.mark.parametrize("p", [0.6, 0.8, 0.95])
+def test_uguale_al_calcolo_passo_passo(p):
+    rng = random.Random(p)
+    for _ in range(200):
+        esiti = [rng.random() < p for _ in range(rng.randint(0, 30))]
+        assert arresto(esiti, PARAMETRI, 20) == _arresto_passo_passo(esiti, PARAMETRI, 20)
@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import pytest
+
+from banca_dati import carica_banca
+from risultati import connessione, salva_risultati
+from sessioni_aula import apri_sessione, avanzamento, correggi_fogli
+from test_banca_dati import _banca_df
+
+
+def test_fogli_rifiutati_se_la_banca_cambia(cartella_di_lavoro):
+    path = str(cartella_di_lavoro / "B.csv")
+    _banca_df(["X"] * 12).to_csv(path, index=False)
+    conn = connessione(str(cartella_di_lavoro / "risultati.sqlite3"))
+    sessione = apri_sessione(carica_banca(path), "B", "X", 5, k_varianti=2, conn=conn)
+    fogli = pd.DataFrame({"nome": ["A"], "variante": ["1"], "risposte": ["ABCDA"]})
+
+    assert len(correggi_fogli(sessione, carica_banca(path), fogli)) == 1
+
+    _banca_df(["X"] * 13).to_csv(path, index=False)
+    os.utime(path, ns=(1, 1))  # firma diversa anche con mtime a bassa risoluzione
+    with pytest.raises(ValueError, match="modificata"):
+        correggi_fogli(sessione, carica_banca(path), fogli)
+
+
+def test_ricorreggere_i_fogli_non_duplica(cartella_di_lavoro):
+    path = str(cartella_di_lavoro / "B.csv")
+    _banca_df(["X"] * 12).to_csv(path, index=False)
+    conn = connessione(str(cartella_di_lavoro / "risultati.sqlite3"))
+    sessione = apri_sessione(carica_banca(path), "B", "X", 5, k_varianti=2, conn=conn)
+    fogli = pd.DataFrame({"nome": ["A", "B", "C"], "variante": ["1", "2", "1"], "risposte": ["ABCDA", "AAAAA", "ABCDA"]})
+
+    for _ in range(2):
+        righe = correggi_fogli(sessione, carica_banca(path), fogli, {"login_user": "docente"})
+        salva_risultati(righe.to_dict(orient="records"), conn=conn)
+
+    per_studente = conn.execute(
+        "SELECT nome_partecipante, COUNT(*) FROM risultati WHERE sessione_aula = ? GROUP BY nome_partecipante",
+        (sessione.codice,),
+    ).fetchall()
+    assert sorted(per_studente) == [("A", 1), ("B", 1), ("C", 1)]
+    assert avanzamento(sessione.codice, conn=conn)["consegne"] == 3
@@ -0,0 +1,61 @@
+import hashlib
+
+import pytest
+
+import utenti
+
+
+@pytest.fixture
+def file_utenti(cartella_di_lavoro):
+    path = cartella_di_lavoro / "utenti_test_finale.csv"
+    path.write_text(
+        "username,password\n"
+        f"hash,{utenti.hash_password('segreta', iterazioni=1000)}\n"
+        "chiaro,segreta\n",
+        encoding="utf-8",
+    )
+    return str(path)
+
+
+@pytest.fixture
+def chiamate_kdf(monkeypatch):
+    chiamate = []
+    originale = hashlib.pbkdf2_hmac
+
+    def conta(nome, password, sale, iterazioni, *args):
+        chiamate.append(iterazioni)
+        return originale(nome, password, sale, 1, *args)  # test veloci: conta solo le chiamate
+
+    monkeypatch.setattr(hashlib, "pbkdf2_hmac", conta)
+    return chiamate
+
+
+@pytest.mark.parametrize("username, password, valido", [
+    ("chiaro", "segreta", True),
+    ("chiaro", "sbagliata", False),
+    ("sconosciuto", "segreta", False),
+])
+def test_password_in_chiaro_pagano_il_kdf(file_utenti, chiamate_kdf, username, password, valido):
+    assert (utenti.autentica(username, password, path=file_utenti) is not None) is valido
+    assert chiamate_kdf == [utenti.ITERAZIONI_PBKDF2]
+
+
+def test_password_con_hash(file_utenti):
+    assert utenti.autentica("hash", "segreta", path=file_utenti).username == "hash"
+    assert utenti.autentica("hash", "sbagliata", path=file_utenti) is None
+
+
+def test_sessione_conserva_solo_l_impronta(file_utenti):
+    utente = utenti.autentica("chiaro", "segreta", path=file_utenti)
+    impronta = utenti.impronta_password(utente.password)
+    assert "segreta" not in impronta
+    assert utenti.ancora_valido("chiaro", impronta, path=file_utenti)
+    # la password in chiaro non vale più come credenziale di sessione
+    assert not utenti.ancora_valido("chiaro", "segreta", path=file_utenti)
+
+    with open(file_utenti, "a", encoding="utf-8") as f:
+        f.write("altro,x\n")
+    assert utenti.ancora_valido("chiaro", impronta, path=file_utenti)
+    with open(file_utenti, "w", encoding="utf-8") as f:
+        f.write("username,password\nchiaro,cambiata\n")
+    assert not utenti.ancora_valido("chiaro", impronta, path=file_utenti)
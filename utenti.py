@@ -0,0 +1,243 @@
+"""Anagrafica utenti dell'app: indice per username, password con hash e ricarica a caldo.
+
+Il file utenti (utenti_test_finale.csv o utenti_quiz.csv, colonne almeno
+username e password, opzionali ruolo ed ente) viene compilato in un dizionario
+username -> Utente e riletto solo quando cambiano mtime o dimensione: i nuovi
+utenti sono attivi senza riavviare l'app.
+
+Le password possono essere salvate come hash con sale:
+    pbkdf2_sha256$<iterazioni>$<sale base64>$<hash base64>
+    scrypt$<n>$<r>$<p>$<sale base64>$<hash base64>
+e vengono confrontate in tempo costante. Le password in chiaro restano
+accettate per compatibilità (con lo stesso costo di KDF, per non rivelare
+quali utenti le usano); per convertirle:
+    python utenti.py --converti utenti_test_finale.csv
+"""
+import argparse
+import base64
+import csv
+import getpass
+import hashlib
+import hmac
+import os
+import secrets
+import sys
+import threading
+from dataclasses import dataclass
+
+# ============================================================
+# COSTANTI
+# ============================================================
+FILE_UTENTI = ("utenti_test_finale.csv", "utenti_quiz.csv")  # il secondo per compatibilità
+COLONNE_RICHIESTE = {"username", "password"}
+ITERAZIONI_PBKDF2 = 600_000
+BYTE_SALE = 16
+SCHEMI_HASH = ("pbkdf2_sha256", "scrypt")
+# hash ben formato ma che non corrisponde a nessuna password: per gli username inesistenti
+_HASH_FITTIZIO = f"pbkdf2_sha256${ITERAZIONI_PBKDF2}${'A' * 24}${'A' * 44}"
+
+
+class FileUtentiNonValido(ValueError):
+    """Il file utenti manca o non ha le colonne richieste."""
+
+
+@dataclass(frozen=True)
+class Utente:
+    username: str
+    password: str   # hash 'schema$...' oppure, per compatibilità, in chiaro
+    ruolo: str = ""
+    ente: str = ""
+
+
+@dataclass(frozen=True)
+class IndiceUtenti:
+    """Anagrafica compilata e immutabile."""
+    path: str
+    versione: tuple     # (mtime_ns, size) del file
+    utenti: dict        # username -> Utente
+    in_chiaro: int      # utenti con password non ancora convertita in hash
+
+    def get(self, username: str):
+        return self.utenti.get(username)
+
+
+# ============================================================
+# HASH DELLE PASSWORD
+# ============================================================
+
+def _b64(dati: bytes) -> str:
+    return base64.b64encode(dati).decode("ascii")
+
+
+def hash_password(password: str, iterazioni: int = ITERAZIONI_PBKDF2) -> str:
+    """Hash PBKDF2-SHA256 con sale casuale, nel formato pbkdf2_sha256$iterazioni$sale$hash."""
+    sale = secrets.token_bytes(BYTE_SALE)
+    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), sale, iterazioni)
+    return f"pbkdf2_sha256${iterazioni}${_b64(sale)}${_b64(dk)}"
+
+
+def is_hash(memorizzata: str) -> bool:
+    return memorizzata.split("$", 1)[0] in SCHEMI_HASH and memorizzata.count("$") >= 3
+
+
+def verifica_password(password: str, memorizzata: str) -> bool:
+    """Confronto in tempo costante con l'hash (o con la password in chiaro, per i file non convertiti)."""
+    candidata = (password or "").encode("utf-8")
+    if not is_hash(memorizzata):
+        # stesso costo degli hash e degli username inesistenti: il tempo di risposta non distingue i casi
+        verifica_password(password, _HASH_FITTIZIO)
+        return hmac.compare_digest(candidata, memorizzata.encode("utf-8"))
+    try:
+        schema, *parametri = memorizzata.split("$")
+        if schema == "pbkdf2_sha256":
+            iterazioni, sale, atteso = parametri
+            calcolato = hashlib.pbkdf2_hmac("sha256", candidata, base64.b64decode(sale), int(iterazioni))
+        else:
+            n, r, p, sale, atteso = parametri
+            calcolato = hashlib.scrypt(
+                candidata, salt=base64.b64decode(sale), n=int(n), r=int(r), p=int(p),
+                maxmem=256 * 1024 * 1024, dklen=len(base64.b64decode(atteso)),
+            )
+    except (ValueError, TypeError):
+        return False
+    return hmac.compare_digest(calcolato, base64.b64decode(atteso))
+
+
+# ============================================================
+# INDICE CON RICARICA A CALDO
+# ============================================================
+_lock = threading.Lock()
+_cache_indici = {}   # path -> IndiceUtenti
+
+
+def trova_file_utenti(cartella: str = ".") -> str:
+    for nome in FILE_UTENTI:
+        path = os.path.join(cartella, nome)
+        if os.path.exists(path):
+            return path
+    raise FileUtentiNonValido(
+        f"File '{FILE_UTENTI[0]}' (o '{FILE_UTENTI[1]}') non trovato. Crealo nella stessa cartella dell'app."
+    )
+
+
+def _leggi_righe(path: str):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        colonne = set(reader.fieldnames or ())
+        if not COLONNE_RICHIESTE.issubset(colonne):
+            raise FileUtentiNonValido("Il file utenti deve contenere almeno le colonne: username, password.")
+        return list(reader), list(reader.fieldnames)
+
+
+def compila_utenti(path: str, versione: tuple) -> IndiceUtenti:
+    righe, _ = _leggi_righe(path)
+    utenti = {}
+    for r in righe:
+        username = (r.get("username") or "").strip()
+        if not username or username in utenti:
+            continue  # come il filtro precedente: vale la prima riga di ogni username
+        utenti[username] = Utente(
+            username=username,
+            password=r.get("password") or "",
+            ruolo=(r.get("ruolo") or "").strip(),
+            ente=(r.get("ente") or "").strip(),
+        )
+    in_chiaro = sum(1 for u in utenti.values() if not is_hash(u.password))
+    return IndiceUtenti(path=path, versione=versione, utenti=utenti, in_chiaro=in_chiaro)
+
+
+def carica_utenti(path: str = None) -> IndiceUtenti:
+    """Indice degli utenti, ricompilato solo se mtime/size del file sono cambiati."""
+    path = os.path.abspath(path or trova_file_utenti())
+    try:
+        st = os.stat(path)
+    except OSError:
+        raise FileUtentiNonValido(f"File utenti '{path}' non trovato.")
+    versione = (st.st_mtime_ns, st.st_size)
+
+    indice = _cache_indici.get(path)
+    if indice is not None and indice.versione == versione:
+        return indice
+    with _lock:
+        indice = _cache_indici.get(path)
+        if indice is None or indice.versione != versione:
+            indice = compila_utenti(path, versione)
+            _cache_indici[path] = indice
+        return indice
+
+
+def autentica(username: str, password: str, path: str = None):
+    """Utente se le credenziali sono valide, altrimenti None (il KDF si paga solo qui, al login)."""
+    utente = carica_utenti(path).get(username or "")
+    if utente is None:
+        # stesso costo di un utente esistente: non rivela quali username esistono
+        verifica_password(password, _HASH_FITTIZIO)
+        return None
+    return utente if verifica_password(password, utente.password) else None
+
+
+def impronta_password(password_file: str) -> str:
+    """
+    SHA-256 del campo password del file utenti, da tenere in sessione al posto del
+    campo stesso (che per gli utenti non ancora convertiti è la password in chiaro).
+    """
+    return hashlib.sha256(password_file.encode("utf-8")).hexdigest()
+
+
+def ancora_valido(username: str, impronta_memorizzata: str, path: str = None) -> bool:
+    """
+    Verifica a ogni rerun, senza KDF: l'utente esiste ancora e la sua password nel
+    file è la stessa verificata al login (confronto tra impronte, vedi impronta_password).
+    """
+    try:
+        utente = carica_utenti(path).get(username or "")
+    except FileUtentiNonValido:
+        return False
+    return utente is not None and hmac.compare_digest(
+        impronta_password(utente.password).encode("ascii"), impronta_memorizzata.encode("utf-8")
+    )
+
+
+# ============================================================
+# CONVERSIONE DEL FILE
+# ============================================================
+
+def converti_file(path: str) -> int:
+    """Sostituisce nel file le password in chiaro con il loro hash. Ritorna quante ne ha convertite."""
+    righe, colonne = _leggi_righe(path)
+    convertite = 0
+    for r in righe:
+        password = r.get("password") or ""
+        if password and not is_hash(password):
+            r["password"] = hash_password(password)
+            convertite += 1
+    if convertite:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=colonne)
+            writer.writeheader()
+            writer.writerows(righe)
+        os.replace(tmp, path)
+    return convertite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gestione delle password del file utenti.")
+    azione = parser.add_mutually_exclusive_group(required=True)
+    azione.add_argument("--converti", metavar="FILE", help="sostituisce le password in chiaro con hash PBKDF2")
+    azione.add_argument("--hash", action="store_true", help="chiede una password e ne stampa l'hash")
+    args = parser.parse_args(argv)
+
+    if args.hash:
+        print(hash_password(getpass.getpass("Password: ")))
+        return 0
+    try:
+        n = converti_file(args.converti)
+    except (OSError, FileUtentiNonValido) as e:
+        parser.error(str(e))
+    print(f"{args.converti}: {n} password convertite", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())